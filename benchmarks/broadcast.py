@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Time sending one message to a large number of recipients
+
+Compares calling send for every recipient with broadcast, against a
+client that just counts the bytes it is asked to write.
+"""
+import logging
+import sys
+import time
+
+from benderjab import bot
+
+class NullClient(object):
+    def __init__(self):
+        self.writes = 0
+        self.size = 0
+
+    def send(self, stanza):
+        self.writes += 1
+        self.size += len(str(stanza))
+
+def send_loop(b, users, body):
+    for user in users:
+        b.send(user, body)
+
+def broadcast(b, users, body):
+    b.broadcast(users, body)
+
+def main(args=None):
+    count = 10000
+    if args is not None and len(args) > 1:
+        count = int(args[1])
+
+    b = bot.BenderJab()
+    b.jid = 'bot@example.org'
+    b.log = logging.getLogger('benchmark')
+    users = ['user%d@example.org' % (i,) for i in range(count)]
+    body = 'The build is broken again. ' * 4
+    for name, run in (('send loop', send_loop), ('broadcast', broadcast)):
+        b.cl = NullClient()
+        start = time.perf_counter()
+        run(b, users, body)
+        elapsed = time.perf_counter() - start
+        print("%-10s %d recipients in %.3f sec (%.0f msgs/sec, %d writes)"
+              % (name, count, elapsed, count / elapsed, b.cl.writes))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
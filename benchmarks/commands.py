@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Compare a chain of re.match calls with CommandRouter dispatch
+"""
+import re
+import sys
+import time
+
+from benderjab.commands import CommandRouter
+
+def make_chain(names):
+    def parser(message, who=None):
+        for name in names:
+            if re.match(name, message):
+                return name
+        return None
+    return parser
+
+def make_router(names):
+    router = CommandRouter()
+    for name in names:
+        router.add(name, lambda args, who, name=name: name)
+    def parser(message, who=None):
+        cmd, args = router.lookup(message)
+        if cmd is None:
+            return None
+        return router.run(cmd, args, who)
+    return parser
+
+def main(args=None):
+    # stay under the re module's cache size, past it re.match recompiles
+    # every pattern and the chain gets far slower still
+    for count in (10, 100, 400):
+        repeat = 200000 // count
+        names = ['command%04d' % (i,) for i in range(count)]
+        # the last command is the worst case for the chain
+        message = names[-1] + ' some arguments'
+        for label, make in (('re.match chain', make_chain),
+                            ('CommandRouter', make_router)):
+            parser = make(names)
+            start = time.perf_counter()
+            for i in range(repeat):
+                parser(message)
+            elapsed = time.perf_counter() - start
+            print("%-15s %5d commands %8.2f usec/message"
+                  % (label, count, elapsed / repeat * 1e6))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
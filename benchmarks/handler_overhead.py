@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Time the per stanza overhead of the message and presence handlers
+
+The parser and client do nothing, so what's left is the bot's own
+bookkeeping: parsing addresses, looking at its jid, checking
+authorization and building the reply.
+"""
+import logging
+import sys
+import time
+
+import xmpp
+
+from benderjab import bot
+from benderjab import util
+
+class NullClient(object):
+    def send(self, stanza):
+        pass
+
+def measure(func, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        func(i)
+    elapsed = time.perf_counter() - start
+    return elapsed / repeat * 1e6
+
+def main(args=None):
+    repeat = 100000
+    if args is not None and len(args) > 1:
+        repeat = int(args[1])
+
+    b = bot.BenderJab()
+    # like it would be after reading a config file
+    b.cfg['jid'] = 'bot@example.org'
+    b.log = logging.getLogger('benchmark')
+    b.cl = NullClient()
+    b.parser = lambda body, who: 'ok'
+    users = ['user%d@example.org/home' % (i,) for i in range(50)]
+    b.authorized_users = b._parse_user_list(" ".join(users))
+    messages = [xmpp.protocol.Message(b.jid, body='hi', typ='chat', frm=u)
+                for u in users]
+    presences = [xmpp.Presence(to=b.jid, frm=u) for u in users]
+
+    tests = [
+        ('toJID(str)', lambda i: util.toJID(users[i % 50])),
+        ('bot.jid', lambda i: b.jid),
+        ('send', lambda i: b.send(users[i % 50], 'hi')),
+        ('messageCB', lambda i: b.messageCB(b.cl, messages[i % 50])),
+        ('presenceCB', lambda i: b.presenceCB(b.cl, presences[i % 50])),
+    ]
+    for name, func in tests:
+        print("%-12s %7.2f usec/call" % (name, measure(func, repeat)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Compare mailing through MailSender with a connection per message
+
+Both deliver to the SMTPSink from the test suite, so run this from the
+top of the source tree.
+"""
+import smtplib
+import sys
+import time
+
+from benderjab.mail import MailSender
+from test.mock import SMTPSink
+
+def connection_per_message(sink, messages):
+    for sender, recipients, text in messages:
+        s = smtplib.SMTP(sink.host, sink.port)
+        s.sendmail(sender, recipients, text)
+        s.quit()
+
+def mail_sender(sink, messages):
+    mail = MailSender(sink.host, sink.port)
+    for sender, recipients, text in messages:
+        mail.send(sender, recipients, text)
+    mail.close()
+
+def main(args=None):
+    count = 1000
+    if args is not None and len(args) > 1:
+        count = int(args[1])
+
+    messages = [('bot@example.org', ['user%d@example.org' % (i,)],
+                 'Subject: test %d\r\n\r\nbuild %d finished\r\n' % (i, i))
+                for i in range(count)]
+    for name, run in (('SMTP per message', connection_per_message),
+                      ('MailSender', mail_sender)):
+        sink = SMTPSink()
+        start = time.perf_counter()
+        run(sink, messages)
+        elapsed = time.perf_counter() - start
+        print("%-18s %d messages in %.3f sec (%.0f msgs/sec, %d connections)"
+              % (name, len(sink.messages), elapsed, count / elapsed,
+                 sink.connections))
+        sink.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Compare the XML-RPC and JSON encodings for jabber:iq:rpc calls
+
+For each payload, time a round trip (marshal, serialize, parse the
+stanza like the receiving stream would, unmarshal) and report the size
+of the stanza on the wire.
+"""
+import sys
+import time
+
+import xmpp
+
+from benderjab import rpc
+
+def payloads(count):
+    return {
+        'numeric array': ([i * 0.5 for i in range(count)],),
+        'int array': (list(range(count)),),
+        'structs': ([{'id': i, 'name': 'row%d' % i, 'score': i / 7.0,
+                      'tags': ['a', 'b']} for i in range(count // 10)],),
+    }
+
+def round_trip(params, namespace):
+    marshaled = rpc.marshal(params, 'store', namespace=namespace)
+    wire = str(rpc.make_iq('bot@example.org', 'set', marshaled,
+                           namespace=namespace))
+    rpc.extract_params(xmpp.Iq(node=wire))
+    return len(wire.encode('utf-8'))
+
+def main(args=None):
+    count = 10000
+    repeat = 5
+    if args is not None and len(args) > 1:
+        count = int(args[1])
+
+    for name, params in sorted(payloads(count).items()):
+        print(name)
+        for label, namespace in (('xml-rpc', xmpp.NS_RPC),
+                                 ('json', rpc.NS_RPC_JSON)):
+            start = time.perf_counter()
+            for i in range(repeat):
+                size = round_trip(params, namespace)
+            elapsed = (time.perf_counter() - start) / repeat
+            print("  %-8s %9d bytes %8.1f ms/round trip" % (
+                label, size, elapsed * 1000))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
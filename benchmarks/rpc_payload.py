@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Compare the text and node based jabber:iq:rpc payload paths
+
+Each hop marshals a call, serializes the iq as it would go on the wire,
+parses it back like the receiving xmpp stream would, and unmarshals
+the parameters.
+"""
+import sys
+import time
+import xmlrpc.client
+
+import xmpp
+
+from benderjab import rpc
+
+def make_payload(count):
+    return ([i * 7 for i in range(count)],
+            [{'name': 'row%d' % i, 'value': i / 3.0, 'ok': i % 2 == 0}
+             for i in range(count // 10)],
+            'x' * count)
+
+def text_hop(params):
+    marshaled = xmlrpc.client.dumps(params, 'store')
+    wire = str(rpc.make_iq('bot@example.org', 'set', marshaled))
+    iq = xmpp.Iq(node=wire)
+    xmlrpc.client.loads(rpc.extract_iq(iq))
+    return len(wire)
+
+def node_hop(params):
+    wire = str(rpc.make_iq('bot@example.org', 'set',
+                           rpc.marshal_node(params, 'store')))
+    iq = xmpp.Iq(node=wire)
+    rpc.extract_params(iq)
+    return len(wire)
+
+def measure(hop, params, repeat):
+    size = 0
+    start = time.perf_counter()
+    for i in range(repeat):
+        size += hop(params)
+    elapsed = time.perf_counter() - start
+    return repeat / elapsed, size / elapsed
+
+def main(args=None):
+    count = 20000
+    repeat = 10
+    if args is not None and len(args) > 1:
+        count = int(args[1])
+
+    params = make_payload(count)
+    print("payload: %d bytes" % (node_hop(params),))
+    for name, hop in (('dumps/XML2Node/loads', text_hop),
+                      ('marshal_node/extract_params', node_hop)):
+        rate, throughput = measure(hop, params, repeat)
+        print("%-28s %8.2f msgs/sec %10.0f bytes/sec" % (name, rate, throughput))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Time answering a flood of presence subscription requests
+
+Feeds 10,000 subscribe presences through presenceCB, answering each
+as it arrives and then in batches, against a client that just counts
+the bytes it is asked to write.
+"""
+import logging
+import sys
+import time
+
+import xmpp
+
+from benderjab import bot
+
+class NullClient(object):
+    def __init__(self):
+        self.writes = 0
+        self.size = 0
+
+    def send(self, stanza):
+        self.writes += 1
+        self.size += len(str(stanza))
+
+def run(b, requests):
+    for presence in requests:
+        b.presenceCB(b.cl, presence)
+    # answer the batches without waiting for their timers
+    while b._subscriptions:
+        b._flush_subscriptions()
+
+def main(args=None):
+    count = 10000
+    if args is not None and len(args) > 1:
+        count = int(args[1])
+
+    requests = [xmpp.Presence(to='bot@example.org', typ='subscribe',
+                              frm='user%d@example.org/home' % (i,))
+                for i in range(count)]
+    modes = (
+        ('immediate', {}),
+        ('batched', {'subscription_batch': 0.5}),
+        ('throttled', {'subscription_batch': 0.5, 'greeting_rate': 10}),
+    )
+    for name, cfg in modes:
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        b.log = logging.getLogger('benchmark')
+        b.cfg.update(cfg)
+        b.cl = NullClient()
+        start = time.perf_counter()
+        run(b, requests)
+        elapsed = time.perf_counter() - start
+        print("%-10s %d requests in %.3f sec (%.0f requests/sec, "
+              "%d writes, %d bytes)" % (name, count, elapsed,
+                                        count / elapsed, b.cl.writes,
+                                        b.cl.size))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
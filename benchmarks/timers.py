@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Time scheduling, cancelling and running a large number of timers
+
+Compares the Scheduler heap with scanning a list of pending timers on
+every event loop step, like the old time_delay example did.
+"""
+import random
+import sys
+import time
+
+from benderjab.scheduler import Scheduler
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def run_heap(delays, steps):
+    clock = Clock()
+    s = Scheduler(clock)
+    handles = [s.call_later(d, lambda: None) for d in delays]
+    for handle in handles[::10]:
+        handle.cancel()
+    fired = 0
+    horizon = max(delays)
+    for i in range(steps):
+        clock.now = horizon * (i + 1) / steps
+        s.timeout(5)
+        for handle in s.pop_due():
+            handle.callback()
+            fired += 1
+    return fired
+
+def run_scan(delays, steps):
+    pending = [[d, False] for d in delays]
+    for entry in pending[::10]:
+        entry[1] = True
+    fired = 0
+    horizon = max(delays)
+    for i in range(steps):
+        now = horizon * (i + 1) / steps
+        due = [e for e in pending if e[0] <= now and not e[1]]
+        pending = [e for e in pending if e[0] > now]
+        fired += len(due)
+    return fired
+
+def main(args=None):
+    count = 100000
+    steps = 1000
+    if args is not None and len(args) > 1:
+        count = int(args[1])
+
+    random.seed(1)
+    delays = [random.uniform(0, 3600) for i in range(count)]
+    for name, run in (('heap scheduler', run_heap), ('list scan', run_scan)):
+        start = time.perf_counter()
+        fired = run(delays, steps)
+        elapsed = time.perf_counter() - start
+        print("%-16s %d timers, %d fired over %d steps in %.3f sec"
+              % (name, count, fired, steps, elapsed))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
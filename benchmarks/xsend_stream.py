@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Measure xsend streaming throughput
+
+With a profile name this sends to a real server. Without one, the
+connection is replaced by a socket pair so only the client side cost
+of building and writing stanzas is measured.
+
+usage: xsend_stream.py [count] [profile] [recipient]
+"""
+import socket
+import sys
+import threading
+import time
+
+from benderjab import xsend
+
+class SocketClient(object):
+    """Stand in for an authenticated xmpp.Client"""
+    def __init__(self):
+        self.sock, self.remote = socket.socketpair()
+        self.drain = threading.Thread(target=self._drain, daemon=True)
+        self.drain.start()
+
+    def _drain(self):
+        while self.remote.recv(65536):
+            pass
+
+    def isConnected(self):
+        return 'tcp'
+
+    def Process(self, timeout=0):
+        return '0'
+
+    def send(self, stanza):
+        self.sock.sendall(str(stanza).encode('utf-8'))
+
+    def disconnect(self):
+        self.sock.close()
+
+def main(args=None):
+    count = 10000
+    profile = None
+    recipient = 'user@example.org'
+    if args is not None and len(args) > 1:
+        count = int(args[1])
+    if args is not None and len(args) > 2:
+        profile = args[2]
+    if args is not None and len(args) > 3:
+        recipient = args[3]
+    if profile is None:
+        xsend.connect = lambda profile=None: SocketClient()
+
+    messages = [(recipient, 'alert %d: disk almost full' % (i,))
+                for i in range(count)]
+    start = time.perf_counter()
+    delivered, failed = xsend.send_many(messages, profile)
+    elapsed = time.perf_counter() - start
+    xsend.close_clients()
+    print("delivered %d, failed %d in %0.3f seconds (%0.0f msgs/sec)" % (
+        delivered, failed, elapsed, delivered / elapsed))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,79 @@
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Decide who is allowed to talk to a bot
+"""
+from collections import OrderedDict
+import threading
+
+import xmpp
+
+def _bare(jid):
+    """
+    Return the lower case node@domain of a JID or jid string
+    """
+    if isinstance(jid, xmpp.JID):
+        node, domain = jid.getNode(), jid.getDomain()
+    else:
+        jid = str(jid).split('/', 1)[0]
+        if '@' in jid:
+            node, domain = jid.split('@', 1)
+        else:
+            node, domain = '', jid
+    return (node or '').lower(), domain.lower()
+
+class AuthorizationList(object):
+    """
+    Set of jabber IDs authorized to use a bot
+
+    Entries match on their bare JID, so any resource is accepted, and
+    an entry of *@domain accepts any user at that domain (but not the
+    domain itself). Lookups are hashed, and the last cache_size
+    decisions are remembered so busy senders skip even that.
+
+    Iterating gives back the entries the list was built from.
+    """
+    def __init__(self, users=(), cache_size=1024):
+        self.users = list(users)
+        self.cache_size = cache_size
+        self._bare = set()
+        self._domains = set()
+        for user in self.users:
+            node, domain = _bare(user)
+            if node == '*':
+                self._domains.add(domain)
+            else:
+                self._bare.add((node, domain))
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, who):
+        return self.check(who)
+
+    def check(self, who):
+        """
+        Return True if who is on the list
+        """
+        key = who if isinstance(who, str) else str(who)
+        with self._lock:
+            allowed = self._cache.get(key)
+            if allowed is not None:
+                self._cache.move_to_end(key)
+                return allowed
+
+        node, domain = _bare(who)
+        allowed = (node, domain) in self._bare or \
+                  (bool(node) and domain in self._domains)
+
+        with self._lock:
+            self._cache[key] = allowed
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return allowed
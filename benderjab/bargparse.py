@@ -3,13 +3,20 @@
 The default argparse expects to be running in a terminal
 like environment. so expects to be able to write to a stream
 instead of returning values.
+
+Since a bot parses every message it gets, help and usage text and the
+defaults for a new namespace are computed once and reused until the
+parser changes.
 """
 
 from argparse import ArgumentParser, Action, HelpFormatter, \
      Namespace, ArgumentError, \
-     SUPPRESS, _UNRECOGNIZED_ARGS_ATTR
+     SUPPRESS, _UNRECOGNIZED_ARGS_ATTR, _SubParsersAction
+import shlex
 from benderjab.exceptions import *
 
+SUBPARSER = 'subparser'
+
 class BotArgumentParser(ArgumentParser):
     def __init__(self,
                  prog=None,
@@ -24,12 +31,13 @@ class BotArgumentParser(ArgumentParser):
                  argument_default=None,
                  conflict_handler='error',
                  add_help=True):
+        if prog is None:
+            prog = 'BotCommands'
         super(BotArgumentParser, self).__init__(
-            prog='BotCommands',
+            prog=prog,
             usage=usage,
             description=description,
             epilog=epilog,
-            version=version,
             parents=parents,
             formatter_class=formatter_class,
             prefix_chars=prefix_chars,
@@ -37,8 +45,107 @@ class BotArgumentParser(ArgumentParser):
             argument_default=None,
             conflict_handler=conflict_handler,
             add_help=add_help)
+        # python 3's argparse dropped the version argument
+        if version is not None:
+            self.add_argument('--version', action='version', version=version)
 
         #self.register('action', 'help', BotHelpAction)
+        self._commands = None
+        self._format_cache = {}
+        self._defaults_template = None
+
+    def _cache_key(self):
+        """
+        Something that changes whenever our help text might
+
+        Every action added through us or one of our groups lands in
+        _actions, and new subcommands show up in their choices.
+        """
+        subcommands = tuple(len(action.choices) for action in self._actions
+                            if isinstance(action, _SubParsersAction))
+        return (len(self._actions), subcommands, self.prog, self.usage,
+                self.description, self.epilog)
+
+    def _cached_format(self, name, format):
+        key = self._cache_key()
+        cached = self._format_cache.get(name)
+        if cached is None or cached[0] != key:
+            cached = (key, format())
+            self._format_cache[name] = cached
+        return cached[1]
+
+    def format_usage(self):
+        return self._cached_format(
+            'usage', super(BotArgumentParser, self).format_usage)
+
+    def format_help(self):
+        return self._cached_format(
+            'help', super(BotArgumentParser, self).format_help)
+
+    def set_defaults(self, **kwargs):
+        super(BotArgumentParser, self).set_defaults(**kwargs)
+        self._defaults_template = None
+
+    def _get_defaults_template(self):
+        """
+        Return (key, defaults) for the values a new namespace starts with
+        """
+        key = len(self._actions)
+        template = self._defaults_template
+        if template is None or template[0] != key:
+            defaults = {}
+            for action in self._actions:
+                if action.dest is not SUPPRESS and \
+                   action.default is not SUPPRESS:
+                    defaults.setdefault(action.dest, action.default)
+            for dest in self._defaults:
+                defaults.setdefault(dest, self._defaults[dest])
+            template = self._defaults_template = (key, defaults)
+        return template
+
+    def command(self, name, **kwargs):
+        """
+        Decorator adding a subcommand name that calls func(args)
+
+        kwargs are passed on to add_parser, and the new parser is
+        stored as func.subparser so argument can find it.
+        """
+        def wrapper(func):
+            if not hasattr(func, SUBPARSER):
+                if self._commands is None:
+                    self._commands = self.add_subparsers()
+                func.subparser = self._commands.add_parser(name, **kwargs)
+                func.subparser.prog = name
+                func.subparser.set_defaults(func=func)
+            return func
+        return wrapper
+
+    def argument(self, *args, **kwargs):
+        """
+        Decorator adding an argument to a function's command
+        """
+        def wrapper(func):
+            if not hasattr(func, SUBPARSER):
+                raise RuntimeError("Please use command first")
+            func.subparser.add_argument(*args, **kwargs)
+            return func
+        return wrapper
+
+    def dispatch(self, message, **attrs):
+        """
+        Parse message as a command line and call its command
+
+        attrs are added to the parsed arguments before the command
+        function gets them. Usage problems raise BenderJabBaseErrors,
+        which BenderJab sends back as the reply.
+        """
+        args = self.parse_args(shlex.split(message))
+        for name, value in attrs.items():
+            setattr(args, name, value)
+        func = getattr(args, 'func', None)
+        if func is None:
+            return self.format_usage()
+        return func(args)
 
     def print_usage(self, file=None):
         raise BotUsageException( self.format_usage() )
@@ -56,22 +163,17 @@ class BotArgumentParser(ArgumentParser):
 
     def parse_known_args(self, args=None, namespace=None):
         if args is None:
-            raise BotUsageExceptions("No commands to process")
+            raise BotUsageException("No commands to process")
         else:
             args = list(args)
 
+        key, defaults = self._get_defaults_template()
         if namespace is None:
-            namespace = Namespace()
-
-        for action in self._actions:
-            if action.dest is not SUPPRESS:
-                if not hasattr(namespace, action.dest):
-                    if action.default is not SUPPRESS:
-                        setattr(namespace, action.dest, action.default)
-
-        for dest in self._defaults:
-            if not hasattr(namespace, dest):
-                setattr(namespace, dest, self._defaults[dest])
+            namespace = Namespace(**defaults)
+        else:
+            for dest, value in defaults.items():
+                if not hasattr(namespace, dest):
+                    setattr(namespace, dest, value)
 
         try:
             namespace, args = self._parse_known_args(args, namespace)
@@ -93,7 +195,7 @@ class BotHelpAction(Action):
             option_strings=option_strings,
             dest=dest,
             default=default,
-            neargs=0,
+            nargs=0,
             help=help)
 
     def __call__(self, parser, namespace, values, option_string=None):
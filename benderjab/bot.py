@@ -3,19 +3,26 @@
 # Copyright 2007 Diane Trout
 # This software is covered by the GNU Lesser Public License 2.1
 #
+import asyncio
+from collections import OrderedDict, deque
 import subprocess
 import errno
+import functools
 from email.mime.text import MIMEText
-import smtplib
 from getpass import getpass
 import logging
 from logging import FileHandler
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueListener, TimedRotatingFileHandler
 from optparse import OptionParser
+import inspect
 import os
-import re
+import queue
+import random
+import select
 import signal
+import socket
 import sys
+import threading
 import time
 import traceback
 import types
@@ -24,11 +31,37 @@ import xmpp
 
 from benderjab import util
 from benderjab import daemon
+from benderjab.auth import AuthorizationList
+from benderjab import commands
+from benderjab.delayed import DelayedMessageStore
+from benderjab.logs import JSONFormatter, RecordQueueHandler
+from benderjab.mail import MailSender
+from benderjab.outbound import OutboundQueue, TokenBucket
+from benderjab.presence import PresenceManager
+from benderjab import roster
+from benderjab.scheduler import Scheduler
+from benderjab.sessions import SessionStore
+from benderjab.workers import OrderedWorkerPool
 from benderjab.exceptions import BenderJabBaseError
 
 MAILTO_PROTO = 'mailto:'
 JABBER_PROTO = 'jabber:'
 
+def _address_template(stanza):
+    """
+    Serialize stanza once, returning a function that fills in its to
+    """
+    template = str(stanza)
+    # the start tag ends at the first >, any in attributes are escaped
+    split = template.index('>')
+    if template[split-1] == '/':
+        split -= 1
+    head = template[:split] + ' to="'
+    tail = '"' + template[split:]
+    def address(jid):
+        return head + xmpp.simplexml.XMLescape(str(jid)) + tail
+    return address
+
 class JIDMissingResource(RuntimeError):
     """
     XML RPC calls need the full jabber ID + resource to work
@@ -40,6 +73,17 @@ class BenderJab(object):
   """Base class for a simple jabber bot
 
   self.eventTasks - list of things to do after an event timeout
+  self.commands - commands the default parser knows about, add to it
+                  with the command decorator
+  self.sessions - per user dictionaries, self.sessions[who]
+  self.roster - our contacts, filled in as the server tells us about them
+  self.presence - publish our presence with self.presence.publish(),
+                  and see who is online with self.presence.online()
+  self.scheduler - timers set with call_later, call_at and call_every
+
+  Parsers and event tasks may be coroutine functions, their
+  coroutines are scheduled on the event loop when running under
+  run_async, or run to completion when using the blocking run.
   """
   # override to change default config file
   configfile = "~/.benderjab"
@@ -50,27 +94,128 @@ class BenderJab(object):
     self.section = section
     if configfile is not None:
         self.configfile = configfile
+    self._config_source = (section, self.configfile)
 
     # set defaults
     self.cfg = {}
+    self._jid_cache = None
     self.cfg['jid'] = None
     self.cfg['password'] = None
     self.cfg['resource'] = "BenderJab"
     # number of seconds to wait in each poll step
     self.cfg['timeout'] = 5
+    # which event loop start() should use, 'poll' or 'asyncio'
+    self.cfg['eventloop'] = 'poll'
     self.cfg['pid'] = "/tmp/%(jid)s.%(resource)s.pid"
     self.cfg['log'] = "/tmp/%(jid)s.%(resource)s.log"
     self.cfg['loglevel'] = "WARNING"
+    # 'queue' writes log records from a background thread so stanza
+    # handling never waits on the disk, 'direct' writes them in place
+    self.cfg['log_mode'] = 'queue'
+    # 'text' or 'json', one object per line
+    self.cfg['log_format'] = 'text'
     self.cfg['smtpserver'] = 'localhost'
     self.cfg['smtpport'] = 25
+    # seconds to wait on the smtp server before giving up on a message
+    self.cfg['smtp_timeout'] = 60
+    # number of threads to run parsers on, 0 runs them inline
+    self.cfg['workers'] = 0
+    # how many messages may wait for a worker, defaults to 4 per worker
+    self.cfg['worker_queue'] = None
+    # sqlite file for send_later/send_at, None keeps them in memory
+    self.cfg['delayed_store'] = None
+    # how many send_later messages to commit at once, anything over 1
+    # is faster but loses up to a second of them if the bot crashes
+    self.cfg['delayed_commit_size'] = 1
+    # outgoing messages per second, overall and to any one jid.
+    # leaving both as None sends messages right away.
+    self.cfg['send_rate'] = None
+    self.cfg['send_burst'] = None
+    self.cfg['send_rate_per_jid'] = None
+    self.cfg['send_burst_per_jid'] = None
+    # how many messages may wait to be sent before we start dropping them
+    self.cfg['send_queue'] = 10000
+    # XEP-0033 multicast service for broadcast, see discover_multicast
+    self.cfg['multicast'] = None
+    # how many recipients to put in one multicast stanza
+    self.cfg['multicast_limit'] = 50
+    # how many per user sessions to keep in memory, how long (seconds)
+    # an unused one lasts, an optional cap on their (pickled) size in
+    # bytes, and an optional dbm file to keep evicted sessions in
+    self.cfg['sessions'] = 1000
+    self.cfg['session_ttl'] = None
+    self.cfg['session_memory'] = None
+    self.cfg['session_store'] = None
+    # seconds to wait before the first reconnect attempt, doubling
+    # after each failure up to reconnect_max_delay
+    self.cfg['reconnect_delay'] = 1
+    self.cfg['reconnect_max_delay'] = 300
+    # how many messages to hold while reconnecting
+    self.cfg['offline_queue'] = 1000
+    # when to fetch our roster: 'eager' asks for it while logging on
+    # without waiting for the answer, 'lazy' the first time self.roster
+    # is used, and 'none' never.
+    self.cfg['roster'] = 'eager'
+    # sqlite file to keep the roster in between runs, so the server
+    # only has to send what changed
+    self.cfg['roster_cache'] = None
+    # who may subscribe to our presence: 'all', or 'authorized' to
+    # turn away anyone not in authorized_users
+    self.cfg['subscriptions'] = 'all'
+    # seconds to collect subscription requests before answering them
+    # together, 0 answers each one as it arrives. at most
+    # subscription_batch_size are answered per batch.
+    self.cfg['subscription_batch'] = 0
+    self.cfg['subscription_batch_size'] = 500
+    # hi/bye messages to (un)subscribers per second, None for no limit.
+    # greetings over the limit are skipped.
+    self.cfg['greeting_rate'] = None
+    self.cfg['greeting_burst'] = None
+    # seconds to wait after sending our presence before sending a
+    # change, later changes replace any still waiting
+    self.cfg['presence_debounce'] = 0
 
     # set defaults for things that can't be set from a config file
-    self.authorized_users = None
+    self._authorized_users = None
     self.cl = None
     self.parser = self._parser
+    self.commands = commands.CommandRouter()
+    self.commands.add_methods(self)
     self.eventTasks = []
+    self.scheduler = Scheduler()
 
     self.log = None
+    self._log_handlers = []
+    self._log_listener = None
+    # asyncio state, only set while run_async is active
+    self._loop = None
+    self._wakeup = None
+    self._watched = None
+    self._tasks = set()
+    # socketpair other threads write to to wake up run, and its thread
+    self._poll_wakeup = None
+    self._poll_thread = None
+    self._workers = None
+    self._send_lock = threading.RLock()
+    self._delayed = None
+    self._delayed_timer = None
+    self._delayed_lock = threading.Lock()
+    # ids of delayed messages waiting in the send queue
+    self._delayed_queued = set()
+    self._outbound = None
+    self._mail = None
+    self._drain_timer = None
+    self._sessions = None
+    self._reconnecting = False
+    self._reconnect_attempts = 0
+    self._offline = deque()
+    self._connected_client = None
+    self._roster = None
+    self._roster_requested = False
+    self._subscriptions = OrderedDict()
+    self._subscription_timer = None
+    self._greetings = None
+    self._presence = None
 
   def configure_logging(self, have_console=False):
       """
@@ -81,7 +226,7 @@ class BenderJab(object):
       if levelname is None:
           loglevel = logging.DEBUG
       else:
-          levename = levelname.upper()
+          levelname = levelname.upper()
           if levelname == 'DEBUG':
               loglevel = logging.DEBUG
           elif levelname == 'INFO':
@@ -99,26 +244,54 @@ class BenderJab(object):
 
       self.loglevel = loglevel
 
-      log_format = '%(asctime)s %(name)-6s %(levelname)-8s %(message)s'
-      formatter = logging.Formatter(log_format)
+      if self.cfg['log_format'] == 'json':
+          formatter = JSONFormatter()
+      else:
+          log_format = '%(asctime)s %(name)-6s %(levelname)-8s %(message)s'
+          formatter = logging.Formatter(log_format)
 
       if not self.jid:
           raise RuntimeError("Please configure a JID before starting logging")
+      # don't double up on handlers if we're configured again
+      self._stop_logging()
       self.log = logging.getLogger(self.jid.getStripped())
       self.log.setLevel(self.loglevel)
 
+      handlers = []
       if have_console:
-          console = logging.StreamHandler()
-          console.setFormatter(formatter)
-          self.log.addHandler(console)
+          handlers.append(logging.StreamHandler())
 
       if self.log_filename is not None:
-          logfile = TimedRotatingFileHandler(
-              self.log_filename,'midnight',1,14)
-          logfile.setFormatter(formatter)
-          self.log.addHandler(logfile)
+          handlers.append(TimedRotatingFileHandler(
+              self.log_filename,'midnight',1,14))
+
+      for handler in handlers:
+          handler.setFormatter(formatter)
+      self._log_handlers = list(handlers)
+      if self.cfg['log_mode'] == 'queue' and handlers:
+          records = queue.SimpleQueue()
+          self._log_listener = QueueListener(records, *handlers)
+          self._log_listener.start()
+          handlers = [RecordQueueHandler(records)]
+          self._log_handlers.extend(handlers)
+
+      for handler in handlers:
+          self.log.addHandler(handler)
+
+      self.log.info("Debug level set to: %s (%d)", levelname, loglevel)
 
-      self.log.info("Debug level set to: %s (%d)" % (levelname, loglevel))
+  def _stop_logging(self):
+      """
+      Write out queued log records and close our handlers
+      """
+      if self._log_listener is not None:
+          self._log_listener.stop()
+          self._log_listener = None
+      for handler in self._log_handlers:
+          if self.log is not None:
+              self.log.removeHandler(handler)
+          handler.close()
+      self._log_handlers = []
 
   def _parse_user_list(self, user_list, require_resource=False):
     """
@@ -141,7 +314,7 @@ class BenderJab(object):
     return parsed_list
 
   def _parse_address(self, address):
-      if type(address) in str:
+      if isinstance(address, str):
           if address.startswith(MAILTO_PROTO):
               return MAILTO_PROTO, address[len(MAILTO_PROTO):]
           elif address.startswith(JABBER_PROTO):
@@ -151,21 +324,48 @@ class BenderJab(object):
       elif isinstance(address, xmpp.JID):
           return JABBER_PROTO, address
       else:
-          self.log.error("Unrecognized address %s" % (str(address)))
+          self.log.error("Unrecognized address %s", address)
           return None, None
 
 
+  def _get_authorized_users(self):
+      return self._authorized_users
+  def _set_authorized_users(self, users):
+      if users is not None and not isinstance(users, AuthorizationList):
+          users = AuthorizationList(users)
+      self._authorized_users = users
+  authorized_users = property(_get_authorized_users, _set_authorized_users,
+                              doc="who may talk to us, None allows everyone")
+
   def check_authorization(self, who):
     """
     Check our sender against the allowed list of users
     """
-    if self.authorized_users is None:
+    # grab it once in case reload_authorization swaps it out
+    authorized_users = self._authorized_users
+    if authorized_users is None:
         return True
+    return authorized_users.check(who)
 
-    for user in self.authorized_users:
-      if who.bareMatch(user):
-        return True
-    return False
+  def reload_authorization(self):
+      """
+      Reread authorized_users from our config file
+
+      Called when we get a SIGHUP.
+      """
+      section, configfile = self._config_source
+      if hasattr(configfile, 'seek'):
+          configfile.seek(0)
+      cfg = util.get_config(section, configfile)
+      if cfg is None:
+          return
+      self.cfg['authorized_users'] = cfg.get('authorized_users', None)
+      self.authorized_users = self._parse_user_list(self.cfg['authorized_users'])
+      if self.log is not None:
+          count = 'everyone'
+          if self.authorized_users is not None:
+              count = str(len(self.authorized_users))
+          self.log.info("Reloaded authorized users: %s", count)
 
   def _check_required_option(self, name):
     """
@@ -186,6 +386,7 @@ class BenderJab(object):
           section = self.section
       if configfile is None:
           configfile = self.configfile
+      self._config_source = (section, configfile)
 
       self.cfg.update(util.get_config(section, configfile))
 
@@ -242,9 +443,114 @@ class BenderJab(object):
       return self.cfg['log'] % (self._get_cfg_subset())
   log_filename = property(_get_log_filename, doc="name of file to store our log in")
 
+  def _get_sessions(self):
+      if self._sessions is None:
+          ttl = self._get_float_cfg('session_ttl')
+          max_bytes = self.cfg['session_memory']
+          if max_bytes is not None:
+              max_bytes = int(max_bytes)
+          self._sessions = SessionStore(int(self.cfg['sessions']), ttl,
+                                        max_bytes, self.cfg['session_store'])
+          if ttl:
+              self.call_every(ttl, self._sessions.prune)
+      return self._sessions
+  sessions = property(_get_sessions, doc="per user session dictionaries")
+
+  def _close_sessions(self):
+      if self._sessions is not None:
+          self._sessions.close()
+          self._sessions = None
+
+  def _get_roster(self):
+      if self.cfg['roster'] == 'lazy' and self.cl is not None:
+          self.request_roster()
+      return self._roster_cache()
+  roster = property(_get_roster, doc="our roster as a RosterCache")
+
+  def _close_roster(self):
+      if self._roster is not None:
+          self._roster.close()
+          self._roster = None
+
+  def request_roster(self):
+      """
+      Ask the server for our roster without waiting for the answer
+
+      If the server supports roster versioning we send the version we
+      have so it only needs to send what has changed since.
+      """
+      if self._roster_requested:
+          return
+      self._roster_requested = True
+      iq = xmpp.Iq('get', xmpp.NS_ROSTER)
+      if self._roster_versioning():
+          iq.getTag('query').setAttr('ver', self._roster_cache().version or '')
+      with self._send_lock:
+          self.cl.SendAndCallForResponse(iq, self._roster_result)
+
+  def _roster_cache(self):
+      # self.roster without triggering a lazy request
+      if self._roster is None:
+          self._roster = roster.RosterCache(self.cfg['roster_cache'] or ':memory:')
+      return self._roster
+
+  def _roster_versioning(self):
+      stream = getattr(getattr(self.cl, 'Dispatcher', None), 'Stream', None)
+      features = getattr(stream, 'features', None)
+      return features is not None and \
+             features.getTag('ver', namespace=roster.NS_ROSTER_VER) is not None
+
+  def _roster_result(self, conn, iq):
+      if not xmpp.isResultNode(iq):
+          self._roster_requested = False
+          self.log.error("Couldn't get roster: %s", iq.getError())
+          return
+      query = iq.getTag('query')
+      if query is None:
+          # our cached roster is already current
+          self.log.debug("Roster version unchanged")
+          return
+      count = self._roster_cache().apply(query, replace=True)
+      self.log.info("Received roster with %d items", count)
+
+  def roster_push_handler(self, conn, iq):
+      """
+      Apply a roster push from the server to self.roster
+      """
+      frm = iq.getFrom()
+      if frm is not None and frm.getStripped() != self.jid.getStripped():
+          self.log.warning("Ignoring roster push from %s", frm)
+          raise xmpp.NodeProcessed
+      query = iq.getTag('query')
+      if query is not None:
+          self._roster_cache().apply(query)
+      self._write(iq.buildReply('result'), conn)
+      raise xmpp.NodeProcessed
+
+  def _get_presence(self):
+      if self._presence is None:
+          self._presence = PresenceManager(
+              self._send_presence, self._get_float_cfg('presence_debounce'),
+              self.call_later)
+      return self._presence
+  presence = property(_get_presence, doc="our presence and our contacts'")
+
+  def _send_presence(self, stanza):
+      if self.cl is None or self._reconnecting:
+          # we'll announce ourselves once we're connected
+          return False
+      self._write(stanza)
+      return True
+
   def _get_jid(self):
-      if self.cfg['jid']:
-          return util.toJID(self.cfg['jid'])
+      jid = self.cfg['jid']
+      if not jid:
+          return None
+      # reuse the JID we parsed last time unless cfg['jid'] changed
+      cached = self._jid_cache
+      if cached is None or cached[0] is not jid:
+          cached = self._jid_cache = (jid, util.toJID(jid))
+      return cached[1]
   def _set_jid(self, jid):
       if self.cl is None:
           self.cfg['jid'] = util.toJID(jid)
@@ -264,8 +570,15 @@ class BenderJab(object):
   def on_sigterm(self, signalnum, frame):
       raise KeyboardInterrupt("SIGTERM")
 
+  def on_sighup(self, signalnum, frame):
+      try:
+          self.reload_authorization()
+      except Exception as e:
+          self.log.error("Couldn't reload authorized users %s", e)
+
   def register_signal_handlers(self):
       signal.signal(signal.SIGTERM, self.on_sigterm)
+      signal.signal(signal.SIGHUP, self.on_sighup)
 
   def main(self, args=None):
       """
@@ -311,7 +624,10 @@ class BenderJab(object):
           daemon.writePidFile(self.pid_filename)
           self.log.critical("starting up")
           try:
-              self.run()
+              if self.cfg['eventloop'] == 'asyncio':
+                  asyncio.run(self.run_async())
+              else:
+                  self.run()
           except (KeyboardInterrupt, SystemExit):
               pass
           #except Exception, e:
@@ -319,8 +635,14 @@ class BenderJab(object):
           #    print errmsg
 
           # indicate shutting down
-          self.log.warn("shutting down. (%d)" % (os.getpid()))
+          self.log.warning("shutting down. (%d)", os.getpid())
+          self._shutdown_workers()
+          self._close_delayed_store()
+          self._close_mail_sender()
+          self._close_sessions()
+          self._close_roster()
           daemon.removePidFile(self.pid_filename)
+          self._stop_logging()
           logging.shutdown()
 
   def stop(self):
@@ -341,7 +663,7 @@ class BenderJab(object):
           msg %= (self.pid_filename,)
           print(msg, file=sys.stderr)
           if self.log is not None:
-              self.log.info(msg % (self.pid_filename))
+              self.log.info(msg)
 
 
   def restart(self, daemonize):
@@ -363,55 +685,525 @@ class BenderJab(object):
     if self.cfg['password'] is None:
         raise ValueError("please set a password before logging in")
 
-    jid = util.toJID(self.cfg['jid'])
-    self.cl = xmpp.Client(jid.getDomain(), debug=[])
-    # if you have dnspython installed and use_srv is True
-    # the dns service discovery lookup seems to fail.
-    self.cl.connect(use_srv=False)
-
-    auth_state = self.cl.auth(jid.getNode(), self.cfg['password'], self.cfg['resource'])
-    if auth_state is None:
-      # auth failed
-      self.log.error("couldn't authenticate with"+str(self.jid))
-      # probably want a better exception here
-      raise RuntimeError(self.cl.lastErr)
+    # _reconnect_async may have connected for us on another thread
+    cl, self._connected_client = self._connected_client, None
+    if cl is None:
+        cl = self._connect_client()
+    self.cl = cl
 
     # tell the xmpp client that we're ready to handle things
     self.cl.RegisterHandler('message', self.messageCB)
     self.cl.RegisterHandler('presence', self.presenceCB)
-
-    # announce our existence to the server
-    self.cl.getRoster()
-    self.cl.sendInitPresence()
+    self.cl.RegisterHandler('iq', self.roster_push_handler, typ='set',
+                            ns=xmpp.NS_ROSTER)
+
+    # ask for our roster, but don't wait around for it
+    self._roster_requested = False
+    if self.cfg['roster'] == 'eager':
+        self.request_roster()
+
+    # announce our existence to the server, _finish_reconnect does
+    # this if we're reconnecting
+    if not self._reconnecting:
+        self.presence.announce()
+    # send anything that came due while we were away
+    if self._get_delayed_store() is not None:
+        self._schedule_delayed(0)
     # not needed but lets me muck around with the client from interpreter
     return self.cl
 
-  def send(self, address, message):
+  def _connect_client(self):
+      """
+      Return a new connected and authenticated client
+
+      Doesn't touch self.cl, so it's safe to call from another thread.
+      """
+      jid = util.toJID(self.cfg['jid'])
+      cl = xmpp.Client(jid.getDomain(), debug=[])
+      # if you have dnspython installed and use_srv is True
+      # the dns service discovery lookup seems to fail.
+      if not cl.connect(use_srv=False):
+        raise RuntimeError("couldn't connect to " + jid.getDomain())
+
+      auth_state = cl.auth(jid.getNode(), self.cfg['password'], self.cfg['resource'])
+      if auth_state is None:
+        # auth failed
+        self.log.error("couldn't authenticate with %s", self.jid)
+        # probably want a better exception here
+        raise RuntimeError(cl.lastErr)
+      return cl
+
+  def send(self, address, message, on_sent=None):
       """
       Send a message to specified user
+
+      Returns False if the message was held while reconnecting or
+      dropped by a full send queue, instead of going out. on_sent() is
+      called once it has been written, which may be later if it's
+      waiting in the send queue.
       """
 
       address_type, address = self._parse_address(address)
       body = str(message)
 
       if address_type == JABBER_PROTO:
-          self.log.debug("IMing: <%s> %s" % (str(address),body))
-          self.cl.send(xmpp.protocol.Message(address,typ='chat',body=body))
+          self.log.debug("IMing: <%s> %s", address, body)
+          stanza = xmpp.protocol.Message(address,typ='chat',body=body)
+          return self._send_stanza(stanza, address, on_sent)
       elif address_type == MAILTO_PROTO:
           self._send_email(address, body)
       elif address_type is None:
           pass
+      if on_sent is not None:
+          on_sent()
+      return True
+
+  def broadcast(self, addresses, message, multicast=None):
+      """
+      Send the same message to every address in addresses
+
+      The message is serialized once and only the recipient changes for
+      each copy. mailto: addresses share one SMTP session. If multicast
+      (or cfg['multicast']) names a XEP-0033 service, jabber recipients
+      are sent to it in groups instead of one stanza apiece.
+      """
+      body = str(message)
+      jids = []
+      emails = []
+      for address in addresses:
+          address_type, address = self._parse_address(address)
+          if address_type == JABBER_PROTO:
+              jids.append(address)
+          elif address_type == MAILTO_PROTO:
+              emails.append(address)
+
+      self.log.debug("Broadcasting to %d jids, %d emails: %s",
+                     len(jids), len(emails), body)
+      if multicast is None:
+          multicast = self.cfg['multicast']
+      if jids:
+          if multicast:
+              self._multicast(multicast, jids, body)
+          else:
+              self._broadcast_jids(jids, body)
+      if emails:
+          self._send_emails(emails, body)
+      return len(jids) + len(emails)
+
+  def _broadcast_jids(self, jids, body, chunk=64):
+      """
+      Send body to each jid, filling in a serialized message template
+      """
+      address = _address_template(xmpp.protocol.Message(typ='chat', body=body))
+      self._write_stanzas([(address(jid), jid) for jid in jids], chunk)
+
+  def _write_stanzas(self, stanzas, chunk=64):
+      """
+      Send a list of (serialized stanza, address), chunk to a write
+      """
+      if self._reconnecting or self._get_outbound() is not None:
+          for stanza, address in stanzas:
+              self._send_stanza(stanza, address)
+          return
+      self._write_chunks([s for s, a in stanzas], chunk)
+
+  def _write_chunks(self, stanzas, chunk=64):
+      """
+      Write a list of serialized stanzas, chunk to a write
+      """
+      with self._send_lock:
+          for start in range(0, len(stanzas), chunk):
+              self.cl.send("".join(stanzas[start:start+chunk]))
+
+  def _multicast(self, service, jids, body):
+      """
+      Send body to jids through a XEP-0033 multicast service
+      """
+      limit = int(self.cfg['multicast_limit'])
+      for start in range(0, len(jids), limit):
+          msg = xmpp.protocol.Message(service, typ='chat', body=body)
+          addresses = msg.addChild('addresses', namespace=xmpp.NS_ADDRESS)
+          for jid in jids[start:start+limit]:
+              addresses.addChild('address', {'type': 'bcc', 'jid': str(jid)})
+          self._send_stanza(msg, service)
+
+  def discover_multicast(self):
+      """
+      Ask our server if it supports XEP-0033 multicast
+
+      If it does, broadcast will use it from now on. Returns the
+      multicast service or None.
+      """
+      domain = self.jid.getDomain()
+      identities, features = xmpp.features.discoverInfo(self.cl, domain)
+      if xmpp.NS_ADDRESS in features:
+          self.cfg['multicast'] = domain
+          return domain
+      return None
+
+  def _get_outbound(self):
+      """
+      Return the rate limited send queue, or None if we aren't limiting
+      """
+      if self._outbound is None:
+          rate = self._get_float_cfg('send_rate')
+          peer_rate = self._get_float_cfg('send_rate_per_jid')
+          if rate or peer_rate:
+              max_queue = self.cfg['send_queue']
+              if max_queue is not None:
+                  max_queue = int(max_queue)
+              self._outbound = OutboundQueue(
+                  self._write_outbound,
+                  rate, self._get_float_cfg('send_burst'),
+                  peer_rate, self._get_float_cfg('send_burst_per_jid'),
+                  max_queue)
+      return self._outbound
+
+  def _get_float_cfg(self, name):
+      value = self.cfg[name]
+      if value is None:
+          return None
+      return float(value)
+
+  def send_queue_stats(self):
+      """
+      Return metrics for the outgoing message queue, or None if unused
+      """
+      if self._outbound is None:
+          return None
+      return self._outbound.stats()
+
+  def _send_stanza(self, stanza, address, on_sent=None):
+      """
+      Send a stanza, or a serialized one, addressed to address
+
+      Stanzas are held while we're reconnecting, and go through the
+      rate limited queue if there is one. Returns False if the stanza
+      was held or dropped, otherwise on_sent() is called once it's
+      been written.
+      """
+      if self._reconnecting:
+          self._hold_offline(stanza, address)
+          return False
+      elif self._get_outbound() is not None:
+          return self._queue_stanza(stanza, address, on_sent)
+      else:
+          self._write(stanza)
+          if on_sent is not None:
+              on_sent()
+          return True
+
+  def _write(self, stanza, conn=None):
+      """
+      Write stanza to conn, our client by default, holding the send lock
+
+      Everything written to the server goes through here (or holds
+      _send_lock) so worker threads can't interleave their writes.
+      """
+      if conn is None:
+          conn = self.cl
+      with self._send_lock:
+          return conn.send(stanza)
+
+  def _queue_stanza(self, stanza, address, on_sent=None):
+      """
+      Add stanza to the send queue and make sure something will drain it
+      """
+      to = util.toJID(address).getStripped()
+      if not self._outbound.put(stanza, to, on_sent):
+          self.log.warning("Send queue full, dropped message to %s", to)
+          return False
+      self._schedule_drain()
+      return True
+
+  def _schedule_drain(self):
+      with self._send_lock:
+          if self._drain_timer is not None:
+              return
+          if self._on_loop_thread():
+              # write what the rate allows now instead of a step later
+              self._drain_outbound()
+          else:
+              self._drain_timer = self.call_later(0, self._drain_outbound)
+
+  def _on_loop_thread(self):
+      """
+      Return True if we're on the thread running run or run_async
+      """
+      if self._loop is not None:
+          try:
+              return asyncio.get_running_loop() is self._loop
+          except RuntimeError:
+              return False
+      return self._poll_thread is threading.current_thread()
+
+  def _drain_outbound(self):
+      with self._send_lock:
+          self._drain_timer = None
+          if self._reconnecting:
+              # _finish_reconnect will start us up again
+              return
+          wait = self._outbound.drain()
+          if wait is not None:
+              self._drain_timer = self.call_later(wait, self._drain_outbound)
+
+  def _write_outbound(self, data):
+      """
+      Put several serialized stanzas on the wire at once
+      """
+      self._write(data)
+
+  def _hold_offline(self, stanza, address):
+      """
+      Keep a stanza to send once we've reconnected
+      """
+      limit = int(self.cfg['offline_queue'])
+      with self._send_lock:
+          if len(self._offline) >= limit:
+              self._offline.popleft()
+              self.log.warning("Offline queue full, dropped oldest message")
+          self._offline.append((stanza, address))
+
+  def _flush_offline(self):
+      with self._send_lock:
+          held = self._offline
+          self._offline = deque()
+      if held:
+          self.log.info("Sending %d messages held while offline", len(held))
+      for stanza, address in held:
+          self._send_stanza(stanza, address)
+
+  def _connection_lost(self):
+      """
+      Start reconnecting in the background, holding messages until we do
+      """
+      if self._reconnecting:
+          return
+      self.log.warning("Lost connection to the server")
+      self._reconnecting = True
+      self._reconnect_attempts = 0
+      if self._loop is not None:
+          self._unwatch_connection()
+      self._close_client()
+      self._schedule_reconnect()
+
+  def _close_client(self):
+      """
+      Close our dead client's socket and forget it
+      """
+      cl, self.cl = self.cl, None
+      if cl is None:
+          return
+      try:
+          cl.disconnect()
+      except Exception:
+          # including the IOError xmpppy's DisconnectHandler raises
+          pass
+
+  def _reconnect_delay(self):
+      """
+      Exponential backoff with jitter, so bots don't all come back at once
+      """
+      delay = float(self.cfg['reconnect_delay']) * 2 ** self._reconnect_attempts
+      delay = min(delay, float(self.cfg['reconnect_max_delay']))
+      return random.uniform(delay / 2, delay)
+
+  def _schedule_reconnect(self):
+      delay = self._reconnect_delay()
+      self._reconnect_attempts += 1
+      self.log.info("Reconnecting in %.1f seconds", delay)
+      self.call_later(delay, self._reconnect)
+
+  def _reconnect(self):
+      if self._loop is not None:
+          # keep the event loop running while we connect & authenticate
+          self._spawn(self._reconnect_async())
+      else:
+          self._finish_reconnect(self._try_logon())
+
+  async def _reconnect_async(self):
+      # connecting blocks so it happens on another thread, but self.cl
+      # and its handlers are only set up from the event loop's
+      try:
+          cl = await self._loop.run_in_executor(None, self._connect_client)
+      except Exception as e:
+          self.log.warning("Reconnect failed: %s", e)
+          self._finish_reconnect(False)
+          return
+      self._connected_client = cl
+      self._finish_reconnect(self._try_logon())
+
+  def _try_logon(self):
+      try:
+          self.logon()
+          return True
+      except Exception as e:
+          self.log.warning("Reconnect failed: %s", e)
+          return False
+
+  def _finish_reconnect(self, connected):
+      if not connected:
+          self._schedule_reconnect()
+          return
+      self.log.info("Reconnected after %d attempts", self._reconnect_attempts)
+      self._reconnecting = False
+      self._reconnect_attempts = 0
+      self.presence.announce()
+      if self._loop is not None:
+          self._watch_connection()
+      self._flush_offline()
+      if self._outbound is not None and len(self._outbound):
+          self._schedule_drain()
+
+  def send_at(self, when, address, message):
+      """
+      Send message to address at time.time() when
+
+      If cfg['delayed_store'] names a file the message is saved there
+      and will still be sent if the bot is restarted, otherwise it is
+      just a timer.
+      """
+      store = self._get_delayed_store()
+      if store is None:
+          self.call_at(when, self.send, address, message)
+          return
+      if store.add(when, address, message):
+          self.call_later(1, store.flush)
+      self._schedule_delayed(when)
+
+  def send_later(self, delay, address, message):
+      """
+      Send message to address in delay seconds
+      """
+      self.send_at(time.time() + delay, address, message)
+
+  def _get_delayed_store(self):
+      if self._delayed is None and self.cfg['delayed_store']:
+          commit_size = int(self.cfg['delayed_commit_size'])
+          self._delayed = DelayedMessageStore(self.cfg['delayed_store'],
+                                              commit_size)
+      return self._delayed
+
+  def _close_delayed_store(self):
+      with self._delayed_lock:
+          if self._delayed_timer is not None:
+              self._delayed_timer.cancel()
+              self._delayed_timer = None
+      if self._delayed is not None:
+          self._delayed.close()
+          self._delayed = None
+
+  def _schedule_delayed(self, when):
+      """
+      Make sure we check the delayed store no later than when
+
+      Only one timer is kept for the whole store, for the earliest
+      message in it.
+      """
+      with self._delayed_lock:
+          timer = self._delayed_timer
+          if timer is not None and not timer.cancelled and \
+             timer.when <= self._scheduler_time(when):
+              return
+          if timer is not None:
+              timer.cancel()
+          self._delayed_timer = self.call_at(when, self._deliver_delayed)
+
+  def _deliver_delayed(self, limit=500):
+      """
+      Send up to limit stored messages that are due
+
+      If there are more than limit we come back on the next step rather
+      than stalling the event loop. Messages stay in the store until
+      they've actually been written, so with a send queue we wait for it
+      to write the last batch before reading more. While we're
+      reconnecting they wait for logon to check the store again.
+      """
+      store = self._delayed
+      if store is None:
+          return
+      if self._reconnecting:
+          with self._delayed_lock:
+              self._delayed_timer = None
+          return
+      now = time.time()
+      rows = []
+      retry = None
+      with self._delayed_lock:
+          queued = bool(self._delayed_queued)
+      if queued:
+          retry = now + float(self.cfg['timeout'])
+      else:
+          rows = store.get_due(now, limit)
+      for msgid, due, address, body in rows:
+          with self._delayed_lock:
+              self._delayed_queued.add(msgid)
+          try:
+              written = functools.partial(self._delayed_written, msgid)
+              if not self.send(address, body, written):
+                  raise RuntimeError("%s wasn't sent" % (address,))
+          except Exception as e:
+              with self._delayed_lock:
+                  self._delayed_queued.discard(msgid)
+              self.log.error("Couldn't send delayed message %s", e)
+              retry = now + float(self.cfg['timeout'])
+              break
+
+      with self._delayed_lock:
+          self._delayed_timer = None
+          if retry is not None:
+              when = retry
+          elif len(rows) == limit:
+              when = now
+          else:
+              when = store.next_due()
+          if when is not None:
+              self._delayed_timer = self.call_at(when, self._deliver_delayed)
+
+  def _delayed_written(self, msgid):
+      """
+      Forget a delayed message once it's been written to the server
+      """
+      with self._delayed_lock:
+          self._delayed_queued.discard(msgid)
+      store = self._delayed
+      if store is not None:
+          store.remove([msgid])
 
   def _send_email(self, address, body):
-      # email address
+      self._send_emails([address], body)
+
+  def _send_emails(self, addresses, body):
+      """
+      Queue body to be mailed to each address
+
+      The mail goes out from a background thread which reuses its
+      connection to cfg['smtpserver'], so several addresses share one
+      SMTP session.
+      """
+      mail = self._get_mail_sender()
       msg = MIMEText(body)
       msg['Subject'] = body
-      msg['From'] = self.jid
-      msg['To'] = address
-      self.log.debug("EMAILing: <%s> %s" % (str(address), msg.as_string()))
-      s = smtplib.SMTP('localhost',2525)
-      s.sendmail(self.jid, [address], msg.as_string())
-      s.quit()
+      msg['From'] = str(self.jid)
+      for address in addresses:
+          del msg['To']
+          msg['To'] = address
+          text = msg.as_string()
+          self.log.debug("EMAILing: <%s> %s", address, text)
+          mail.send(str(self.jid), [address], text)
+
+  def _get_mail_sender(self):
+      if self._mail is None:
+          self._mail = MailSender(self.cfg['smtpserver'],
+                                  int(self.cfg['smtpport']),
+                                  timeout=float(self.cfg['smtp_timeout']),
+                                  log=self.log)
+      return self._mail
+
+  def _close_mail_sender(self):
+      if self._mail is not None:
+          self._mail.close()
+          self._mail = None
 
   def messageCB(self, conn, msg):
     """Simple handling of messages
@@ -423,83 +1215,416 @@ class BenderJab(object):
         #self.log.debug(u"FROM: <%s>: sent empty packet" %(unicode(who)))
         return None
     elif self.check_authorization(who):
-        try:
-            self.log.debug("FROM: <%s> " % (str(who)) + str(body))
-            reply = self.parser(body, who)
-        except BenderJabBaseError as e:
-            reply = str(e)
-        except Exception as e:
-            reply = "Exception: " + str(e)
-            self.log.error("Exception in messageCB. "+str(e))
-            self.log.debug(traceback.format_exc())
+        self.log.debug("FROM: <%s> %s", who, body)
+        workers = self._get_workers()
+        if workers is not None:
+            workers.submit(str(who),
+                           lambda: self._worker_parse(body, who),
+                           lambda reply: self._send_from_worker(who, reply))
+            return None
+        reply = self._call_parser(body, who)
+        if inspect.isawaitable(reply):
+            self._spawn(self._send_awaited_reply(who, reply))
+            return None
     else:
         reply = "Authorization Error."
 
     self.send(who, reply)
 
+  def _call_parser(self, body, who):
+      """
+      Call our parser, turning exceptions into a reply
+      """
+      try:
+          return self.parser(body, who)
+      except Exception as e:
+          return self._format_exception(e)
+
+  def _format_exception(self, e):
+      """
+      Turn an exception raised by a parser into a reply message
+      """
+      if isinstance(e, BenderJabBaseError):
+          return str(e)
+      self.log.error("Exception in messageCB. %s", e)
+      self.log.debug(traceback.format_exc())
+      return "Exception: " + str(e)
+
+  async def _await_reply(self, reply):
+      """
+      Wait for a coroutine parser to finish
+      """
+      try:
+          return await reply
+      except Exception as e:
+          return self._format_exception(e)
+
+  async def _send_awaited_reply(self, who, reply):
+      self.send(who, await self._await_reply(reply))
+
+  def _get_workers(self):
+      """
+      Return the parser worker pool, or None if parsers run inline
+      """
+      if self._workers is None:
+          workers = int(self.cfg['workers'] or 0)
+          if workers > 0:
+              max_pending = self.cfg['worker_queue']
+              if max_pending is not None:
+                  max_pending = int(max_pending)
+              self._workers = OrderedWorkerPool(workers, max_pending,
+                                                self.log)
+      return self._workers
+
+  def _shutdown_workers(self):
+      if self._workers is not None:
+          self._workers.shutdown()
+          self._workers = None
+
+  def _worker_parse(self, body, who):
+      """
+      Run the parser on a worker thread
+      """
+      reply = self._call_parser(body, who)
+      if inspect.isawaitable(reply):
+          reply = asyncio.run(self._await_reply(reply))
+      return reply
+
+  def _send_from_worker(self, who, reply):
+      """
+      Send a reply computed on a worker thread
+      """
+      self.call_threadsafe(self.send, who, reply)
+
+  def call_threadsafe(self, func, *args):
+      """
+      Call func(*args) from a worker thread without racing our event loop
+
+      Under run_async func is handed to the event loop, otherwise it is
+      called right away while holding the lock send() uses.
+      """
+      if self._loop is not None:
+          self._loop.call_soon_threadsafe(func, *args)
+      else:
+          with self._send_lock:
+              func(*args)
+
   def _parser(self, message, who):
-    """Default parser function,
-    overide this or replace self.parser with a different function
-    to do something more useful
+    """Default parser function, looks up the command in self.commands
+
+    Add methods with the command decorator, register functions with
+    self.command, or overide this or replace self.parser with a
+    different function to do something more useful
     """
-    # some default commands
-    if re.match("help", message):
-      reply = "I'm sooo not helpful"
-    elif re.match("time", message):
-      reply = "Server time is "+time.asctime()
-    elif re.match("uptime", message):
-      reply = subprocess.getoutput("uptime")
-    elif re.match("Exception:", message):
-      self.log.warning("Received Exception: " + message)
-      reply = None
-    else:
-      reply = "I have no idea what \""+message+"\" means."
-    return reply
+    cmd, args = self.commands.lookup(message)
+    if cmd is None:
+      return "I have no idea what \""+message+"\" means."
+    if args is None:
+      return cmd.usage()
+    return self.commands.run(cmd, args, who)
+
+  def command(self, name, pattern=None, help=None, hidden=False):
+    """Decorator registering func(args, who) as the handler for name
+    """
+    def wrapper(func):
+      self.commands.add(name, func, pattern, help, hidden)
+      return func
+    return wrapper
+
+  # some default commands
+  @commands.command('help', help="list the commands I know")
+  def _help_command(self, args, who):
+    if args and args in self.commands:
+      return self.commands.commands[args.lower()].usage()
+    return "I know: " + ", ".join(self.commands)
+
+  @commands.command('time', help="what time is it here")
+  def _time_command(self, args, who):
+    return "Server time is "+time.asctime()
+
+  @commands.command('uptime', help="how long have I been up")
+  def _uptime_command(self, args, who):
+    return subprocess.getoutput("uptime")
+
+  # other bots' error replies, so we don't answer them
+  @commands.command('Exception:', hidden=True)
+  def _exception_command(self, args, who):
+    self.log.warning("Received Exception: %s", args)
+    return None
 
   def presenceCB(self, conn, msg):
     try:
       presence_type = msg.getType()
       who = msg.getFrom()
-      # This code provides for a fairly promiscous bot
-      # a more secure bot should check an auth list and accept deny
-      # based on the incoming who JID
-      sendChat = True
-      if self.jid.bareMatch(who):
-          self.log.info("Potential message loop: " + str(msg))
-          sendChat = False
-
-      if presence_type == "subscribe":
-        # Tell the server that we accept their subscription request
-        conn.send(xmpp.Presence(to=who, typ='subscribed'))
-        # Ask to be their contact too
-        conn.send(xmpp.Presence(to=who, typ='subscribe'))
-        # Be friendly
-        if sendChat:
-            conn.send(xmpp.Message(who, "hi " + who.getNode(), typ='chat'))
-        self.log.info("%s subscribed" % (who))
-      elif presence_type == "unsubscribe":
-        if sendChat:
-            conn.send(xmpp.Message(who, "bye " + who.getNode(), typ='chat'))
-        conn.send(xmpp.Presence(to=who, typ='unsubscribed'))
-        conn.send(xmpp.Presence(to=who, typ='unsubscribe'))
-        self.log.info("%s unsubscribed" % (who))
+      self.presence.update(msg)
+      # anyone may subscribe unless cfg['subscriptions'] is 'authorized'
+      if presence_type in ("subscribe", "unsubscribe"):
+        self.queue_subscription(who, presence_type)
     except Exception as e:
-      self.log.error("Exception in presenceCB " + str(e))
+      self.log.error("Exception in presenceCB %s", e)
       self.log.debug(traceback.format_exc())
 
+  def queue_subscription(self, who, request):
+      """
+      Answer a 'subscribe' or 'unsubscribe' request from who
+
+      If cfg['subscription_batch'] is set, requests are collected for
+      that many seconds and answered together, with a later request
+      from a jid replacing an earlier one.
+      """
+      delay = self._get_float_cfg('subscription_batch')
+      if not delay:
+          self._answer_subscriptions([(who, request)])
+          return
+      key = who.getStripped().lower()
+      with self._send_lock:
+          self._subscriptions.pop(key, None)
+          self._subscriptions[key] = (who, request)
+          if self._subscription_timer is None:
+              self._subscription_timer = self.call_later(
+                  delay, self._flush_subscriptions)
+
+  def _flush_subscriptions(self):
+      size = int(self.cfg['subscription_batch_size'])
+      batch = []
+      with self._send_lock:
+          self._subscription_timer = None
+          while self._subscriptions and len(batch) < size:
+              batch.append(self._subscriptions.popitem(last=False)[1])
+          if self._subscriptions:
+              self._subscription_timer = self.call_later(
+                  self._get_float_cfg('subscription_batch'),
+                  self._flush_subscriptions)
+      self._answer_subscriptions(batch, batched=True)
+
+  def _answer_subscriptions(self, requests, batched=False):
+      """
+      Reply to a list of (who, 'subscribe' or 'unsubscribe') requests
+
+      Subscribers are asked to let us subscribe back, and greeted if
+      cfg['greeting_rate'] allows. With cfg['subscriptions'] set to
+      'authorized', subscribe requests from anyone not in
+      authorized_users are refused. A batch is serialized from
+      templates and written several stanzas at a time.
+
+      The presence replies go straight to the server like
+      _send_presence, only greetings go through the send queues.
+      """
+      if batched:
+          templates = {}
+          for typ in ('subscribe', 'subscribed', 'unsubscribe', 'unsubscribed'):
+              templates[typ] = _address_template(xmpp.Presence(typ=typ))
+          def presence(typ, who):
+              return templates[typ](who)
+      else:
+          def presence(typ, who):
+              return xmpp.Presence(to=who, typ=typ)
+
+      me = self.jid.getStripped()
+      authorized_only = self.cfg['subscriptions'] == 'authorized'
+      replies = []
+      greetings = []
+      for who, request in requests:
+        # don't greet ourselves
+        sendChat = me != who.getStripped()
+        if not sendChat:
+            self.log.info("Potential message loop: %s from %s", request, who)
+
+        if request == "subscribe":
+          if authorized_only and not self.check_authorization(who):
+              replies.append((presence('unsubscribed', who), who))
+              self.log.info("%s refused subscription", who)
+              continue
+          # Tell the server that we accept their subscription request
+          replies.append((presence('subscribed', who), who))
+          # Ask to be their contact too
+          replies.append((presence('subscribe', who), who))
+          # Be friendly
+          if sendChat and self._may_greet():
+              greetings.append((self._greeting("hi ", who), who))
+          self.log.info("%s subscribed", who)
+        elif request == "unsubscribe":
+          if sendChat and self._may_greet():
+              greetings.append((self._greeting("bye ", who), who))
+          replies.append((presence('unsubscribed', who), who))
+          replies.append((presence('unsubscribe', who), who))
+          self.log.info("%s unsubscribed", who)
+
+      if batched:
+          if self.cl is not None and not self._reconnecting:
+              self._write_chunks([str(s) for s, a in replies])
+          self._write_stanzas([(str(s), a) for s, a in greetings])
+      else:
+          for stanza, who in replies:
+              self._send_presence(stanza)
+          for stanza, who in greetings:
+              self._send_stanza(stanza, who)
+
+  def _greeting(self, text, who):
+      return xmpp.Message(who, text + (who.getNode() or ''), typ='chat')
+
+  def _may_greet(self):
+      rate = self._get_float_cfg('greeting_rate')
+      if not rate:
+          return True
+      if self._greetings is None:
+          self._greetings = TokenBucket(rate,
+                                        self._get_float_cfg('greeting_burst'))
+      return self._greetings.take()
+
 
   def step(self, conn, timeout):
-    """single step through the event loop"""
+    """single step through the event loop
+
+    Waits at most timeout seconds for network activity, less if a
+    timer is due sooner. Under run, another thread setting a timer
+    wakes us up too.
+    """
     try:
-      state = conn.Process(timeout)
-      if state is None:
-        self.logon()
-      for f in self.eventTasks:
-        f(self)
+      if self._reconnecting:
+        # nothing to read, wait for a timer like the one reconnecting us
+        wait = self.scheduler.timeout(timeout)
+        if self._poll_wakeup is not None:
+          self._wait_for_data(wait)
+        elif wait:
+          time.sleep(wait)
+      else:
+        wait = self.scheduler.timeout(timeout)
+        if self._poll_wakeup is not None:
+          # wait here rather than in Process so other threads can wake us
+          self._wait_for_data(wait)
+          wait = 0
+        try:
+          state = conn.Process(wait)
+        except IOError:
+          state = None
+        # Process returns None or 0 when the connection dropped
+        if not state:
+          self._connection_lost()
+      self._run_timers()
+      self._run_event_tasks()
       return 1
     except KeyboardInterrupt:
       return 0
 
+  def call_at(self, when, callback, *args):
+      """
+      Call callback(*args) at time.time() when
+
+      when is converted to the scheduler's monotonic clock right away,
+      so changing the system clock afterwards doesn't move the call.
+      Returns a handle whose cancel() method stops the call.
+      """
+      handle = self.scheduler.call_at(self._scheduler_time(when),
+                                      callback, *args)
+      self._timers_changed()
+      return handle
+
+  def _scheduler_time(self, when):
+      """
+      Convert a time.time() value to the scheduler's clock
+      """
+      return self.scheduler.clock() + (when - time.time())
+
+  def call_later(self, delay, callback, *args):
+      """
+      Call callback(*args) in delay seconds
+
+      Returns a handle whose cancel() method stops the call.
+      """
+      handle = self.scheduler.call_later(delay, callback, *args)
+      self._timers_changed()
+      return handle
+
+  def call_every(self, interval, callback, *args):
+      """
+      Call callback(*args) every interval seconds
+
+      Returns a handle whose cancel() method stops the calls.
+      """
+      handle = self.scheduler.call_every(interval, callback, *args)
+      self._timers_changed()
+      return handle
+
+  def _timers_changed(self):
+      """
+      Make run or run_async recompute how long it can sleep
+      """
+      if self._loop is not None:
+          self._loop.call_soon_threadsafe(self._wakeup.set)
+          return
+      wakeup = self._poll_wakeup
+      if wakeup is not None and \
+         self._poll_thread is not threading.current_thread():
+          try:
+              wakeup[1].send(b'\0')
+          except OSError:
+              # already has a wakeup waiting, or run just finished
+              pass
+
+  def _wait_for_data(self, wait):
+      """
+      Wait up to wait seconds for data on our socket or a wakeup
+      """
+      if self._tls_pending():
+          return
+      readers = [self._poll_wakeup[0]]
+      if getattr(self.cl, 'Connection', None) is not None:
+          readers.append(self._get_socket())
+      readable = select.select(readers, [], [], wait)[0]
+      if self._poll_wakeup[0] in readable:
+          try:
+              self._poll_wakeup[0].recv(4096)
+          except OSError:
+              pass
+
+  def _run_timers(self):
+      """
+      Call everything in the scheduler that is due
+      """
+      for handle in self.scheduler.pop_due():
+          if handle.cancelled:
+              continue
+          try:
+              result = handle.callback(*handle.args)
+              if inspect.isawaitable(result):
+                  self._spawn(result)
+          except Exception as e:
+              self.log.error("Exception in timer %s", e)
+              self.log.debug(traceback.format_exc())
+
+  def _run_event_tasks(self):
+      """
+      Call everything in eventTasks, scheduling any coroutines they return
+      """
+      for f in self.eventTasks:
+          result = f(self)
+          if inspect.isawaitable(result):
+              self._spawn(result)
+
+  def _spawn(self, coroutine):
+      """
+      Run a coroutine returned by a parser or event task
+
+      Under run_async the coroutine becomes a task on our event loop,
+      otherwise we block until it finishes.
+      """
+      if self._loop is None:
+          return asyncio.run(coroutine)
+
+      task = self._loop.create_task(coroutine)
+      self._tasks.add(task)
+      task.add_done_callback(self._task_done)
+      return task
+
+  def _task_done(self, task):
+      self._tasks.discard(task)
+      if not task.cancelled() and task.exception() is not None:
+          e = task.exception()
+          self.log.error("Exception in task %s", e)
+          self.log.debug("".join(traceback.format_exception(
+              type(e), e, e.__traceback__)))
+
   def run(self, timeout=None):
     """
     Enter event loop
@@ -507,25 +1632,146 @@ class BenderJab(object):
     if self.cl is None:
         self.logon()
 
+    self._poll_wakeup = socket.socketpair()
+    for sock in self._poll_wakeup:
+        sock.setblocking(False)
+    self._poll_thread = threading.current_thread()
     try:
-        step_timeout = self.cfg['timeout']
+        step_timeout = float(self.cfg['timeout'])
         if timeout is None:
             while self.step(self.cl, step_timeout):
                 pass
         else:
-            tstart = time.time()
-            while self.step(self.cl, step_timeout) and timeout > 0:
-                tnow = time.time()
+            tstart = time.monotonic()
+            while self.step(self.cl, max(0, min(step_timeout, timeout))) \
+                  and timeout > 0:
+                tnow = time.monotonic()
                 timeout -= (tnow - tstart)
                 tstart = tnow
     except Exception as e:
-      self.log.error("Fatal Exception " + str(e))
+      self.log.error("Fatal Exception %s", e)
       self.log.debug(traceback.format_exc())
+    finally:
+      wakeup, self._poll_wakeup = self._poll_wakeup, None
+      self._poll_thread = None
+      for sock in wakeup:
+          sock.close()
 
     return
 
+  def _get_socket(self):
+      """
+      Return the socket our xmpp connection is reading from
+      """
+      connection = self.cl.Connection
+      sock = getattr(connection, '_sslObj', None)
+      if sock is None:
+          sock = connection._sock
+      return sock
+
+  def _watch_connection(self):
+      self._watched = self._get_socket()
+      self._loop.add_reader(self._watched, self._on_readable)
+
+  def _unwatch_connection(self):
+      if self._watched is not None:
+          self._loop.remove_reader(self._watched)
+          self._watched = None
+
+  def _on_readable(self):
+      """
+      Process incoming stanzas when the event loop sees data on our socket
+
+      run_async is woken up afterwards to run timers and event tasks.
+      """
+      try:
+          while True:
+              try:
+                  state = self.cl.Process(0)
+              except IOError:
+                  state = None
+              if not state:
+                  # Process returns None or 0 when the connection dropped
+                  self._connection_lost()
+                  break
+              # TLS may have decrypted more than Process read, and the
+              # event loop can't see that waiting on the socket
+              if not self._tls_pending():
+                  break
+      except Exception as e:
+          self.log.error("Exception processing stanzas %s", e)
+          self.log.debug(traceback.format_exc())
+      self._wakeup.set()
+
+  def _tls_pending(self):
+      """
+      Return True if our TLS connection has read data Process hasn't
+      """
+      connection = getattr(self.cl, 'Connection', None)
+      sock = getattr(connection, '_sslObj', None)
+      return sock is not None and sock.pending() > 0
+
+  def _next_wakeup(self):
+      """
+      How long the asyncio loop can sleep before it has something to do
+
+      None means sleep until there's network activity.
+      """
+      limit = None
+      if self.eventTasks:
+          limit = float(self.cfg['timeout'])
+      return self.scheduler.timeout(limit)
+
+  async def run_async(self, timeout=None):
+    """
+    Enter an asyncio based event loop
+
+    Instead of polling the connection every cfg['timeout'] seconds,
+    the event loop watches our socket and only calls Process when
+    there is something to read. Event tasks still run after each batch
+    of stanzas, and every cfg['timeout'] seconds if there are any.
+    """
+    if self.cl is None:
+        self.logon()
+
+    self._loop = asyncio.get_running_loop()
+    self._wakeup = asyncio.Event()
+    self._watched = None
+    try:
+        self._watch_connection()
+        deadline = None
+        if timeout is not None:
+            deadline = self._loop.time() + timeout
+        while True:
+            wait = self._next_wakeup()
+            if deadline is not None:
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    break
+                if wait is None or remaining < wait:
+                    wait = remaining
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._run_timers()
+            self._run_event_tasks()
+    except Exception as e:
+        self.log.error("Fatal Exception %s", e)
+        self.log.debug(traceback.format_exc())
+    finally:
+        self._unwatch_connection()
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._loop = None
+        self._wakeup = None
+
   def disconnect(self):
-    self.cl.disconnect()
+    if self.cl is not None:
+      self.cl.disconnect()
 
 if __name__ == "__main__":
     bot = BenderJab()
@@ -0,0 +1,136 @@
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Route chat messages to command handlers
+
+The first word of a message picks the command out of a dictionary, so
+it doesn't matter how many commands a bot has. A command may also give
+a regular expression, which is matched against the rest of the
+message and the resulting match object passed in place of the text.
+"""
+import re
+import time
+
+COMMAND_ATTR = '_benderjab_command'
+
+class Command(object):
+    """
+    A registered command and its call statistics
+    """
+    __slots__ = ('name', 'func', 'pattern', 'help', 'hidden',
+                 'calls', 'errors', 'total_time')
+
+    def __init__(self, name, func, pattern=None, help=None, hidden=False):
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        self.name = name
+        self.func = func
+        self.pattern = pattern
+        self.help = help
+        self.hidden = hidden
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+
+    def usage(self):
+        if self.help:
+            return "usage: %s: %s" % (self.name, self.help)
+        if self.pattern is not None:
+            return "usage: %s %s" % (self.name, self.pattern.pattern)
+        return "usage: %s" % (self.name,)
+
+def command(name=None, pattern=None, help=None, hidden=False):
+    """
+    Mark a BenderJab method as the handler for a command
+
+    The method is called as method(args, who), where args is the rest
+    of the message after the command name, or the match object if a
+    pattern was given. name defaults to the method's name. hidden
+    commands still work but aren't listed.
+    """
+    def wrapper(func):
+        setattr(func, COMMAND_ATTR,
+                (name or func.__name__, pattern, help, hidden))
+        return func
+    return wrapper
+
+class CommandRouter(object):
+    """
+    Dictionary of commands keyed on their lower case name
+    """
+    def __init__(self):
+        self.commands = {}
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(sorted(key for key, cmd in self.commands.items()
+                           if not cmd.hidden))
+
+    def __contains__(self, name):
+        return name.lower() in self.commands
+
+    def add(self, name, func, pattern=None, help=None, hidden=False):
+        """
+        Register func(args, who) to handle messages starting with name
+        """
+        cmd = Command(name, func, pattern, help, hidden)
+        self.commands[name.lower()] = cmd
+        return cmd
+
+    def add_methods(self, obj):
+        """
+        Register every method of obj marked with the command decorator
+
+        Overriding a marked method in a subclass keeps it registered.
+        """
+        specs = {}
+        for cls in reversed(type(obj).__mro__):
+            for attr, value in vars(cls).items():
+                spec = getattr(value, COMMAND_ATTR, None)
+                if spec is not None:
+                    specs[attr] = spec
+        for attr, (name, pattern, help, hidden) in specs.items():
+            self.add(name, getattr(obj, attr), pattern, help, hidden)
+
+    def lookup(self, message):
+        """
+        Find the command for message
+
+        Returns (command, args) or (None, None) if there's no such
+        command. args is None if the command has a pattern that
+        didn't match.
+        """
+        parts = message.split(None, 1)
+        if not parts:
+            return None, None
+        cmd = self.commands.get(parts[0].lower())
+        if cmd is None:
+            return None, None
+        args = parts[1] if len(parts) > 1 else ''
+        if cmd.pattern is not None:
+            args = cmd.pattern.match(args)
+        return cmd, args
+
+    def run(self, cmd, args, who=None):
+        """
+        Call cmd's handler, keeping track of how long it took
+        """
+        start = time.perf_counter()
+        cmd.calls += 1
+        try:
+            return cmd.func(args, who)
+        except Exception:
+            cmd.errors += 1
+            raise
+        finally:
+            cmd.total_time += time.perf_counter() - start
+
+    def stats(self):
+        """
+        Return {name: (calls, errors, total seconds)} for every command
+        """
+        return dict((cmd.name, (cmd.calls, cmd.errors, cmd.total_time))
+                    for cmd in self.commands.values())
@@ -0,0 +1,113 @@
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Durable storage for messages that should be sent later
+
+Messages live in an SQLite table indexed by when they are due, so a bot
+can have a huge number of them scheduled without holding them in
+memory, and anything that came due while the bot was down gets sent
+once it starts up again.
+"""
+import sqlite3
+import threading
+
+class DelayedMessageStore(object):
+    """
+    SQLite table of (due, address, body) messages waiting to be sent
+
+    add commits each message right away, which is cheap with the
+    write ahead log and synchronous=NORMAL. A larger commit_size
+    buffers new messages and writes them in a single transaction once
+    that many have piled up or flush is called, but anything still
+    buffered is lost if the process dies. Delivery is at least once:
+    get_due reads messages without removing them, and remove should
+    be called after they have been sent.
+    """
+    def __init__(self, filename, commit_size=1):
+        self.filename = filename
+        self.commit_size = commit_size
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS delayed ("
+                         " id INTEGER PRIMARY KEY,"
+                         " due REAL NOT NULL,"
+                         " address TEXT NOT NULL,"
+                         " body TEXT NOT NULL)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS delayed_due ON delayed (due)")
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            row = self._db.execute("SELECT COUNT(*) FROM delayed").fetchone()
+            return row[0] + len(self._buffer)
+
+    def add(self, due, address, body):
+        """
+        Queue body to be sent to address at time due
+
+        Returns True if this started a new batch of uncommitted
+        messages, in which case the caller should arrange for flush to
+        be called soon.
+        """
+        with self._lock:
+            self._buffer.append((due, str(address), str(body)))
+            if len(self._buffer) >= self.commit_size:
+                self._flush()
+                return False
+            return len(self._buffer) == 1
+
+    def flush(self):
+        """
+        Commit any buffered messages
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO delayed (due, address, body) VALUES (?, ?, ?)",
+                    self._buffer)
+            self._buffer = []
+
+    def next_due(self):
+        """
+        When the next message is due, or None if there aren't any
+        """
+        with self._lock:
+            due = self._db.execute("SELECT MIN(due) FROM delayed").fetchone()[0]
+            for entry in self._buffer:
+                if due is None or entry[0] < due:
+                    due = entry[0]
+            return due
+
+    def get_due(self, now, limit=500):
+        """
+        Return up to limit (id, due, address, body) rows due by now
+        """
+        with self._lock:
+            self._flush()
+            cursor = self._db.execute(
+                "SELECT id, due, address, body FROM delayed"
+                " WHERE due <= ? ORDER BY due LIMIT ?", (now, limit))
+            return cursor.fetchall()
+
+    def remove(self, ids):
+        """
+        Forget messages that have been sent
+        """
+        with self._lock:
+            with self._db:
+                self._db.executemany("DELETE FROM delayed WHERE id = ?",
+                                     [(msgid,) for msgid in ids])
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._db.close()
@@ -0,0 +1,57 @@
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Log formatting for bots
+
+JSONFormatter writes each record as one JSON object per line, for log
+collectors that would rather not parse text. RecordQueueHandler hands
+records to a QueueListener without flattening them to text first.
+"""
+import copy
+import json
+import logging
+from logging.handlers import QueueHandler
+
+# attributes every LogRecord has, anything else came from extra=
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord(
+    'name', logging.INFO, 'pathname', 0, 'msg', (), None))) | \
+    frozenset(('message', 'asctime', 'taskName'))
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format records as a line of JSON
+
+    Records have time, logger, level and message keys, plus exception
+    if there was one and any attributes passed with extra=.
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key not in entry:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+class RecordQueueHandler(QueueHandler):
+    """
+    QueueHandler that keeps exception info for the listener's formatter
+
+    The stock prepare formats the whole record, pasting any traceback
+    into the message. This only fills in the message arguments, while
+    they still hold the values they had when the record was logged.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
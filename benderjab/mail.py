@@ -0,0 +1,148 @@
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Send email without blocking the xmpp thread
+"""
+import logging
+import queue
+import smtplib
+import threading
+
+class MailSender(object):
+    """
+    Deliver email from a background thread
+
+    One SMTP connection is kept open and reused for everything queued,
+    it is closed after idle_timeout seconds without mail and reopened
+    when the next message shows up or if the server hung up on us.
+    timeout bounds each blocking SMTP operation so a stuck relay can't
+    hang the mail thread.
+    """
+    def __init__(self, host='localhost', port=25, idle_timeout=30,
+                 batch_size=100, smtp_factory=smtplib.SMTP, timeout=60,
+                 log=None):
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.log = log or logging.getLogger(__name__)
+        self.batch_size = batch_size
+        self.smtp_factory = smtp_factory
+        self.sent = 0
+        self.failed = 0
+        self.connections = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._smtp = None
+
+    def send(self, sender, recipients, text):
+        """
+        Queue text to be mailed from sender to the list of recipients
+        """
+        self._queue.put((sender, recipients, text))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='benderjab-mail')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def flush(self):
+        """
+        Wait until everything queued so far has been handled
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Send anything still queued and stop the mail thread
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        try:
+            self._process()
+        finally:
+            # let send start a new thread if this one died
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+    def _process(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._disconnect()
+                continue
+            batch = [item]
+            while item is not None and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+
+            try:
+                self._deliver([b for b in batch if b is not None])
+            finally:
+                for i in range(len(batch)):
+                    self._queue.task_done()
+            if batch[-1] is None:
+                self._disconnect()
+                return
+
+    def _connect(self):
+        if self._smtp is None:
+            self._smtp = self.smtp_factory(self.host, int(self.port),
+                                           timeout=self.timeout)
+            self.connections += 1
+        return self._smtp
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except OSError:
+                pass
+            self._smtp = None
+
+    def _drop(self):
+        """
+        Close a connection that's no longer usable without saying goodbye
+        """
+        if self._smtp is not None:
+            try:
+                self._smtp.close()
+            except OSError:
+                pass
+            self._smtp = None
+
+    def _deliver(self, batch):
+        for sender, recipients, text in batch:
+            try:
+                try:
+                    self._connect().sendmail(sender, recipients, text)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    # the connection went stale, try a fresh one once
+                    self._drop()
+                    self._connect().sendmail(sender, recipients, text)
+                self.sent += 1
+            except OSError as e:
+                # smtplib errors are OSErrors too
+                self.failed += 1
+                self.log.error("Couldn't mail %s: %s", recipients, e)
+                if not isinstance(e, smtplib.SMTPException) or \
+                   isinstance(e, smtplib.SMTPServerDisconnected):
+                    self._drop()
+            except Exception as e:
+                # a bad message shouldn't take the mail thread with it
+                self.failed += 1
+                self.log.error("Couldn't mail %s: %s", recipients, e)
@@ -0,0 +1,215 @@
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Rate limited queue for stanzas the bot sends
+
+Servers disconnect clients that send too fast, so instead of writing
+each stanza as soon as it's ready the bot can queue them here and let
+the event loop drain the queue as fast as the limits allow.
+"""
+from collections import OrderedDict, deque
+import threading
+import time
+
+class TokenBucket(object):
+    """
+    Allow rate events per second, with bursts of up to burst events
+    """
+    def __init__(self, rate, burst=None, clock=time.time):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if burst is None:
+            burst = max(rate, 1)
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait(self, now=None):
+        """
+        Seconds until take will succeed
+        """
+        if now is None:
+            now = self.clock()
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now=None):
+        """
+        Use up a token if there is one, returning whether there was
+        """
+        if now is None:
+            now = self.clock()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def full(self, now=None):
+        if now is None:
+            now = self.clock()
+        self._refill(now)
+        return self.tokens >= self.burst
+
+class OutboundQueue(object):
+    """
+    Queue of stanzas held back by global and per destination limits
+
+    drain writes everything the limits allow with a single call to
+    write, keeping stanzas for the same destination in order and taking
+    turns between destinations. Once max_queue stanzas are waiting put
+    drops new ones. If write raises, the stanzas it was given are put
+    back at the front of their queues.
+    """
+    def __init__(self, write, rate=None, burst=None, peer_rate=None,
+                 peer_burst=None, max_queue=None, max_write=64,
+                 clock=time.time):
+        self.write = write
+        self.clock = clock
+        self.bucket = None
+        if rate:
+            self.bucket = TokenBucket(rate, burst, clock)
+        self.peer_rate = peer_rate
+        self.peer_burst = peer_burst
+        self.max_queue = max_queue
+        self.max_write = max_write
+        self._lock = threading.RLock()
+        # destination -> deque of (stanza, on_sent)
+        self._queues = OrderedDict()
+        self._peers = {}
+        self._depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.writes = 0
+
+    def __len__(self):
+        return self._depth
+
+    def stats(self):
+        """
+        Return a dictionary of queue metrics
+        """
+        with self._lock:
+            return {'depth': self._depth,
+                    'destinations': len(self._queues),
+                    'sent': self.sent,
+                    'dropped': self.dropped,
+                    'writes': self.writes}
+
+    def put(self, stanza, to=None, on_sent=None):
+        """
+        Queue stanza for destination to
+
+        on_sent() is called once stanza has been written. Returns False
+        if the queue was full and stanza was dropped.
+        """
+        with self._lock:
+            if self.max_queue is not None and self._depth >= self.max_queue:
+                self.dropped += 1
+                return False
+            queue = self._queues.get(to)
+            if queue is None:
+                queue = self._queues[to] = deque()
+            queue.append((stanza, on_sent))
+            self._depth += 1
+            return True
+
+    def _peer_bucket(self, to):
+        if not self.peer_rate or to is None:
+            return None
+        bucket = self._peers.get(to)
+        if bucket is None:
+            bucket = TokenBucket(self.peer_rate, self.peer_burst, self.clock)
+            self._peers[to] = bucket
+        return bucket
+
+    def _prune_peers(self, now):
+        """
+        Forget buckets that have refilled for destinations with nothing
+        queued, they'd be recreated full anyway
+        """
+        for to, bucket in list(self._peers.items()):
+            if to not in self._queues and bucket.full(now):
+                del self._peers[to]
+
+    def _requeue(self, batch):
+        for to, entry in reversed(batch):
+            queue = self._queues.get(to)
+            if queue is None:
+                queue = self._queues[to] = deque()
+            queue.appendleft(entry)
+
+    def drain(self):
+        """
+        Write as many queued stanzas as the limits allow
+
+        Returns how many seconds until more may be sent, or None if
+        the queue is empty.
+        """
+        with self._lock:
+            now = self.clock()
+            batch = []
+            wait = None
+            for to in list(self._queues):
+                if len(batch) >= self.max_write:
+                    break
+                if self.bucket is not None and self.bucket.wait(now) > 0:
+                    break
+                queue = self._queues[to]
+                peer = self._peer_bucket(to)
+                while queue and len(batch) < self.max_write:
+                    if self.bucket is not None and self.bucket.wait(now) > 0:
+                        break
+                    if peer is not None and not peer.take(now):
+                        peer_wait = peer.wait(now)
+                        if wait is None or peer_wait < wait:
+                            wait = peer_wait
+                        break
+                    if self.bucket is not None:
+                        self.bucket.take(now)
+                    batch.append((to, queue.popleft()))
+                if queue:
+                    # let other destinations go first next time
+                    self._queues.move_to_end(to)
+                else:
+                    del self._queues[to]
+
+            if batch:
+                try:
+                    self.write("".join(str(entry[0])
+                                       for to, entry in batch))
+                except Exception:
+                    self._requeue(batch)
+                    raise
+                self._depth -= len(batch)
+                self.sent += len(batch)
+                self.writes += 1
+            if len(self._peers) > 1024:
+                self._prune_peers(now)
+
+            if not self._depth:
+                wait = None
+            else:
+                if self.bucket is not None:
+                    global_wait = self.bucket.wait(now)
+                    if global_wait > 0 and \
+                       (wait is None or global_wait > wait):
+                        wait = global_wait
+                if wait is None or len(batch) >= self.max_write:
+                    wait = 0
+
+        for to, (stanza, on_sent) in batch:
+            if on_sent is not None:
+                on_sent()
+        return wait
@@ -0,0 +1,165 @@
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Keep track of our presence and our contacts'
+
+Our own presence is only sent when it actually changes, and changes
+that come close together are merged into one update. Contacts'
+presence is kept in a table so asking who is online doesn't need to
+walk the roster.
+"""
+import threading
+import time
+
+import xmpp
+
+class PresenceManager(object):
+    """
+    Publish our presence and remember everyone else's
+
+    send is called with each presence stanza to publish, and may
+    return False if it couldn't be sent. If debounce is set, a change
+    made less than debounce seconds after the last update waits until
+    then, replaced by any later changes. call_later(delay, func) is
+    used to wait and must return something with a cancel method.
+    """
+    def __init__(self, send, debounce=0, call_later=None, clock=time.time):
+        self.send = send
+        self.debounce = debounce
+        self.call_later = call_later
+        self.clock = clock
+        self.sent = 0
+        self.suppressed = 0
+        # what we want to look like, and what we told everyone
+        self._wanted = (None, None, None)
+        self._published = None
+        self._last_sent = None
+        self._timer = None
+        # bare jid -> {resource: (show, status, priority)}
+        self._contacts = {}
+        self._lock = threading.RLock()
+
+    def _get_current(self):
+        return self._published
+    current = property(_get_current,
+                       doc="(show, status, priority) last published, or None")
+
+    def publish(self, show=None, status=None, priority=None):
+        """
+        Set our presence, sending it if it's different from last time
+
+        Returns True if an update was sent or is waiting to be sent.
+        """
+        wanted = (show or None, status or None,
+                  None if priority is None else int(priority))
+        with self._lock:
+            self._wanted = wanted
+            if wanted == self._published:
+                self.suppressed += 1
+                if self._timer is not None:
+                    # changed and changed back before anyone saw it
+                    self._timer.cancel()
+                    self._timer = None
+                return False
+            if self._timer is not None:
+                return True
+            now = self.clock()
+            if self.debounce and self.call_later is not None and \
+               self._last_sent is not None and \
+               now - self._last_sent < self.debounce:
+                self._timer = self.call_later(
+                    self._last_sent + self.debounce - now, self.flush)
+                return True
+            return self._send(now)
+
+    def flush(self):
+        """
+        Send a pending presence change now
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._wanted == self._published:
+                return False
+            return self._send(self.clock())
+
+    def announce(self):
+        """
+        Send our presence after logging on
+
+        Contacts' presence is forgotten, since the server will tell us
+        about them again.
+        """
+        with self._lock:
+            self._published = None
+            self._contacts = {}
+            return self.flush()
+
+    def _send(self, now):
+        show, status, priority = self._wanted
+        if not self.send(xmpp.Presence(show=show, status=status,
+                                       priority=priority)):
+            return False
+        self._published = self._wanted
+        self._last_sent = now
+        self.sent += 1
+        return True
+
+    def update(self, stanza):
+        """
+        Record a contact's presence stanza
+
+        Returns True if it was an availability update.
+        """
+        presence_type = stanza.getType()
+        if presence_type not in (None, '', 'available', 'unavailable'):
+            return False
+        who = stanza.getFrom()
+        if who is None:
+            return False
+        bare = who.getStripped().lower()
+        resource = who.getResource() or ''
+        with self._lock:
+            if presence_type == 'unavailable':
+                resources = self._contacts.get(bare)
+                if resources is not None:
+                    resources.pop(resource, None)
+                    if not resources or not resource:
+                        del self._contacts[bare]
+            else:
+                priority = stanza.getPriority()
+                try:
+                    priority = int(priority or 0)
+                except ValueError:
+                    priority = 0
+                self._contacts.setdefault(bare, {})[resource] = (
+                    stanza.getShow(), stanza.getStatus(), priority)
+        return True
+
+    def online(self):
+        """
+        Return a sorted list of the bare jids with a resource online
+        """
+        with self._lock:
+            return sorted(self._contacts)
+
+    def is_online(self, jid):
+        key = self._key(jid)
+        with self._lock:
+            return key in self._contacts
+
+    def resources(self, jid):
+        """
+        Return {resource: (show, status, priority)} for jid
+        """
+        with self._lock:
+            return dict(self._contacts.get(self._key(jid), {}))
+
+    def _key(self, jid):
+        return xmpp.JID(jid).getStripped().lower()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._contacts)
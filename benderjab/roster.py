@@ -0,0 +1,115 @@
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Our roster, kept in SQLite instead of xmpppy's in memory Roster
+
+With a file behind it the roster survives restarts. Its version lets
+the server send only what changed since then (XEP-0237), instead of
+the whole roster every time we log on.
+"""
+import sqlite3
+import threading
+
+import xmpp
+
+NS_ROSTER_VER = 'urn:xmpp:features:rosterver'
+
+class RosterCache(object):
+    """
+    Roster items keyed by bare JID, plus the roster version
+
+    Items are dictionaries with jid, name, subscription, ask and
+    groups keys. Only the items asked for are loaded into memory.
+    """
+    def __init__(self, filename=':memory:'):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS roster ("
+                         " jid TEXT PRIMARY KEY,"
+                         " name TEXT,"
+                         " subscription TEXT,"
+                         " ask TEXT,"
+                         " groups TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS roster_meta ("
+                         " key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+
+    def _get_version(self):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM roster_meta WHERE key = 'ver'").fetchone()
+        if row is None:
+            return None
+        return row[0]
+    version = property(_get_version, doc="roster version from the server")
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM roster").fetchone()[0]
+
+    def __contains__(self, jid):
+        return self.get(jid) is not None
+
+    def __iter__(self):
+        with self._lock:
+            jids = [row[0] for row in
+                    self._db.execute("SELECT jid FROM roster ORDER BY jid")]
+        return iter(jids)
+
+    def get(self, jid):
+        """
+        Return the roster item for jid, or None if it's not on our roster
+        """
+        jid = xmpp.JID(jid).getStripped()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT jid, name, subscription, ask, groups FROM roster"
+                " WHERE jid = ?", (jid,)).fetchone()
+        if row is None:
+            return None
+        return {'jid': row[0], 'name': row[1], 'subscription': row[2],
+                'ask': row[3],
+                'groups': row[4].split('\n') if row[4] else []}
+
+    def apply(self, query, replace=False):
+        """
+        Update from a jabber:iq:roster query
+
+        replace means query holds the whole roster, otherwise it is a
+        roster push with just the items that changed. Items with a
+        subscription of remove are deleted.
+        """
+        updates = []
+        removes = []
+        for item in query.getTags('item'):
+            jid = xmpp.JID(item.getAttr('jid')).getStripped()
+            if item.getAttr('subscription') == 'remove':
+                removes.append((jid,))
+                continue
+            groups = [g.getData() for g in item.getTags('group')]
+            updates.append((jid, item.getAttr('name'),
+                            item.getAttr('subscription') or 'none',
+                            item.getAttr('ask'), '\n'.join(groups)))
+        version = query.getAttr('ver')
+
+        with self._lock:
+            with self._db:
+                if replace:
+                    self._db.execute("DELETE FROM roster")
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO roster"
+                    " (jid, name, subscription, ask, groups)"
+                    " VALUES (?, ?, ?, ?, ?)", updates)
+                self._db.executemany("DELETE FROM roster WHERE jid = ?",
+                                     removes)
+                if version is not None:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO roster_meta (key, value)"
+                        " VALUES ('ver', ?)", (version,))
+        return len(updates) + len(removes)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
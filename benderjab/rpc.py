@@ -7,17 +7,41 @@ them to your receiving xml-rpc server, and waits for the response.
 Alternatively one can have an event loop to wait for returning xml-rpc
 messages sent with xmlrc_send. For that xmlrpc_extract_iq will unpack
 the jabber message and return the xml-rpc (args, methodname) tuple
+
+XmlRpcBot.rpc_call_async returns a future instead of waiting, so many
+calls can be in flight over the same connection.
+
+marshal_node and extract_params skip the extra text round trips that
+make_iq and extract_iq need. marshal_node puts the xmlrpc.client.dumps
+output straight into the iq instead of parsing it into a node tree,
+and extract_params reads the parameters out of the node tree the xmpp
+stream parser already built instead of serializing and reparsing it.
+
+Peers that advertise NS_RPC_JSON through disco#info can be sent calls
+encoded as JSON instead of XML-RPC, which is smaller and faster for
+numeric arrays and large structs. See XmlRpcBot.rpc_negotiate.
+
+multicall and XmlRpcBot.rpc_batch pack many calls into a single
+system.multicall iq to save round trips.
 """
+import base64
+from concurrent.futures import Future
+import datetime
+import itertools
+import json
 import logging
+import threading
 import xmlrpc.client
 from xmlrpc.server import SimpleXMLRPCDispatcher
 import sys
+from xml.sax import saxutils
 
 import xmpp
 from xmpp import simplexml
 
 from benderjab.bot import BenderJab
 from benderjab.util import toJID
+from benderjab.workers import LimitedWorkerPool
 from benderjab.xsend import connect
 
 class XmlRpcReceiveTimeout(IOError):
@@ -30,18 +54,41 @@ class XmlRpcProtocolError(IOError):
     There was a problem extracting the parameters out of the jabber message
     """
 
-def make_iq(tojid, typ, marshaled, msgid=None):
+# jabber:iq:rpc with a JSON body instead of XML-RPC
+NS_RPC_JSON = 'urn:benderjab:rpc:json:0'
+
+def make_iq(tojid, typ, marshaled, msgid=None, namespace=xmpp.NS_RPC):
     """
     Wrap XML-RPC marshaled data in an XMPP jabber:iq:rpc message
+
+    marshaled can either be xml text or a node from marshal
     """
     tojid = toJID(tojid)
     iq = xmpp.Iq(typ=typ, to=tojid, xmlns=None)
     if msgid is not None:
       iq.setID(msgid)
-    query = iq.addChild('query', namespace=xmpp.NS_RPC)
-    query.addChild(node=simplexml.XML2Node(marshaled))
+    query = iq.addChild('query', namespace=namespace)
+    if not isinstance(marshaled, simplexml.Node):
+        marshaled = simplexml.XML2Node(marshaled)
+    query.addChild(node=marshaled)
     return iq
 
+def _get_query(iq):
+    """
+    Return the single child node of a jabber:iq:rpc message
+    """
+    children = iq.getChildren()
+    if len(children) < 1:
+        errmsg = "Iq didn't have a body to extract"
+        logging.debug("%s: %s", errmsg, iq)
+        raise XmlRpcProtocolError(errmsg)
+    elif len(children) > 1:
+        errmsg = "Too many child nodes"
+        logging.debug("%s: %s", errmsg, iq)
+        raise XmlRpcProtocolError(errmsg)
+    else:
+        return children[0]
+
 def extract_iq(iq):
     """
     Extract xml-rpc xml from a jabber:iq:rpc message
@@ -52,36 +99,278 @@ def extract_iq(iq):
 
     returns None if there wasn't a body to extract
     """
-    children = iq.getChildren()
-    if len(children) < 1:
-        errmsg = "Iq didn't have a body to extract"
-        logging.debug(errmsg + ": " + str(iq))
-        raise XmlRpcProtocolError(errmsg)
-    elif len(children) > 1:
-        errmsg = "Too many child nodes"
-        logging.debug(errmsg + ": " + str(iq))
-        raise XmlRpcProtocolError(errmsg)
+    return str(_get_query(iq))
+
+def extract_params(iq, use_builtin_types=False):
+    """
+    Unpack a jabber:iq:rpc message into a (params, methodname) tuple
+
+    Works like xmlrpc.client.loads(extract_iq(iq)) without converting
+    the message back to text and parsing it again.
+    """
+    query = _get_query(iq)
+    if query.getNamespace() == NS_RPC_JSON:
+        return unmarshal_json(_get_json(query), use_builtin_types)
+    for payload in query.getChildren():
+        if payload is not None:
+            return unmarshal_node(payload, use_builtin_types)
+    errmsg = "Query didn't have a body to extract"
+    logging.debug("%s: %s", errmsg, iq)
+    raise XmlRpcProtocolError(errmsg)
+
+class RawXmlNode(simplexml.Node):
+    """
+    Node that serializes to an already rendered block of xml
+
+    Lets us hand xmlrpc.client.dumps output to xmpppy without first
+    parsing it into a node tree only to turn it back into text.
+    """
+    def __init__(self, xml):
+        simplexml.Node.__init__(self, 'xmlrpc')
+        self.xml = xml
+
+    def __str__(self, fancy=0):
+        return self.xml
+
+def marshal_node(params, methodname=None, methodresponse=False,
+                 allow_none=False):
+    """
+    Convert params to a node that can be added to an iq
+
+    Takes the same arguments as xmlrpc.client.dumps
+    """
+    xml = xmlrpc.client.dumps(params, methodname, methodresponse,
+                              allow_none=allow_none)
+    if xml.startswith('<?xml'):
+        # drop the xml declaration, we're going in the middle of a stream
+        xml = xml[xml.index('?>')+2:].lstrip()
+    return RawXmlNode(xml)
+
+def _is_json_tag(key):
+    """
+    Is key __base64__ or __datetime__, or one with extra leading _s?
+    """
+    return isinstance(key, str) and key.startswith('__') and \
+           key.lstrip('_') in ('base64__', 'datetime__')
+
+def _escape_json(value):
+    """
+    Add a _ to the key of one key dicts that would read back as a tag
+
+    unmarshal_json takes it off again.
+    """
+    if isinstance(value, dict):
+        value = dict((k, _escape_json(v)) for k, v in value.items())
+        if len(value) == 1:
+            key = next(iter(value))
+            if _is_json_tag(key):
+                value = {'_' + key: value[key]}
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_escape_json(v) for v in value]
+    return value
+
+class _JsonEncoder(json.JSONEncoder):
+    """
+    Encode the extra types XML-RPC supports as tagged objects
+    """
+    def default(self, value):
+        if isinstance(value, (bytes, bytearray, xmlrpc.client.Binary)):
+            if isinstance(value, xmlrpc.client.Binary):
+                value = value.data
+            return {'__base64__': base64.b64encode(value).decode('ascii')}
+        elif isinstance(value, datetime.datetime):
+            return {'__datetime__': value.strftime("%Y%m%dT%H:%M:%S")}
+        elif isinstance(value, xmlrpc.client.DateTime):
+            return {'__datetime__': value.value}
+        elif hasattr(value, '__dict__'):
+            return _escape_json(vars(value))
+        return json.JSONEncoder.default(self, value)
+
+def marshal_json(params, methodname=None, methodresponse=False):
+    """
+    Convert params to a JSON body for a NS_RPC_JSON query
+
+    Takes the same arguments as marshal_node, the body mirrors the
+    XML-RPC structure: methodName and params, or fault for a Fault.
+    """
+    if isinstance(params, xmlrpc.client.Fault):
+        body = {'fault': {'faultCode': params.faultCode,
+                          'faultString': params.faultString}}
+    else:
+        if methodresponse and len(params) != 1:
+            raise ValueError("response tuple must be a singleton")
+        body = {'params': _escape_json(params)}
+        if methodname is not None and not methodresponse:
+            body['methodName'] = methodname
+    text = json.dumps(body, cls=_JsonEncoder, separators=(',', ':'))
+    # only escape what we have to, XMLescape would also expand every "
+    return RawXmlNode(saxutils.escape(text))
+
+def marshal(params, methodname=None, methodresponse=False, allow_none=False,
+            namespace=xmpp.NS_RPC):
+    """
+    Convert params to a node for a query in namespace
+    """
+    if namespace == NS_RPC_JSON:
+        return marshal_json(params, methodname, methodresponse)
+    return marshal_node(params, methodname, methodresponse, allow_none)
+
+def _get_json(query):
+    for kid in query.getChildren():
+        if isinstance(kid, RawXmlNode):
+            # built locally, not parsed off the stream
+            return saxutils.unescape(kid.xml)
+    return query.getData()
+
+def unmarshal_json(text, use_builtin_types=False):
+    """
+    Convert a NS_RPC_JSON body to (params, methodname)
+    """
+    def decode_tagged(obj):
+        if len(obj) == 1:
+            if '__base64__' in obj:
+                data = base64.b64decode(obj['__base64__'])
+                if use_builtin_types:
+                    return data
+                return xmlrpc.client.Binary(data)
+            elif '__datetime__' in obj:
+                value = xmlrpc.client.DateTime(obj['__datetime__'])
+                if use_builtin_types:
+                    return datetime.datetime.strptime(value.value,
+                                                      "%Y%m%dT%H:%M:%S")
+                return value
+            key = next(iter(obj))
+            if _is_json_tag(key):
+                # one of ours, escaped by _escape_json
+                return {key[1:]: obj[key]}
+        return obj
+
+    try:
+        body = json.loads(text, object_hook=decode_tagged)
+    except ValueError as e:
+        raise XmlRpcProtocolError("bad JSON rpc body: " + str(e))
+    if 'fault' in body:
+        raise xmlrpc.client.Fault(**body['fault'])
+    return tuple(body.get('params', ())), body.get('methodName')
+
+def _children(node):
+    return [kid for kid in node.getChildren() if kid is not None]
+
+def _unmarshal_value(node, use_builtin_types):
+    """
+    Convert an xml-rpc <value> node back into a python value
+    """
+    kids = _children(node)
+    if not kids:
+        # untyped values are strings
+        return node.getData()
+    typed = kids[0]
+    name = typed.getName()
+    if name in ('int', 'i4', 'i8', 'i1', 'i2', 'biginteger'):
+        return int(typed.getData())
+    elif name == 'string':
+        return typed.getData()
+    elif name in ('double', 'float', 'bigdecimal'):
+        return float(typed.getData())
+    elif name == 'boolean':
+        data = typed.getData()
+        if data == '1':
+            return True
+        elif data == '0':
+            return False
+        raise TypeError("bad boolean value")
+    elif name == 'array':
+        data = _children(typed)
+        if not data:
+            return []
+        return [_unmarshal_value(v, use_builtin_types)
+                for v in _children(data[0])]
+    elif name == 'struct':
+        struct = {}
+        for member in _children(typed):
+            key = None
+            value = None
+            for part in _children(member):
+                if part.getName() == 'name':
+                    key = part.getData()
+                elif part.getName() == 'value':
+                    value = _unmarshal_value(part, use_builtin_types)
+            struct[key] = value
+        return struct
+    elif name == 'nil':
+        return None
+    elif name == 'base64':
+        data = base64.decodebytes(typed.getData().encode('ascii'))
+        if use_builtin_types:
+            return data
+        return xmlrpc.client.Binary(data)
+    elif name == 'dateTime.iso8601':
+        value = xmlrpc.client.DateTime(typed.getData().strip())
+        if use_builtin_types:
+            return datetime.datetime.strptime(value.value, "%Y%m%dT%H:%M:%S")
+        return value
+    raise XmlRpcProtocolError("unknown xml-rpc type %s" % (name,))
+
+def unmarshal_node(node, use_builtin_types=False):
+    """
+    Convert an xml-rpc node tree to (params, methodname)
+
+    Like xmlrpc.client.loads this raises xmlrpc.client.Fault if node is
+    a fault response.
+    """
+    if isinstance(node, RawXmlNode):
+        # built locally, not parsed off the stream
+        return xmlrpc.client.loads(node.xml, use_builtin_types)
+
+    methodname = None
+    name = node.getName()
+    if name == 'params':
+        params_node = node
+    elif name in ('methodCall', 'methodResponse'):
+        params_node = None
+        for part in _children(node):
+            part_name = part.getName()
+            if part_name == 'params':
+                params_node = part
+            elif part_name == 'methodName':
+                methodname = part.getData()
+            elif part_name == 'fault':
+                fault = _unmarshal_value(_children(part)[0], use_builtin_types)
+                raise xmlrpc.client.Fault(**fault)
     else:
-        return str(children[0])
+        raise XmlRpcProtocolError("unexpected xml-rpc element %s" % (name,))
+
+    params = []
+    if params_node is not None:
+        for param in _children(params_node):
+            value = _children(param)[0]
+            params.append(_unmarshal_value(value, use_builtin_types))
+    return tuple(params), methodname
 
 def error_iq(who, err_attrs, description, body, msgid=None):
     iq = xmpp.Iq(typ='error', to=who)
     if msgid is not None:
         iq.setID(msgid)
-    iq.addChild(node=simplexml.XML2Node(str(body)))
+    if not isinstance(body, simplexml.Node):
+        body = simplexml.XML2Node(str(body))
+    iq.addChild(node=body)
     error = iq.addChild('error', err_attrs)
     error.addChild(description, namespace='urn:ietf:params:xml:ns:xmpp-stanzas')
     return iq
 
-def send(conn, tojid, params, methodname=None, encoding=None):
+def send(conn, tojid, params, methodname=None, encoding=None, msgid=None,
+         namespace=xmpp.NS_RPC):
     """
     Send an xml-rpc message via jabber
 
     JEP-009 http://www.xmpp.org/extensions/xep-0009.html
-    """
-    call_xml = xmlrpc.client.dumps(params, methodname, encoding)
 
-    iq = make_iq(tojid, 'set', call_xml)
+    encoding is ignored, xmpp streams are always utf-8. Use
+    namespace=NS_RPC_JSON to send a JSON body to peers that support it.
+    """
+    marshaled = marshal(params, methodname, namespace=namespace)
+    iq = make_iq(tojid, 'set', marshaled, msgid, namespace)
     msg_id = conn.send(iq)
     return msg_id
 
@@ -97,19 +386,185 @@ def receive(conn, msgid, timeout=25):
     if msg is None:
         raise XmlRpcReceiveTimeout("message %s timed out" %(str(id)))
 
-    body = extract_iq(msg)
-    return xmlrpc.client.loads(body)
+    return extract_params(msg)
 
-def call(conn, tojid, params, methodname=None, encoding=None):
-    msgid = send(conn,tojid, params, methodname, encoding)
+def call(conn, tojid, params, methodname=None, encoding=None,
+         namespace=xmpp.NS_RPC):
+    msgid = send(conn,tojid, params, methodname, encoding, namespace=namespace)
     reply_iq = receive(conn, msgid)
     return reply_iq[0]
 
 
+def _multicall_results(results):
+    """
+    Convert system.multicall results to values and Fault instances
+    """
+    converted = []
+    for result in results:
+        if isinstance(result, dict):
+            converted.append(xmlrpc.client.Fault(result['faultCode'],
+                                                 result['faultString']))
+        elif isinstance(result, list) and len(result) == 1:
+            converted.append(result[0])
+        else:
+            raise ValueError("unexpected multicall result %s" % (str(result),))
+    return converted
+
+def _multicall_params(calls):
+    return ([{'methodName': method, 'params': list(params)}
+             for method, params in calls],)
+
+def multicall(conn, tojid, calls, namespace=xmpp.NS_RPC):
+    """
+    Make several calls to tojid in one round trip using system.multicall
+
+    calls is a list of (methodname, params) tuples. Returns a list with
+    each call's result, or an xmlrpc.client.Fault instance for calls
+    that failed.
+    """
+    results = call(conn, tojid, _multicall_params(calls), 'system.multicall',
+                   namespace=namespace)
+    return _multicall_results(results)
+
+def _settle(future, result=None, error=None):
+    """
+    Resolve future with result or error, unless it was cancelled
+    """
+    if future.done() or not future.set_running_or_notify_cancel():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class RpcBatch(object):
+    """
+    Queue calls to one peer and send them as system.multicall requests
+
+    Queued calls go out when flush_size of them have accumulated, when
+    the oldest has waited flush_interval seconds (using the bot's
+    scheduler), or when flush is called. Each call gets its own future.
+    """
+    def __init__(self, bot, tojid, flush_size=50, flush_interval=0.1):
+        self.bot = bot
+        self.tojid = tojid
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._calls = []
+        self._futures = []
+        self._started = None
+
+    def __len__(self):
+        return len(self._calls)
+
+    def call(self, method, *params):
+        """
+        Queue method(*params), returning a future for its result
+        """
+        future = Future()
+        with self._lock:
+            first = not self._calls
+            if first:
+                self._started = self.bot.scheduler.clock()
+            self._calls.append((method, params))
+            self._futures.append(future)
+            full = len(self._calls) >= self.flush_size
+        if full:
+            self.flush()
+        elif first:
+            self.bot.call_later(self.flush_interval, self._flush_if_due)
+        return future
+
+    def _flush_if_due(self):
+        with self._lock:
+            if not self._calls:
+                return
+            remaining = self._started + self.flush_interval - \
+                        self.bot.scheduler.clock()
+        if remaining > 0:
+            # a batch started after the one that set this timer
+            self.bot.call_later(remaining, self._flush_if_due)
+        else:
+            self.flush()
+
+    def due(self, now=None):
+        """
+        Has the oldest queued call waited at least flush_interval?
+
+        now is on the bot's scheduler clock.
+        """
+        if now is None:
+            now = self.bot.scheduler.clock()
+        with self._lock:
+            return bool(self._calls) and \
+                   now - self._started >= self.flush_interval
+
+    def flush(self):
+        """
+        Send everything queued so far
+        """
+        with self._lock:
+            calls, self._calls = self._calls, []
+            futures, self._futures = self._futures, []
+        if not calls:
+            return None
+
+        try:
+            request = self.bot.rpc_call_async(
+                self.tojid, _multicall_params(calls), 'system.multicall')
+        except Exception as e:
+            for future in futures:
+                _settle(future, error=e)
+            return None
+        def distribute(request):
+            try:
+                results = _multicall_results(request.result())
+                if len(results) != len(futures):
+                    raise XmlRpcProtocolError(
+                        "sent %d calls but got %d results" % (
+                            len(futures), len(results)))
+            except Exception as e:
+                for future in futures:
+                    _settle(future, error=e)
+                return
+            for future, result in zip(futures, results):
+                if isinstance(result, xmlrpc.client.Fault):
+                    _settle(future, error=result)
+                else:
+                    _settle(future, result)
+        request.add_done_callback(distribute)
+        return request
+
 class XmlRpcBot(BenderJab, SimpleXMLRPCDispatcher):
     def __init__(self, section=None, configfile=None):
         super(XmlRpcBot, self).__init__(section, configfile)
         self.cfg['authorized_users'] = None
+        # default number of seconds to wait for rpc_call_async replies
+        self.cfg['rpc_timeout'] = 25
+        # number of threads to run registered functions on, 0 runs inline
+        self.cfg['rpc_workers'] = 0
+        # how many calls may be queued or running before we refuse more
+        self.cfg['rpc_queue'] = None
+        # set to json to use NS_RPC_JSON with peers that advertise it
+        self.cfg['rpc_format'] = 'xmlrpc'
+        # default size and age (in seconds) at which rpc_batch sends
+        self.cfg['rpc_batch_size'] = 50
+        self.cfg['rpc_batch_interval'] = 0.1
+
+        # jid -> rpc namespace we've negotiated with that peer
+        self.rpc_peer_formats = {}
+        # msgid -> (future, decode) for calls waiting on a reply
+        self._pending_calls = {}
+        self._pending_lock = threading.Lock()
+        self._call_ids = itertools.count(1)
+
+        self._rpc_workers = None
+        # method name -> maximum concurrent calls when using rpc_workers
+        self.rpc_method_limits = {}
+
+        # jid -> RpcBatch
+        self._batches = {}
 
         allow_none = False
         encoding = None
@@ -124,6 +579,7 @@ class XmlRpcBot(BenderJab, SimpleXMLRPCDispatcher):
         else:
             # python 2.3, 2.4 version
             SimpleXMLRPCDispatcher.__init__(self)
+        self.register_multicall_functions()
         self.authorized_users = None
 
     def read_config(self, section=None, configfile=None):
@@ -134,48 +590,382 @@ class XmlRpcBot(BenderJab, SimpleXMLRPCDispatcher):
         """
         cl = BenderJab.logon(self)
         cl.RegisterHandler('iq', self.bot_dispatcher, typ='set', ns=xmpp.NS_RPC)
+        cl.RegisterHandler('iq', self.bot_dispatcher, typ='set', ns=NS_RPC_JSON)
+        cl.RegisterHandler('iq', self.disco_info_handler, typ='get',
+                           ns=xmpp.NS_DISCO_INFO)
+        cl.RegisterHandler('iq', self.rpc_response_handler, typ='result')
+        cl.RegisterHandler('iq', self.rpc_response_handler, typ='error')
+
+    def disco_info_handler(self, conn, msg):
+        """
+        Tell peers which rpc encodings we understand
+        """
+        reply = msg.buildReply('result')
+        query = reply.getTag('query')
+        query.addChild('identity', {'category': 'automation', 'type': 'rpc'})
+        for feature in (xmpp.NS_DISCO_INFO, xmpp.NS_RPC, NS_RPC_JSON):
+            query.addChild('feature', {'var': feature})
+        self._write(reply, conn)
+        raise xmpp.NodeProcessed
+
+    def _require_connection(self):
+        """
+        Raise RuntimeError unless we can write to the server right now
+        """
+        if self._reconnecting:
+            msg = "Bot is reconnecting to the server"
+        elif self.cl is None:
+            msg = "Bot isn't connected to the server"
+        else:
+            return
+        logging.fatal(msg)
+        raise RuntimeError(msg)
+
+    def rpc_negotiate(self, tojid, timeout=None):
+        """
+        Ask tojid which rpc encodings it supports
+
+        Returns a future for the namespace calls to tojid will use from
+        now on, NS_RPC_JSON if the peer advertises it and cfg['rpc_format']
+        is json, otherwise jabber:iq:rpc.
+        """
+        key = str(tojid)
+        # use XML-RPC until we hear back
+        self.rpc_peer_formats.setdefault(key, xmpp.NS_RPC)
+
+        def decode(msg):
+            features = [f.getAttr('var')
+                        for f in msg.getTag('query').getTags('feature')]
+            namespace = xmpp.NS_RPC
+            if NS_RPC_JSON in features and self.cfg['rpc_format'] == 'json':
+                namespace = NS_RPC_JSON
+            self.rpc_peer_formats[key] = namespace
+            return namespace
+
+        msgid, future = self._add_pending_call(decode, timeout)
+        iq = xmpp.Iq(typ='get', to=toJID(tojid), queryNS=xmpp.NS_DISCO_INFO)
+        iq.setID(msgid)
+        try:
+            self._require_connection()
+            self._write(iq)
+        except Exception as e:
+            _settle(future, error=e)
+        return future
+
+    def _peer_namespace(self, tojid):
+        """
+        Which rpc namespace to use when calling tojid
+        """
+        if self.cfg['rpc_format'] != 'json':
+            return xmpp.NS_RPC
+        key = str(tojid)
+        if key not in self.rpc_peer_formats:
+            self.rpc_negotiate(tojid)
+        return self.rpc_peer_formats[key]
 
     def rpc_send(self, tojid, args, method):
         """
         Send a XMl-RPC message to tojid.
         """
-        if self.cl is None:
-            msg = "Bot isn't connected to the server"
-            logging.fatal(msg)
-            raise RuntimeError(msg)
-        msg = 'RPC Send <%s>: %s' %(str(tojid),str(method) + str(args))
-        logging.debug(msg)
-        return send(self.cl, tojid, args, method)
+        self._require_connection()
+        logging.debug('RPC Send <%s>: %s%s', tojid, method, args)
+        namespace = self._peer_namespace(tojid)
+        with self._send_lock:
+            return send(self.cl, tojid, args, method, namespace=namespace)
 
     def rpc_call(self, tojid, args, method):
         """
         Send a XML-RPC message to tojid, and return the response
         """
-        if self.cl is None:
-            msg = "Bot isn't connected to the server"
-            logging.fatal(msg)
-            raise RuntimeError(msg)
-        msg = 'RPC Call <%s>: %s' %(str(tojid), str(method) + str(args))
-        logging.debug(msg)
-        result = call(self.cl, tojid, args, method)
-        logging.debug("Result: " + str(result))
+        self._require_connection()
+        logging.debug('RPC Call <%s>: %s%s', tojid, method, args)
+        result = call(self.cl, tojid, args, method,
+                      namespace=self._peer_namespace(tojid))
+        logging.debug("Result: %s", result)
         return result
 
+    def rpc_call_async(self, tojid, args, method, timeout=None):
+        """
+        Send a XML-RPC message to tojid, returning a future for the response
+
+        The future's result is the remote function's return value, or it
+        raises xmlrpc.client.Fault, XmlRpcProtocolError if the remote side
+        sent an error iq, or XmlRpcReceiveTimeout if nothing came back
+        within timeout seconds (cfg['rpc_timeout'] by default).
+        Cancelling the future forgets about the call.
+
+        The future is a concurrent.futures.Future, use asyncio.wrap_future
+        to await it from a coroutine.
+        """
+        self._require_connection()
+        def decode(msg):
+            return extract_params(msg, self.use_builtin_types)[0][0]
+        msgid, future = self._add_pending_call(decode, timeout)
+
+        logging.debug('RPC Call Async <%s>: %s%s', tojid, method, args)
+        try:
+            namespace = self._peer_namespace(tojid)
+            with self._send_lock:
+                send(self.cl, tojid, args, method, msgid=msgid,
+                     namespace=namespace)
+        except Exception as e:
+            _settle(future, error=e)
+        return future
+
+    def rpc_batch(self, tojid, flush_size=None, flush_interval=None):
+        """
+        Return the RpcBatch queuing calls for tojid
+
+        batch.call(method, *params) returns a future, queued calls go out
+        together as one system.multicall request. flush_size and
+        flush_interval update an existing batch for tojid.
+        """
+        key = str(tojid)
+        batch = self._batches.get(key)
+        if batch is None:
+            if flush_size is None:
+                flush_size = int(self.cfg['rpc_batch_size'])
+            if flush_interval is None:
+                flush_interval = float(self.cfg['rpc_batch_interval'])
+            batch = RpcBatch(self, tojid, flush_size, flush_interval)
+            self._batches[key] = batch
+        else:
+            if flush_size is not None:
+                batch.flush_size = flush_size
+            if flush_interval is not None:
+                batch.flush_interval = flush_interval
+        return batch
+
+    def _add_pending_call(self, decode, timeout=None):
+        """
+        Make a msgid and future for a reply we're going to wait for
+
+        decode(msg) converts the result iq into the future's result.
+        """
+        if timeout is None:
+            timeout = float(self.cfg['rpc_timeout'])
+
+        msgid = 'rpc%d' % (next(self._call_ids),)
+        future = Future()
+        with self._pending_lock:
+            self._pending_calls[msgid] = (future, decode)
+        timer = self.call_later(timeout, self._expire_rpc_call, msgid)
+        future.add_done_callback(
+            lambda f: self._forget_rpc_call(msgid, timer))
+        return msgid, future
+
+    def _forget_rpc_call(self, msgid, timer):
+        timer.cancel()
+        with self._pending_lock:
+            self._pending_calls.pop(msgid, None)
+
+    def _pop_rpc_call(self, msgid):
+        with self._pending_lock:
+            return self._pending_calls.pop(msgid, None)
+
+    def _expire_rpc_call(self, msgid):
+        """
+        Fail a call that has waited too long for its reply
+        """
+        pending = self._pop_rpc_call(msgid)
+        if pending is not None:
+            _settle(pending[0], error=XmlRpcReceiveTimeout(
+                "message %s timed out" % (msgid,)))
+
+    def rpc_response_handler(self, conn, msg):
+        """
+        Resolve the rpc_call_async future waiting on this reply
+        """
+        pending = self._pop_rpc_call(msg.getID())
+        if pending is None:
+            # not one of ours
+            return
+        future, decode = pending
+        if future.done():
+            raise xmpp.NodeProcessed
+
+        # _settle, since the caller may cancel future at any moment
+        try:
+            if msg.getType() == 'error':
+                raise XmlRpcProtocolError(
+                    "RPC error from %s: %s" % (str(msg.getFrom()),
+                                              str(msg.getError())))
+            result = decode(msg)
+        except Exception as e:
+            _settle(future, error=e)
+        else:
+            _settle(future, result)
+        raise xmpp.NodeProcessed
+
+    def set_method_concurrency(self, name, limit):
+        """
+        Run at most limit calls to the registered function name at once
+
+        Only applies when cfg['rpc_workers'] is set, None removes the limit.
+        """
+        if limit is None:
+            self.rpc_method_limits.pop(name, None)
+        else:
+            self.rpc_method_limits[name] = limit
+        if self._rpc_workers is not None:
+            self._rpc_workers.set_limit(name, limit)
+
+    def _get_rpc_workers(self):
+        """
+        Return the pool to dispatch calls on, or None to dispatch inline
+        """
+        if self._rpc_workers is None:
+            workers = int(self.cfg['rpc_workers'] or 0)
+            if workers > 0:
+                max_pending = self.cfg['rpc_queue']
+                if max_pending is not None:
+                    max_pending = int(max_pending)
+                self._rpc_workers = LimitedWorkerPool(workers, max_pending,
+                                                      self.log)
+                for name, limit in self.rpc_method_limits.items():
+                    self._rpc_workers.set_limit(name, limit)
+        return self._rpc_workers
+
+    def rpc_queue_depth(self, name=None):
+        """
+        Number of calls queued or running on the rpc workers
+
+        If name is given, only count calls to that function.
+        """
+        if self._rpc_workers is None:
+            return 0
+        return self._rpc_workers.depth(name)
+
+    def _shutdown_workers(self):
+        super(XmlRpcBot, self)._shutdown_workers()
+        if self._rpc_workers is not None:
+            self._rpc_workers.shutdown()
+            self._rpc_workers = None
+
+    def _dispatch_params(self, params, method, namespace=xmpp.NS_RPC):
+        """
+        Call a registered function, returning a methodResponse node
+
+        Works like SimpleXMLRPCDispatcher._marshaled_dispatch, but
+        without converting to and from text.
+        """
+        try:
+            response = (self._dispatch(method, params),)
+            return marshal(response, methodresponse=True,
+                           allow_none=self.allow_none, namespace=namespace)
+        except xmlrpc.client.Fault as fault:
+            return marshal(fault, allow_none=self.allow_none,
+                           namespace=namespace)
+        except BaseException as e:
+            fault = xmlrpc.client.Fault(1, "%s:%s" % (type(e), e))
+            return marshal(fault, allow_none=self.allow_none,
+                           namespace=namespace)
+
+    def _submit_rpc(self, conn, who, msgid, query, params, method):
+        """
+        Queue an rpc call to run on our worker pool
+        """
+        namespace = query.getNamespace()
+        def reply(response):
+            response_iq = make_iq(who, 'result', response, msgid, namespace)
+            self.call_threadsafe(self._write, response_iq, conn)
+
+        if method == 'system.multicall' and \
+           self._submit_multicall(params, namespace, reply):
+            return
+
+        submitted = self._rpc_workers.submit(
+            method, lambda: self._dispatch_params(params, method, namespace),
+            reply)
+        if not submitted:
+            err_attrs = {'code': 500, 'type': 'wait'}
+            self._write(error_iq(who, err_attrs, 'resource-constraint',
+                                 query, msgid), conn)
+
+    def _submit_multicall(self, params, namespace, reply):
+        """
+        Queue each call in a system.multicall under its own method name
+
+        That way set_method_concurrency limits apply to them too.
+        reply gets the methodResponse once they've all finished.
+        Returns False if params doesn't look like a multicall.
+        """
+        if len(params) != 1 or not isinstance(params[0], list):
+            return False
+        calls = params[0]
+        for call in calls:
+            if not isinstance(call, dict) or 'methodName' not in call:
+                return False
+
+        results = [None] * len(calls)
+        remaining = [len(calls)]
+        lock = threading.Lock()
+
+        def finished(index, result):
+            results[index] = result
+            with lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                reply(marshal((results,), methodresponse=True,
+                              allow_none=self.allow_none,
+                              namespace=namespace))
+
+        def run(name, call_params):
+            try:
+                return [self._dispatch(name, call_params)]
+            except xmlrpc.client.Fault as fault:
+                return {'faultCode': fault.faultCode,
+                        'faultString': fault.faultString}
+            except BaseException as e:
+                return {'faultCode': 1, 'faultString': "%s:%s" % (type(e), e)}
+
+        if not calls:
+            reply(marshal(([],), methodresponse=True, namespace=namespace))
+            return True
+        for index, call in enumerate(calls):
+            name = call['methodName']
+            call_params = tuple(call.get('params', ()))
+            submitted = self._rpc_workers.submit(
+                name,
+                lambda name=name, call_params=call_params: run(name, call_params),
+                lambda result, index=index: finished(index, result))
+            if not submitted:
+                finished(index, {'faultCode': 1,
+                                 'faultString': 'rpc queue is full'})
+        return True
+
     def bot_dispatcher(self, conn, msg):
         msgid =None
 
         try:
             who = msg.getFrom()
             msgid = msg.getID()
-            body = extract_iq(msg)
+            query = _get_query(msg)
+            namespace = query.getNamespace()
             if not (self.authorized_users is None or self.check_authorization(who)):
                 err_attrs = {'code': 503, 'type': 'auth'}
-                response_iq = error_iq(who, err_attrs, 'forbidden', body, msgid)
+                response_iq = error_iq(who, err_attrs, 'forbidden', query, msgid)
             else:
-                response = self._marshaled_dispatch(body)
-                response_iq = make_iq(who, 'result', response, msgid)
-            c = conn.send(response_iq)
-        except RuntimeError as e:
-            self.log.error("Exception in bot_dispatcher"+str(e))
+                try:
+                    params, method = extract_params(msg, self.use_builtin_types)
+                except Exception as e:
+                    fault = xmlrpc.client.Fault(1, "%s:%s" % (type(e), e))
+                    response = marshal(fault, namespace=namespace)
+                    response_iq = make_iq(who, 'result', response, msgid,
+                                          namespace)
+                else:
+                    if self._get_rpc_workers() is not None:
+                        self._submit_rpc(conn, who, msgid, query, params, method)
+                        response_iq = None
+                    else:
+                        response = self._dispatch_params(params, method,
+                                                         namespace)
+                        response_iq = make_iq(who, 'result', response, msgid,
+                                              namespace)
+            if response_iq is not None:
+                self._write(response_iq, conn)
+        except (RuntimeError, XmlRpcProtocolError) as e:
+            self.log.error("Exception in bot_dispatcher %s", e)
             # really should send an error back to the sender
         raise xmpp.NodeProcessed
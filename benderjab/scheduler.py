@@ -0,0 +1,159 @@
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Timers for the bot event loop
+
+Timers live in a heap ordered by deadline, so finding the next one due
+is cheap no matter how many are pending. Deadlines are on the
+monotonic clock, so setting the system clock doesn't make timers fire
+early or late. Cancelled timers are left in
+the heap and skipped when they reach the top, unless enough of them
+pile up to be worth rebuilding the heap.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+class TimerHandle(object):
+    """
+    A scheduled call, returned by Scheduler.call_at and friends
+    """
+    __slots__ = ('when', 'callback', 'args', 'interval', 'cancelled',
+                 '_scheduler', '_queued')
+
+    def __init__(self, scheduler, when, callback, args, interval=None):
+        self._scheduler = scheduler
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+        self._queued = False
+
+    def cancel(self):
+        """
+        Stop this timer from firing (again)
+        """
+        if not self.cancelled:
+            self.cancelled = True
+            self._scheduler._cancelled(self)
+
+class Scheduler(object):
+    """
+    Heap of timers, run by whoever owns the event loop
+
+    call_at/call_later/call_every may be used from any thread,
+    pop_due should only be called from the event loop, which should
+    skip any handles cancelled before it gets to them.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._cancelled_count = 0
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled_count
+
+    def _push(self, handle):
+        with self._lock:
+            handle._queued = True
+            heapq.heappush(self._heap,
+                           (handle.when, next(self._counter), handle))
+        return handle
+
+    def call_at(self, when, callback, *args):
+        """
+        Call callback(*args) at time when (as returned by clock)
+        """
+        return self._push(TimerHandle(self, when, callback, args))
+
+    def call_later(self, delay, callback, *args):
+        """
+        Call callback(*args) in delay seconds
+        """
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        """
+        Call callback(*args) every interval seconds until cancelled
+        """
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        handle = TimerHandle(self, self.clock() + interval, callback, args,
+                             interval)
+        return self._push(handle)
+
+    def _cancelled(self, handle):
+        with self._lock:
+            if not handle._queued:
+                # already ran
+                return
+            self._cancelled_count += 1
+            if self._cancelled_count > 64 and \
+               self._cancelled_count * 2 > len(self._heap):
+                heap = []
+                for entry in self._heap:
+                    if entry[2].cancelled:
+                        entry[2]._queued = False
+                    else:
+                        heap.append(entry)
+                heapq.heapify(heap)
+                self._heap = heap
+                self._cancelled_count = 0
+
+    def next_deadline(self):
+        """
+        When the next timer is due, or None if there aren't any
+        """
+        with self._lock:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)[2]._queued = False
+                self._cancelled_count -= 1
+            if self._heap:
+                return self._heap[0][0]
+            return None
+
+    def timeout(self, limit=None):
+        """
+        How long the event loop may wait before a timer is due
+
+        Never more than limit seconds, None means wait forever.
+        """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return limit
+        wait = max(0, deadline - self.clock())
+        if limit is not None and limit < wait:
+            return limit
+        return wait
+
+    def pop_due(self, now=None):
+        """
+        Remove and return the timers that are due
+
+        Repeating timers are rescheduled for their next interval.
+        """
+        if now is None:
+            now = self.clock()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                when, count, handle = heapq.heappop(self._heap)
+                handle._queued = False
+                if handle.cancelled:
+                    self._cancelled_count -= 1
+                    continue
+                due.append(handle)
+            for handle in due:
+                if handle.interval is not None:
+                    # skip intervals we missed rather than firing a burst
+                    missed = (now - handle.when) // handle.interval + 1
+                    handle.when += missed * handle.interval
+                    handle._queued = True
+                    heapq.heappush(self._heap, (handle.when,
+                                                next(self._counter), handle))
+        return due
@@ -0,0 +1,195 @@
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Remember things about the people talking to a bot
+
+Sessions are dictionaries kept per bare JID. Only the most recently
+used ones stay in memory. The rest are dropped, or written to a dbm file
+and loaded again the next time their owner says something.
+"""
+from collections import OrderedDict
+import dbm
+import pickle
+import sys
+import threading
+import time
+
+import xmpp
+
+def session_key(who):
+    """
+    Return the lower case bare JID sessions are filed under
+    """
+    if isinstance(who, xmpp.JID):
+        who = who.getStripped()
+    return str(who).split('/', 1)[0].lower()
+
+def _sizeof(session):
+    try:
+        return len(pickle.dumps(session, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(session)
+
+class SessionStore(object):
+    """
+    LRU of per sender session dictionaries
+
+    store[who] returns who's session, creating an empty one if needed.
+    Sessions are evicted when there are more than max_sessions, when
+    they haven't been used for ttl seconds, or when the pickled size of
+    everything in memory goes over max_bytes. A session's size is
+    measured when it is stored with store[who] = session, so do that
+    after changing a session if you're using max_bytes.
+
+    If spill names a file, evicted (but not expired) sessions are
+    pickled into it instead of being thrown away, and prune removes
+    expired ones from it too.
+    """
+    def __init__(self, max_sessions=1000, ttl=None, max_bytes=None,
+                 spill=None, clock=time.time):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        # key -> [last used, size, session]
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._spill = None
+        if spill is not None:
+            self._spill = dbm.open(spill, 'c')
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, who):
+        key = session_key(who)
+        with self._lock:
+            if key in self._sessions:
+                return True
+            return self._spill is not None and key.encode('utf-8') in self._spill
+
+    def __getitem__(self, who):
+        return self.get(who)
+
+    def __setitem__(self, who, session):
+        key = session_key(who)
+        size = _sizeof(session)
+        with self._lock:
+            entry = self._sessions.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+            self._sessions[key] = [self.clock(), size, session]
+            self._bytes += size
+            self._evict(keep=key)
+
+    def __delitem__(self, who):
+        key = session_key(who)
+        with self._lock:
+            entry = self._sessions.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+            if self._spill is not None:
+                try:
+                    del self._spill[key.encode('utf-8')]
+                except KeyError:
+                    pass
+
+    def memory(self):
+        """
+        Approximate bytes used by the sessions in memory
+        """
+        with self._lock:
+            return self._bytes
+
+    def get(self, who):
+        """
+        Return who's session dictionary, creating it if needed
+        """
+        key = session_key(who)
+        now = self.clock()
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is not None and self._expired(entry[0], now):
+                del self[key]
+                entry = None
+            if entry is None:
+                size, session = self._load(key, now)
+                entry = [now, size, session]
+                self._sessions[key] = entry
+                self._bytes += size
+            else:
+                entry[0] = now
+                self._sessions.move_to_end(key)
+            self._evict(keep=key)
+            return entry[2]
+
+    def _expired(self, used, now):
+        return self.ttl is not None and now - used > self.ttl
+
+    def _load(self, key, now):
+        if self._spill is None:
+            return 0, {}
+        dbkey = key.encode('utf-8')
+        try:
+            data = self._spill[dbkey]
+        except KeyError:
+            return 0, {}
+        del self._spill[dbkey]
+        used, session = pickle.loads(data)
+        if self._expired(used, now):
+            return 0, {}
+        # close enough to what _sizeof would say, without pickling again
+        return len(data), session
+
+    def _evict(self, keep=None):
+        while len(self._sessions) > self.max_sessions or \
+              (self.max_bytes is not None and self._bytes > self.max_bytes):
+            key = next(iter(self._sessions))
+            if key == keep:
+                break
+            self._remove(key, spill=True)
+
+    def _remove(self, key, spill):
+        used, size, session = self._sessions.pop(key)
+        self._bytes -= size
+        if spill and self._spill is not None:
+            self._spill[key.encode('utf-8')] = pickle.dumps(
+                (used, session), pickle.HIGHEST_PROTOCOL)
+
+    def prune(self):
+        """
+        Throw away sessions that have been idle for more than ttl seconds
+
+        Both the ones in memory and the ones spilled to disk.
+        """
+        if self.ttl is None:
+            return 0
+        cutoff = self.clock() - self.ttl
+        removed = 0
+        with self._lock:
+            while self._sessions:
+                key, entry = next(iter(self._sessions.items()))
+                if entry[0] >= cutoff:
+                    break
+                self._remove(key, spill=False)
+                removed += 1
+            if self._spill is not None:
+                for dbkey in list(self._spill.keys()):
+                    used, session = pickle.loads(self._spill[dbkey])
+                    if used < cutoff:
+                        del self._spill[dbkey]
+                        removed += 1
+        return removed
+
+    def close(self):
+        """
+        Save everything in memory to the spill file, if there is one
+        """
+        with self._lock:
+            if self._spill is not None:
+                for key in list(self._sessions):
+                    self._remove(key, spill=True)
+                self._spill.close()
+                self._spill = None
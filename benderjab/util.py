@@ -3,6 +3,7 @@
 # This software is covered by the GNU Lesser Public License 2.1
 #
 import configparser
+import functools
 from getpass import getpass
 import os
 import socket
@@ -19,11 +20,21 @@ def toJID(jid):
   :Parameters:
     - `jid`: something that looks like a jabber id
   """
-  if type(jid) in str:
-    return xmpp.protocol.JID(jid)
+  if isinstance(jid, str):
+    return _parse_jid(jid)
   else:
     return jid
 
+@functools.lru_cache(maxsize=4096)
+def _parse_jid(jid):
+  """
+  Parse jid strings, remembering the most recently used ones
+
+  The same JID object is handed out for the same string, so don't
+  modify what toJID returns.
+  """
+  return xmpp.protocol.JID(jid)
+
 def get_checked_password(jid, password=None):
   """
   Prompt for a password twice and make sure they match
@@ -68,7 +79,7 @@ def get_config(profile=None, filename='~/.benderjab'):
   default={'jid':'romeo@montague.net','password':'juliet'}
   config = configparser.RawConfigParser()
 
-  if type(filename) in str:
+  if isinstance(filename, str):
     config_file = os.path.expanduser(filename)
     if not os.access(config_file,os.R_OK):
       # make a default file and exit
@@ -0,0 +1,165 @@
+#
+# Copyright 2007 Diane Trout
+# This software is covered by the GNU Lesser Public License 2.1
+#
+"""Run bot work off of the xmpp processing thread
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+class OrderedWorkerPool(object):
+    """
+    Thread pool that keeps jobs for the same key in order
+
+    Jobs submitted with the same key run one at a time in the order
+    they were submitted, so their callbacks fire in order too. Jobs for
+    different keys run concurrently.
+
+    At most max_pending jobs may be queued or running, submit blocks
+    until a slot frees up which pushes back on whoever is feeding us.
+    Exceptions from jobs are logged to log, this module's logger by
+    default.
+    """
+    def __init__(self, workers, max_pending=None, log=None):
+        if max_pending is None:
+            max_pending = workers * 4
+        self.workers = workers
+        self.log = log or logging.getLogger(__name__)
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='benderjab')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._pending = 0
+
+    def _get_pending(self):
+        return self._pending
+    pending = property(_get_pending, doc="number of jobs queued or running")
+
+    def submit(self, key, func, callback):
+        """
+        Queue func() to run, and then pass its result to callback
+
+        Both func and callback run on a worker thread.
+        """
+        self._slots.acquire()
+        with self._lock:
+            self._pending += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                # something is already running for key, it'll pick this up
+                queue.append((func, callback))
+                return
+            self._queues[key] = deque()
+        self.executor.submit(self._run, key, func, callback)
+
+    def _run(self, key, func, callback):
+        while True:
+            try:
+                callback(func())
+            except Exception as e:
+                self.log.exception("Exception in worker: %s", e)
+            finally:
+                self._slots.release()
+
+            with self._lock:
+                self._pending -= 1
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                func, callback = queue.popleft()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+class LimitedWorkerPool(object):
+    """
+    Thread pool with optional per-name concurrency limits
+
+    Jobs are submitted under a name, at most limits[name] jobs with that
+    name run at once and the rest wait their turn without tying up a
+    worker thread. Names without a limit only compete for workers.
+
+    submit refuses new jobs once max_pending are queued or running.
+    Exceptions from jobs are logged like OrderedWorkerPool's.
+    """
+    def __init__(self, workers, max_pending=None, log=None):
+        if max_pending is None:
+            max_pending = workers * 4
+        self.workers = workers
+        self.log = log or logging.getLogger(__name__)
+        self.max_pending = max_pending
+        self.limits = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='benderjab')
+        self._lock = threading.Lock()
+        self._running = {}
+        self._waiting = {}
+        self._pending = 0
+
+    def set_limit(self, name, limit):
+        """
+        Allow at most limit concurrent jobs for name, None for no limit
+        """
+        with self._lock:
+            if limit is None:
+                self.limits.pop(name, None)
+            else:
+                self.limits[name] = limit
+
+    def depth(self, name=None):
+        """
+        Number of jobs queued or running, optionally just for name
+        """
+        with self._lock:
+            if name is None:
+                return self._pending
+            return self._running.get(name, 0) + \
+                   len(self._waiting.get(name, ()))
+
+    def submit(self, name, func, callback):
+        """
+        Queue func() to run and pass its result to callback
+
+        Returns False without queuing anything if the pool is full.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+            limit = self.limits.get(name)
+            running = self._running.get(name, 0)
+            if limit is not None and running >= limit:
+                self._waiting.setdefault(name, deque()).append(
+                    (func, callback))
+                return True
+            self._running[name] = running + 1
+        self.executor.submit(self._run, name, func, callback)
+        return True
+
+    def _run(self, name, func, callback):
+        while True:
+            try:
+                callback(func())
+            except Exception as e:
+                self.log.exception("Exception in worker: %s", e)
+
+            with self._lock:
+                self._pending -= 1
+                waiting = self._waiting.get(name)
+                if not waiting:
+                    self._running[name] -= 1
+                    if self._running[name] == 0:
+                        del self._running[name]
+                    return
+                # keep our slot for name and run the next waiting job
+                func, callback = waiting.popleft()
+                if not waiting:
+                    del self._waiting[name]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
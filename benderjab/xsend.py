@@ -3,10 +3,14 @@
 # Copyright 2007 Diane Trout
 # This software is covered by the GNU Lesser Public License 2.1
 #
+import atexit
+import json
 import optparse
 import os
 import random
+import select
 import sys
+import threading
 import time
 
 import xmpp
@@ -52,14 +56,84 @@ def connect(profile=None):
 
   return cl
 
-def send(tojid, text, profile=None):
+# profile -> authenticated client kept around by get_client
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _is_alive(cl):
+    """
+    Check a pooled client is still usable
+
+    Nobody reads from an idle pooled connection, so this also drains
+    whatever the server sent in the meantime.
+    """
+    if not cl.isConnected():
+        return False
+    try:
+        return bool(cl.Process(0))
+    except Exception:
+        return False
+
+def get_client(profile=None):
+    """
+    Return an authenticated client for profile, reusing an earlier one
+
+    Pooled clients stay connected until close_clients is called (which
+    happens automatically at exit) so bulk senders only pay for
+    connecting and authenticating once.
+    """
+    with _clients_lock:
+        cl = _clients.get(profile)
+        if cl is not None:
+            if _is_alive(cl):
+                return cl
+            # don't leak the dead connection's socket
+            del _clients[profile]
+            try:
+                cl.disconnect()
+            except Exception:
+                pass
+
+        cl = connect(profile)
+        if cl is None:
+            return None
+        if not _clients:
+            atexit.register(close_clients)
+        _clients[profile] = cl
+        return cl
+
+def close_clients():
+    """
+    Disconnect every pooled client
+    """
+    with _clients_lock:
+        while _clients:
+            profile, cl = _clients.popitem()
+            try:
+                cl.disconnect()
+            except Exception:
+                pass
+        atexit.unregister(close_clients)
+
+def send(tojid, text, profile=None, keep_alive=False):
   """Quickly send a jabber message tojid
 
   :Parameters:
     - `tojid`: The Jabber ID to send to
     - `text`: a string containing the message to send
     - `profile`: which set of credentials to use from the config file
+    - `keep_alive`: reuse a pooled connection for profile instead of
+                    connecting and disconnecting for this message
   """
+  if keep_alive:
+    cl = get_client(profile)
+    if cl is None:
+      raise IOError("unable to connect, no credentials for profile " +
+                    str(profile))
+    with _clients_lock:
+      cl.send(xmpp.protocol.Message(tojid,text))
+    return
+
   cl = connect(profile)
   # we logged in, so we can send a message
   cl.send(xmpp.protocol.Message(tojid,text))
@@ -67,21 +141,219 @@ def send(tojid, text, profile=None):
   # hang up politely
   cl.disconnect()
 
+def parse_stream_line(line):
+    """
+    Parse one line of a message stream into (jid, message)
+
+    Lines are either jid<TAB>message or a JSON object with "to" and
+    "message" keys.
+    """
+    line = line.rstrip('\r\n')
+    if line.lstrip().startswith('{'):
+        record = json.loads(line)
+        return record['to'], record['message']
+    tojid, tab, message = line.partition('\t')
+    if not tab or not tojid:
+        raise ValueError("expected jid<TAB>message")
+    return tojid, message
+
+def send_many(messages, profile=None, rate=None, errors=None):
+    """
+    Send (jid, message) pairs over a single pooled connection
+
+    :Parameters:
+      - `messages`: iterable of (jid, message) tuples
+      - `profile`: which set of credentials to use from the config file
+      - `rate`: maximum messages per second, None for as fast as possible
+      - `errors`: optional file to report failures to
+
+    Returns a (delivered, failed) tuple of counts.
+    """
+    delivered = 0
+    failed = 0
+    interval = 0
+    if rate:
+        interval = 1.0 / rate
+    next_send = time.time()
+
+    for tojid, message in messages:
+        if interval:
+            delay = next_send - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_send = max(next_send, time.time()) + interval
+        try:
+            cl = get_client(profile)
+            if cl is None:
+                raise IOError("no credentials for profile %s" % (profile,))
+            with _clients_lock:
+                cl.send(xmpp.protocol.Message(tojid, message))
+            if not cl.isConnected():
+                raise IOError("connection dropped")
+            delivered += 1
+        except Exception as e:
+            failed += 1
+            if errors is not None:
+                errors.write("failed sending to %s: %s\n" % (tojid, str(e)))
+    return delivered, failed
+
+class MessageStream(object):
+    """
+    Iterate over the (jid, message) pairs in a file of stream lines
+
+    Pass a different parse_line to read some other line format.
+
+    Lines that can't be parsed are reported to errors, skipped and
+    counted in bad_lines.
+    """
+    def __init__(self, stream, errors=None, parse_line=parse_stream_line):
+        self.stream = stream
+        self.errors = errors
+        self.bad_lines = 0
+        self.parse_line = parse_line
+
+    def __iter__(self):
+        for lineno, line in enumerate(self.stream, 1):
+            if not line.strip():
+                continue
+            try:
+                yield self.parse_line(line)
+            except (ValueError, KeyError) as e:
+                if self.errors is not None:
+                    self.errors.write("line %d: %s\n" % (lineno, str(e)))
+                self.bad_lines += 1
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it's there, it just isn't ours
+        return True
+    return True
+
+def _pidfd_open(pid):
+    """
+    Return a file descriptor that becomes readable when pid exits
+
+    Returns None if pidfds aren't available, raises ProcessLookupError
+    if pid is already gone.
+    """
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except ProcessLookupError:
+        raise
+    except OSError:
+        return None
+
+def wait_for_pids(pids, timeout=10):
+    """
+    Yield each of pids as soon as that process exits
+
+    On Linux this waits on pidfds so it wakes up exactly when a process
+    exits. Elsewhere it polls, starting at 0.1 seconds between checks
+    and backing off to at most timeout seconds.
+    """
+    # pidfds need poll, which not every platform has
+    poller = None
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+    watched = {}
+    polled = set()
+    try:
+        for pid in pids:
+            try:
+                fd = None
+                if poller is not None:
+                    fd = _pidfd_open(pid)
+            except ProcessLookupError:
+                yield pid
+                continue
+            if fd is None:
+                polled.add(pid)
+            else:
+                watched[fd] = pid
+                poller.register(fd, select.POLLIN)
+
+        interval = 0.1
+        next_check = time.time() + interval
+        while watched or polled:
+            wait = None
+            if polled:
+                wait = max(0, next_check - time.time())
+            if not watched:
+                time.sleep(wait)
+            else:
+                if wait is not None:
+                    wait *= 1000
+                for fd, event in poller.poll(wait):
+                    poller.unregister(fd)
+                    os.close(fd)
+                    yield watched.pop(fd)
+
+            if polled and time.time() >= next_check:
+                for pid in [p for p in polled if not _pid_exists(p)]:
+                    polled.discard(pid)
+                    yield pid
+                interval = min(interval * 2, timeout)
+                next_check = time.time() + interval
+    finally:
+        for fd in watched:
+            os.close(fd)
+
 def wait_for_pid(pid, timeout=10):
     """
     Wait for a process id to disappear before returning
 
     pid is the process id to watch
-    time out is how long in seconds to wait between polls
+    time out is the longest we'll wait between polls if we can't
+    get notified when the process exits
     """
+    for exited in wait_for_pids([pid], timeout):
+        pass
 
-    while True:
-        try:
-            os.kill(pid, 0)
-        except OSError as e:
-            # there is no PID, return
-            return
-        time.sleep(timeout)
+def parse_watch_line(line):
+    """
+    Parse an --on-exit stream line into (pid, jid, message)
+
+    Lines are either pid<TAB>jid<TAB>message or a JSON object with
+    "pid", "to" and "message" keys.
+    """
+    line = line.rstrip('\r\n')
+    if line.lstrip().startswith('{'):
+        record = json.loads(line)
+        return int(record['pid']), record['to'], record['message']
+    pid, tab, rest = line.partition('\t')
+    tojid, message = parse_stream_line(rest)
+    return int(pid), tojid, message
+
+def send_on_exit(watches, profile=None, timeout=10, errors=None):
+    """
+    Send each message once its process exits
+
+    :Parameters:
+      - `watches`: iterable of (pid, jid, message) tuples, a pid
+                   may be listed more than once
+      - `profile`: which set of credentials to use from the config file
+      - `timeout`: longest time between polls, if we have to poll
+      - `errors`: optional file to report failures to
+
+    Returns a (delivered, failed) tuple of counts.
+    """
+    by_pid = {}
+    for pid, tojid, message in watches:
+        by_pid.setdefault(pid, []).append((tojid, message))
+
+    delivered = 0
+    failed = 0
+    for pid in wait_for_pids(list(by_pid), timeout):
+        sent, lost = send_many(by_pid.pop(pid), profile, errors=errors)
+        delivered += sent
+        failed += lost
+    return delivered, failed
 
 def make_parser():
     usage = "%prog: [options] jabber-id message..."
@@ -90,13 +362,57 @@ def make_parser():
     parser.add_option('--wait-for-pid', type='int',
            help="Wait for a process ID to exit before sending message",
            default=None)
+    parser.add_option('--profile', default=None,
+           help="which section of the config file to use")
+    parser.add_option('--stream', default=None, metavar='FILE',
+           help="send every jid<TAB>message (or JSON) line in FILE, "
+                "use - for stdin")
+    parser.add_option('--rate', type='float', default=None,
+           help="maximum messages per second when streaming")
+    parser.add_option('--on-exit', action='store_true', default=False,
+           help="stream lines are pid<TAB>jid<TAB>message (or JSON with "
+                "a pid), send each message when its process exits")
 
     return parser
 
+def stream_main(opt):
+    if opt.stream == '-':
+        stream = sys.stdin
+    else:
+        stream = open(opt.stream)
+
+    if opt.on_exit:
+        messages = MessageStream(stream, sys.stderr, parse_watch_line)
+    else:
+        messages = MessageStream(stream, sys.stderr)
+    start = time.time()
+    try:
+        if opt.on_exit:
+            delivered, failed = send_on_exit(list(messages), opt.profile,
+                                             errors=sys.stderr)
+        else:
+            delivered, failed = send_many(messages, opt.profile, opt.rate,
+                                          sys.stderr)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        close_clients()
+    failed += messages.bad_lines
+    elapsed = time.time() - start
+
+    sys.stderr.write("delivered %d, failed %d in %0.1f seconds\n" % (
+        delivered, failed, elapsed))
+    return failed and 1 or 0
+
 def main(cmdline=None):
     parser = make_parser()
     opt, args = parser.parse_args(cmdline)
 
+    if opt.stream is not None:
+        if opt.wait_for_pid is not None:
+            wait_for_pid(opt.wait_for_pid)
+        return stream_main(opt)
+
     if len(args) < 2:
         parser.error("Need JabberID and a message")
 
@@ -107,7 +423,7 @@ def main(cmdline=None):
     tojid=args[1]
     message=' '.join(args[2:])
 
-    send(tojid, message)
+    send(tojid, message, opt.profile)
     return 0
 
 if __name__ == "__main__":
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
+import copy
 import os
 import re
 import sys
 
 import aiml
 
-from benderjab.benderjab import BenderFactory
+from benderjab.bot import BenderJab
 
 class AimlBot(object):
   def __init__(self, startup, brain=None, commands=None):
@@ -84,13 +85,40 @@ class AimlBot(object):
     return rootname+".brn"
 
 
-class parser(object):
-  def __init__(self, startup, brainfile):
-    self.bot = AimlBot(startup, brainfile)
+class AimlJabberBot(BenderJab):
+  def __init__(self, startup, brainfile=None):
+    super(AimlJabberBot, self).__init__('demobot')
+    self.aiml = AimlBot(startup, brainfile)
+    self.parser = self.respond
 
-  def __call__(self, s, who):
-    return self.bot.respond(s, str(who))
+  # every user's predicates are swapped into this one kernel session, so
+  # the kernel doesn't keep a session per user on top of self.sessions
+  KERNEL_SESSION = 'benderjab'
+  # what a new kernel session starts with besides its predicates
+  FRESH_SESSION = ('_inputHistory', '_outputHistory', '_inputStack')
 
+  def respond(self, s, who):
+    """Answer with the AIML kernel
+
+    The kernel's per user predicates are kept in self.sessions between
+    messages so they get evicted along with everything else about who.
+    """
+    session = self.sessions[who]
+    sid = self.KERNEL_SESSION
+    kernel = self.aiml.kernel
+    saved = session.get('aiml', {})
+    # unset predicates read as '', so that clears the last user's
+    for name in kernel.getSessionData(sid):
+      if name not in saved:
+        kernel.setPredicate(name, [] if name in self.FRESH_SESSION else '',
+                            sid)
+    for name, value in saved.items():
+      kernel.setPredicate(name, copy.deepcopy(value), sid)
+    try:
+      return self.aiml.respond(s, sid)
+    finally:
+      session['aiml'] = copy.deepcopy(kernel.getSessionData(sid))
+      self.sessions[who] = session
 
 def main(args):
   if len(args) < 1:
@@ -101,12 +129,10 @@ def main(args):
   if len(args) == 2:
     brainfile = args[1]
 
-  bot = BenderFactory('demobot')
-  bot.parser = parser(startup, brainfile)
+  bot = AimlJabberBot(startup, brainfile)
   if brainfile is not None:
-    bot.parser.cacheBrain()
-  bot.logon()
-  bot.eventLoop()
+    bot.aiml.cacheBrain()
+  bot.main([])
   return 0
 
 if __name__ == "__main__":
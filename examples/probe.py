@@ -5,22 +5,16 @@ and wanted an easier way to try some of their examples.
 """
 from lxml.etree import fromstring, dump
 import xmpp
-import shlex
 from benderjab import bot
 from benderjab.util import get_config, toJID
 from benderjab.bargparse import BotArgumentParser
 
 from dice2 import dice
 
-SUBPARSER = 'subparser'
-
 class ProbeBot(bot.BenderJab):
     def __init__(self, *args, **kwargs):
         super(ProbeBot, self).__init__(*args, **kwargs)
         self.argparse = BotArgumentParser()
-        self.subparsers = self.argparse.add_subparsers()
-        helpparser = self.subparsers.add_parser('help')
-        helpparser.set_defaults(func=self.format_help)
 
     def logon(self, jid=None, password=None, resource=None):
         super(ProbeBot, self).logon(jid, password, resource)
@@ -28,9 +22,6 @@ class ProbeBot(bot.BenderJab):
         self.cl.RegisterHandler('iq', self.iqCB)
 
 
-    def list_commands(self, arg):
-        return "Available commands: " + ", ".join(list(self.commands.keys()))
-
     def messageCB(self, conn, msg):
         tree = fromstring(str(msg))
         dump(tree)
@@ -46,60 +37,37 @@ class ProbeBot(bot.BenderJab):
         tree = fromstring(str(stanza))
         dump(tree)
 
-    def format_help(self, args):
-        return self.argparse.format_help()
-
     def _parser(self, message, who):
         if message:
-            cmdline = shlex.split(message)
-            args = self.argparse.parse_args(cmdline)
-            print("args", args)
-            args.frm = who
-            if args.func:
-                return args.func(args)
-            return "Didn't understand:" + str(message)
-
-    def command(self, name, **kwargs):
-        def wrapper(func):
-            if not hasattr(func, SUBPARSER):
-                func.subparser = self.subparsers.add_parser(name, **kwargs)
-                func.subparser.prog = name
-                func.subparser.set_defaults(func=func)
-                func.subparser.set_defaults(bot=self)
-            return func
-        return wrapper
-
-    def argument(self, *args, **kwargs):
-        def wrapper(func):
-            if not hasattr(func, SUBPARSER):
-                raise RuntimeError("Please use bot.command first")
-            func.subparser.add_argument(*args, **kwargs)
-            return func
-        return wrapper
+            return self.argparse.dispatch(message, frm=who, bot=self)
 
 bot = ProbeBot()
-@bot.argument('strings', nargs='*', help='echo some text back')
-@bot.command('echo', help="return your message")
+commands = bot.argparse
+@commands.command('help', help="list commands")
+def show_help(args):
+    return args.bot.argparse.format_help()
+
+@commands.argument('strings', nargs='*', help='echo some text back')
+@commands.command('echo', help="return your message")
 def echo(args):
     if args.strings:
         return 'You sent:'+' '.join((str(s) for s in args.strings))
     return 'Nothing! You sent Nothing!'
 
-@bot.argument('dice', nargs='*', type=str,
+@commands.argument('dice', nargs='*', type=str,
               help='Specify a die formula. e.g. 2d4 + 2')
-@bot.command('roll', help="Roll D&D-esque dice")
+@commands.command('roll', help="Roll D&D-esque dice")
 def roll(args):
     if args.dice:
         return dice(' '.join(args.dice))
-    parser = getattr(roll, SUBPARSER)
-    return parser.format_usage()
+    return roll.subparser.format_usage()
 
-@bot.argument('-w', '--who', help="specify JID to query")
-@bot.argument('--node', nargs=1, help="specify a node attribute")
-@bot.command('disco-items', help="send a disco#items query")
-def disco_info(args):
+@commands.argument('-w', '--who', help="specify JID to query")
+@commands.argument('--node', nargs=1, help="specify a node attribute")
+@commands.command('disco-items', help="send a disco#items query")
+def disco_items(args):
     if not args.who:
-        return self.subparser.format_usage()
+        return disco_items.subparser.format_usage()
     who = toJID(args.who)
     q = xmpp.Iq(typ="get",
                 queryNS='http://jabber.org/protocol/disco#items',
@@ -109,12 +77,12 @@ def disco_info(args):
     args.bot.cl.send(q)
     return "Sent items query"
 
-@bot.argument('-w', '--who', help="specify JID to query")
-@bot.argument('--node', nargs=1, help="specify a node attribute")
-@bot.command('disco-info', help="send a disco#info query")
+@commands.argument('-w', '--who', help="specify JID to query")
+@commands.argument('--node', nargs=1, help="specify a node attribute")
+@commands.command('disco-info', help="send a disco#info query")
 def disco_info(args):
     if not args.who:
-        return self.subparser.format_usage()
+        return disco_info.subparser.format_usage()
     who = toJID(args.who)
 
     q = xmpp.Iq(typ="get",
@@ -128,7 +96,7 @@ def disco_info(args):
     args.bot.cl.send(q)
     return "Sent info query"
 
-@bot.command('form', help="send me a form")
+@commands.command('form', help="send me a form")
 def form(args):
     form = '''<captcha xmlns="urn:xmpp:captcha">
         <x xmlns="jabber:x:data" type="form">
@@ -151,16 +119,14 @@ def form(args):
     args.bot.cl.send(f)
     return "I hope you like it"
 
-@bot.command('who', help="list who is online")
+@commands.command('who', help="list who is online")
 def who(args):
-    roster = args.bot.cl.getRoster()
+    presence = args.bot.presence
     reply = []
-    for jid in list(roster.keys()):
-        resources = roster.getResources(jid)
-        if resources:
-            reply.append(str(jid))
-            for resource in resources:
-                reply.append(str('\t'+jid+'/'+resource))
+    for jid in presence.online():
+        reply.append(jid)
+        for resource in sorted(presence.resources(jid)):
+            reply.append('\t' + jid + '/' + resource)
 
     return "\n".join(reply)
 
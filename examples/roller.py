@@ -3,32 +3,28 @@
 # Copyright 2007 Diane Trout
 # This software is covered by the GNU Lesser Public License 2.1
 #
-import re
 import sys
 
 from benderjab.bot import BenderJab
+from benderjab.commands import command
 
 # this came from the pyparsing wiki http://pyparsing.wikispaces.com/Examples
 # slightly modified
 import dice2
 
-def parser(s, who=None):
-  try:
-    if re.match("roll", s):
-      return dice2.dice(s[4:])
-  except Exception as e:
-    return "failed:"+str(e)
+class RollerBot(BenderJab):
+  @command('roll', help="roll dice, e.g. roll 2d10 + 3")
+  def roll(self, args, who):
+    try:
+      return dice2.dice(args)
+    except Exception as e:
+      return "failed:"+str(e)
 
-def loop_reporter():
-  print(".")
-
-def main():
-  bot = BenderJab('bender@ghic.org')
-  bot.parser = parser
-  #bot.eventTasks.append(loop_reporter)
-  bot.logon()
-  bot.eventLoop()
+def main(args=None):
+  args = sys.argv if args is None else args
+  bot = RollerBot()
+  bot.main(args[1:])
   return 0
 
 if __name__ == "__main__":
-  sys.exit(main())
+  sys.exit(main(sys.argv))
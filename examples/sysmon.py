@@ -3,13 +3,14 @@
 # Copyright 2007 Diane Trout
 # This software is covered by the GNU Lesser Public License 2.1
 #
-import re
 import sys
-import xmpp
+import time
 
 from benderjab.bot import BenderJab
+from benderjab.commands import command
 
 def main(args=None):
+    args = sys.argv if args is None else args
     bot = SysmonBot()
     bot.main(args[1:])
     return 0
@@ -17,27 +18,26 @@ def main(args=None):
 class SysmonBot(BenderJab):
     def __init__(self):
         super(SysmonBot, self).__init__()
+        # the load changes all the time, don't tell everyone every time
+        self.cfg['presence_debounce'] = 60
+        # show we last published, '' before the first one
+        self._load_show = ''
 
-        self.presence = ''
         self.eventTasks.append(SysmonBot.update_load)
     
-    def _parser(self, message, who=None):
-        reply = ""
+    @command('uptime', help="show the load average")
+    def uptime(self, args, who):
+        return read_linux_uptime()
 
-        try:
-            if re.match("uptime", message, re.IGNORECASE):
-                reply = read_linux_uptime()
-            elif re.match("time", message, re.IGNORECASE):
-                reply = "Server time is "+time.asctime()
-            elif re.match("unknown command", message, re.IGNORECASE):
-                reply = ''
-            else:
-                reply = "Unknown command", message
-        except Exception as e:
-            return "failed:"+str(e)
+    @command('time', help="show the server's time")
+    def server_time(self, args, who):
+        return "Server time is "+time.asctime()
+
+    @command('unknown')
+    def unknown(self, args, who):
+        # don't argue with other bots
+        return ''
 
-        return reply
-    
     def update_load(self):
         loadavg = read_linux_uptime()
         one,five,fifteen,process = parse_uptime(loadavg)
@@ -48,11 +48,14 @@ class SysmonBot(BenderJab):
         elif one > 1.0:
             presence = 'away'
         else:
-            presence = ''
-            
-        if self.presence != presence:
-            self.presence = presence
-            bot.cl.send(xmpp.Presence(show=presence, status=loadavg))
+            presence = None
+
+        # the status is different every time, so only publish when the
+        # load moves to a different show
+        if presence == self._load_show:
+            return
+        self._load_show = presence
+        self.presence.publish(show=presence, status=loadavg)
 
 def read_linux_uptime():
   """So I don't have to keep retyping /proc/loadavg
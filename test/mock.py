@@ -1,9 +1,175 @@
+import select
+import socket
+import socketserver
+import threading
+import unittest
+
+import xmpp
+
+class FakeClock(object):
+    """Clock that only moves when a test changes now
+    """
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class LoggingTestCase(unittest.TestCase):
+    """TestCase that stops the log threads of the bots it set up
+
+    Use self.configure_logging(bot) instead of bot.configure_logging().
+    """
+    def setUp(self):
+        self._logging_bots = []
+
+    def tearDown(self):
+        for b in self._logging_bots:
+            b._stop_logging()
+
+    def configure_logging(self, b):
+        b.configure_logging()
+        self._logging_bots.append(b)
+
 class MockClient(object):
     """Mock a XMPP client
     """
     def __init__(self):
         self.msgs = []
+        self.callbacks = []
 
     def send(self, msg):
         self.msgs.append(msg)
 
+    def SendAndCallForResponse(self, stanza, func, args={}):
+        self.msgs.append(stanza)
+        self.callbacks.append((stanza, func, args))
+
+class MockConnection(object):
+    """Mock the transport part of a XMPP client
+    """
+    def __init__(self, sock):
+        self._sock = sock
+
+class SocketClient(MockClient):
+    """Mock a XMPP client that reads message bodies from a socket
+
+    Each line written to remote becomes a chat message from sender.
+    """
+    def __init__(self, bot, sender):
+        super(SocketClient, self).__init__()
+        self.bot = bot
+        self.sender = sender
+        self.remote, local = socket.socketpair()
+        self.Connection = MockConnection(local)
+
+    def Process(self, timeout=0):
+        if not select.select([self.Connection._sock], [], [], timeout)[0]:
+            return '0'
+        data = self.Connection._sock.recv(4096)
+        if not data:
+            return 0
+        for body in data.decode('utf-8').splitlines():
+            msg = xmpp.protocol.Message(self.bot.jid, body=body, typ='chat',
+                                        frm=self.sender)
+            self.bot.messageCB(self, msg)
+        return len(data)
+
+    def close(self):
+        self.remote.close()
+        self.Connection._sock.close()
+
+class MockSSLObject(object):
+    """Mock a TLS socket holding decrypted data we haven't read yet
+    """
+    def __init__(self, buffered):
+        self.buffered = buffered
+
+    def pending(self):
+        return sum(len(body) for body in self.buffered)
+
+class TLSClient(MockClient):
+    """Mock a XMPP client whose TLS layer already has messages buffered
+
+    Process only reads one of them each time it's called.
+    """
+    def __init__(self, bot, sender, bodies):
+        super(TLSClient, self).__init__()
+        self.bot = bot
+        self.sender = sender
+        self.Connection = MockConnection(None)
+        self.Connection._sslObj = MockSSLObject(list(bodies))
+
+    def Process(self, timeout=0):
+        buffered = self.Connection._sslObj.buffered
+        if buffered:
+            msg = xmpp.protocol.Message(self.bot.jid, body=buffered.pop(0),
+                                        typ='chat', frm=self.sender)
+            self.bot.messageCB(self, msg)
+        return '0'
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib to deliver mail to an SMTPSink
+    """
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 sink ready')
+        sender = None
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self.reply('250 sink')
+            elif verb == 'MAIL':
+                sender = command.split(':', 1)[1].strip()
+                recipients = []
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip())
+                self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b'.\r\n':
+                        break
+                    data.append(line)
+                with self.server.lock:
+                    self.server.messages.append(
+                        (sender, recipients, b''.join(data).decode('utf-8')))
+                self.reply('250 queued')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """Local SMTP server that keeps what it receives in messages
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 _SMTPHandler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+        self.host, self.port = self.server_address
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
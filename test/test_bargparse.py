@@ -0,0 +1,69 @@
+import unittest
+
+from benderjab.bargparse import BotArgumentParser
+from benderjab.exceptions import BenderJabBaseError
+
+class TestBotArgumentParser(unittest.TestCase):
+    def setUp(self):
+        self.parser = BotArgumentParser()
+
+        @self.parser.argument('words', nargs='*')
+        @self.parser.argument('--loud', action='store_true')
+        @self.parser.command('echo', help="say it back")
+        def echo(args):
+            text = ' '.join(args.words)
+            if args.loud:
+                text = text.upper()
+            return args.frm + ': ' + text
+        self.echo = echo
+
+    def test_dispatch(self):
+        self.assertEqual(self.parser.dispatch('echo a "b c"', frm='me'),
+                         'me: a b c')
+        self.assertEqual(self.parser.dispatch('echo --loud hi', frm='me'),
+                         'me: HI')
+        self.assertEqual(self.parser.dispatch('', frm='me'),
+                         self.parser.format_usage())
+        self.assertRaises(BenderJabBaseError, self.parser.dispatch, 'nope')
+        self.assertRaises(BenderJabBaseError, self.parser.dispatch,
+                          'echo --quiet')
+
+        def orphan(args):
+            pass
+        self.assertRaises(RuntimeError, self.parser.argument('-x'), orphan)
+
+    def test_cached_help(self):
+        usage = self.parser.format_usage()
+        help = self.parser.format_help()
+        self.assertTrue(self.parser.format_help() is help)
+        self.assertTrue(self.echo.subparser.format_help() is
+                        self.echo.subparser.format_help())
+
+        # adding a command changes the help
+        @self.parser.command('roll', help="roll dice")
+        def roll(args):
+            return 'rolled'
+        self.assertTrue('roll' in self.parser.format_help())
+        self.assertTrue('roll' in self.parser.format_usage())
+
+        # and so does adding an argument
+        self.parser.add_argument('--verbose', action='store_true')
+        self.assertTrue('--verbose' in self.parser.format_help())
+
+    def test_defaults(self):
+        self.parser.set_defaults(color='blue')
+        args = self.parser.parse_args(['echo'])
+        self.assertEqual(args.color, 'blue')
+        self.assertEqual(args.words, [])
+        self.parser.set_defaults(color='red')
+        self.assertEqual(self.parser.parse_args(['echo']).color, 'red')
+
+    def test_version(self):
+        parser = BotArgumentParser(version='1.0')
+        self.assertTrue('--version' in parser.format_help())
+
+def suite():
+    return unittest.makeSuite(TestBotArgumentParser)
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
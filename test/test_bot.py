@@ -1,17 +1,23 @@
+import asyncio
+import logging
 import socket
+import threading
+import time
 import types
 import unittest
 from io import StringIO
 
 from benderjab import bot
 from benderjab import util
+from benderjab.workers import LimitedWorkerPool, OrderedWorkerPool
 import xmlrpc.client
 
 import xmpp
 
-from .mock import MockClient
+from .mock import LoggingTestCase, MockClient, SocketClient, SMTPSink, \
+    TLSClient
 
-class TestBot(unittest.TestCase):
+class TestBot(LoggingTestCase):
     def test_getter_setters(self):
         """
         Somewhat unnecessary testing of get/set
@@ -26,6 +32,17 @@ class TestBot(unittest.TestCase):
         b.resource = 'resource'
         self.failUnlessEqual(b.resource, r)
 
+    def test_jid_cache(self):
+        self.assertTrue(util.toJID('user@example.fake') is
+                        util.toJID('user@example.fake'))
+        b = bot.BenderJab()
+        self.assertEqual(b.jid, None)
+        b.cfg['jid'] = 'bot@example.fake'
+        jid = b.jid
+        self.assertTrue(b.jid is jid)
+        b.cfg['jid'] = 'other@example.fake'
+        self.assertEqual(str(b.jid), 'other@example.fake')
+
     def test_filename_macro(self):
         """
         Make sure the log & pid file macro expansion works right
@@ -67,13 +84,46 @@ class TestBot(unittest.TestCase):
         self.failUnlessEqual(b.check_authorization(user2), True)
         self.failUnlessEqual(b.check_authorization(baduser), False)
 
+    def test_authorization_index(self):
+        b = bot.BenderJab()
+        user_list = "user1@example.fake/home *@trusted.example"
+        b.authorized_users = b._parse_user_list(user_list)
+        self.assertEqual(len(b.authorized_users), 2)
+        self.assertTrue(b.check_authorization(util.toJID('user1@example.fake/work')))
+        self.assertTrue(b.check_authorization(util.toJID('User1@Example.fake')))
+        self.assertTrue(b.check_authorization(util.toJID('anyone@trusted.example/x')))
+        self.assertFalse(b.check_authorization(util.toJID('user2@example.fake')))
+        self.assertFalse(b.check_authorization(util.toJID('trusted.example')))
+
+        # decisions are cached, and the cache is bounded
+        b.authorized_users.cache_size = 2
+        for i in range(5):
+            b.check_authorization('user%d@example.fake' % (i,))
+        self.assertEqual(list(b.authorized_users._cache),
+                         ['user3@example.fake', 'user4@example.fake'])
+
+    def test_reload_authorization(self):
+        config = StringIO("[bot]\njid=bot@example.fake\n"
+                          "authorized_users=user1@example.fake\n")
+        b = bot.BenderJab()
+        b.read_config('bot', config)
+        self.assertTrue(b.check_authorization(util.toJID('user1@example.fake')))
+
+        config.seek(0)
+        config.truncate()
+        config.write("[bot]\njid=bot@example.fake\n"
+                     "authorized_users=user2@example.fake\n")
+        b.on_sighup(None, None)
+        self.assertFalse(b.check_authorization(util.toJID('user1@example.fake')))
+        self.assertTrue(b.check_authorization(util.toJID('user2@example.fake')))
+
     def test_authorized_message(self):
         b = bot.BenderJab()
         b.jid = "bot@example.org"
         user_list = "user1@example.fake other@fake.example"
         b.authorized_users = b._parse_user_list(user_list)
         b.cl = MockClient()
-        b.configure_logging()
+        self.configure_logging(b)
 
         fromjid = util.toJID('user1@example.fake')
         tojid = util.toJID('random_user@example.fake')
@@ -104,12 +154,134 @@ class TestBot(unittest.TestCase):
                             users_bad,
                             require_resource=True)
 
+    def test_broadcast(self):
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cl = MockClient()
+        users = ['user%d@example.org' % (i,) for i in range(100)]
+
+        sink = SMTPSink()
+        b.cfg['smtpserver'] = sink.host
+        b.cfg['smtpport'] = sink.port
+        try:
+            count = b.broadcast(users + ['mailto:a@example.org',
+                                         'mailto:b@example.org'],
+                                'hi & bye')
+            b._close_mail_sender()
+        finally:
+            sink.close()
+        self.assertEqual(count, 102)
+        # 100 messages in two writes
+        self.assertEqual(len(b.cl.msgs), 2)
+        stanzas = xmpp.Node(node='<s>' + "".join(b.cl.msgs) + '</s>')
+        messages = stanzas.getTags('message')
+        self.assertEqual([m.getAttr('to') for m in messages], users)
+        self.assertEqual(messages[0].getTagData('body'), 'hi & bye')
+        self.assertEqual(sink.connections, 1)
+        self.assertEqual([m[1] for m in sink.messages],
+                         [['<a@example.org>'], ['<b@example.org>']])
+
+        b.cl = MockClient()
+        b.cfg['multicast_limit'] = 30
+        b.broadcast(users, 'hi', multicast='multicast.example.org')
+        self.assertEqual(len(b.cl.msgs), 4)
+        addresses = b.cl.msgs[0].getTag('addresses', namespace=xmpp.NS_ADDRESS)
+        self.assertEqual(len(addresses.getTags('address')), 30)
+        self.assertEqual(str(b.cl.msgs[0].getTo()), 'multicast.example.org')
+
+    def test_reconnect(self):
+        """Losing the connection should back off and hold messages
+        """
+        class FlakyBot(bot.BenderJab):
+            failures = 2
+            def logon(self):
+                if self.failures:
+                    self.failures -= 1
+                    raise RuntimeError("server down")
+                self.cl = MockClient()
+                return self.cl
+
+        class DeadConnection(object):
+            closed = False
+            def Process(self, timeout):
+                return None
+            def disconnect(self):
+                self.closed = True
+
+        b = FlakyBot()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cfg['reconnect_delay'] = 0.01
+        dead = b.cl = DeadConnection()
+        b.step(b.cl, 1)
+        self.assertTrue(b._reconnecting)
+        # the dead client's socket gets closed
+        self.assertTrue(dead.closed)
+        self.assertEqual(b.cl, None)
+        b.send('user@example.org', 'held')
+        b.broadcast(['a@example.org', 'b@example.org'], 'also held')
+        self.assertEqual(len(b._offline), 3)
+
+        start = time.time()
+        while b._reconnecting and time.time() - start < 5:
+            b.step(b.cl, 1)
+        self.assertFalse(b._reconnecting)
+        self.assertEqual(b.failures, 0)
+        # we announce our presence, then send what was held
+        self.assertTrue(isinstance(b.cl.msgs[0], xmpp.protocol.Presence))
+        held = b.cl.msgs[1:]
+        self.assertEqual([m.getBody() for m in held[:1]], ['held'])
+        self.assertEqual(len(held), 3)
+
+        # the delay doubles with each attempt, up to the maximum
+        b.cfg['reconnect_max_delay'] = 0.05
+        b._reconnect_attempts = 2
+        self.assertTrue(0.02 <= b._reconnect_delay() <= 0.04)
+        b._reconnect_attempts = 10
+        self.assertTrue(0.025 <= b._reconnect_delay() <= 0.05)
+
+    def test_reconnect_async(self):
+        """Only connecting happens off the event loop's thread
+        """
+        threads = {}
+        class HandlerClient(MockClient):
+            def RegisterHandler(self, *args, **kwargs):
+                pass
+        class AsyncBot(bot.BenderJab):
+            def _connect_client(self):
+                threads['connect'] = threading.current_thread()
+                return HandlerClient()
+            def logon(self):
+                threads['logon'] = threading.current_thread()
+                return super(AsyncBot, self).logon()
+
+        b = AsyncBot()
+        b.jid = 'bot@example.org'
+        b.cfg['password'] = 'secret'
+        b.cfg['roster'] = 'none'
+        self.configure_logging(b)
+        b._reconnecting = True
+        b._watch_connection = lambda: None
+
+        async def reconnect():
+            b._loop = asyncio.get_running_loop()
+            try:
+                await b._reconnect_async()
+            finally:
+                b._loop = None
+        asyncio.run(reconnect())
+        self.assertFalse(b._reconnecting)
+        self.assertTrue(isinstance(b.cl, MockClient))
+        self.assertTrue(threads['logon'] is threading.current_thread())
+        self.assertFalse(threads['connect'] is threading.current_thread())
+
     def test_presence(self):
         """Make sure presence subscription behaves reasonably
         """
         b = bot.BenderJab()
         b.jid = 'bot@example.org'
-        b.configure_logging()
+        self.configure_logging(b)
         b.cl = MockClient()
         who = 'someone@example.org'
 
@@ -120,6 +292,226 @@ class TestBot(unittest.TestCase):
         b.presenceCB(b.cl, xmpp.Presence(to=b.jid, frm=b.jid, typ='subscribe'))
         self.assertTrue(isinstance(b.cl.msgs[-1], xmpp.protocol.Presence))
 
+    def test_batched_presence(self):
+        """Subscription requests can be collected and answered together
+        """
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cl = MockClient()
+        b.cfg['subscription_batch'] = 60
+        b.cfg['subscription_batch_size'] = 2
+        b.cfg['subscriptions'] = 'authorized'
+        b.cfg['greeting_rate'] = 0.001
+        b.cfg['greeting_burst'] = 1
+        b.authorized_users = ['*@example.org']
+
+        for who in ('a@example.org', 'b@example.org/home',
+                    'mallory@elsewhere.fake', 'A@example.org/work'):
+            b.presenceCB(b.cl, xmpp.Presence(to=b.jid, frm=who,
+                                             typ='subscribe'))
+        # nothing goes out until the batch is due
+        self.assertEqual(b.cl.msgs, [])
+        self.assertEqual(len(b.scheduler), 1)
+
+        # a@example.org asked twice, so only three requests are answered
+        b._flush_subscriptions()
+        b._flush_subscriptions()
+        self.assertEqual(b._subscription_timer, None)
+        sent = "".join(b.cl.msgs)
+        self.assertEqual(sent.count('type="subscribed"'), 2)
+        self.assertEqual(sent.count('type="subscribe"'), 2)
+        self.assertEqual(sent.count('type="unsubscribed"'), 1)
+        self.assertTrue('to="mallory@elsewhere.fake"' in sent)
+        # only one greeting fits under the rate limit
+        self.assertEqual(sent.count('<message'), 1)
+
+    def test_subscription_replies_skip_queues(self):
+        """Subscription presence isn't rate limited or held offline
+        """
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cl = MockClient()
+        b.cfg['send_rate'] = 1
+        who = xmpp.JID('someone@example.org')
+        b._answer_subscriptions([(who, 'subscribe')])
+        self.assertEqual([m.getType() for m in b.cl.msgs],
+                         ['subscribed', 'subscribe'])
+        # the greeting waits its turn in the send queue
+        self.assertEqual(len(b._outbound), 1)
+
+        b.cl = MockClient()
+        b._reconnecting = True
+        b._answer_subscriptions([(who, 'subscribe')], batched=True)
+        self.assertEqual(b.cl.msgs, [])
+        self.assertEqual(len(b._offline), 1)
+
+    def test_coroutine_parser_blocking(self):
+        """A coroutine parser should still work with the polling loop
+        """
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cl = MockClient()
+
+        async def parser(message, who):
+            return "async " + message
+        b.parser = parser
+
+        msg = xmpp.protocol.Message(b.jid, body='hi', typ='chat',
+                                    frm='user@example.org')
+        b.messageCB(b.cl, msg)
+        self.assertEqual(b.cl.msgs[-1].getBody(), 'async hi')
+
+    def test_run_async(self):
+        """Slow coroutine parsers shouldn't block other messages
+        """
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cl = SocketClient(b, 'user@example.org')
+        ticks = []
+        b.eventTasks.append(lambda bot: ticks.append(1))
+
+        async def parser(message, who):
+            if message == 'slow':
+                await asyncio.sleep(0.2)
+            return message
+        b.parser = parser
+
+        async def exercise():
+            loop = b.run_async(timeout=0.5)
+            task = asyncio.ensure_future(loop)
+            await asyncio.sleep(0.05)
+            b.cl.remote.send(b'slow\n')
+            await asyncio.sleep(0.05)
+            b.cl.remote.send(b'fast\n')
+            await task
+
+        try:
+            asyncio.run(exercise())
+        finally:
+            b.cl.close()
+        replies = [m.getBody() for m in b.cl.msgs]
+        self.assertEqual(replies, ['fast', 'slow'])
+        self.assertTrue(ticks)
+        self.assertTrue(b._loop is None)
+
+    def test_poll_wakeup(self):
+        """Timers set from other threads shouldn't wait for the timeout
+        """
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cl = SocketClient(b, 'user@example.org')
+        b.cfg['timeout'] = 5
+        fired = []
+
+        def worker():
+            time.sleep(0.1)
+            b.call_later(0, lambda: fired.append(time.monotonic()))
+        start = time.monotonic()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        try:
+            b.run(timeout=1)
+        finally:
+            thread.join()
+            b.cl.close()
+        self.assertEqual(len(fired), 1)
+        self.assertTrue(fired[0] - start < 1)
+        self.assertTrue(b._poll_wakeup is None)
+
+    def test_rate_limited_worker_reply(self):
+        """Replies from workers go out as soon as the rate allows
+        """
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        b.cfg['workers'] = 2
+        b.cfg['send_rate'] = 100
+        b.cfg['timeout'] = 5
+        self.configure_logging(b)
+        b.cl = SocketClient(b, 'user@example.org')
+        written = []
+        send = b.cl.send
+        def timed_send(data):
+            written.append(time.monotonic())
+            send(data)
+        b.cl.send = timed_send
+
+        def parser(message, who):
+            time.sleep(0.2)
+            return message
+        b.parser = parser
+
+        start = time.monotonic()
+        b.cl.remote.send(b'hi\n')
+        try:
+            b.run(timeout=1)
+        finally:
+            b._shutdown_workers()
+            b.cl.close()
+        self.assertEqual(len(written), 1)
+        self.assertTrue(written[0] - start < 1)
+        self.assertTrue('hi' in b.cl.msgs[0])
+
+    def test_tls_buffered(self):
+        """Data TLS already decrypted is processed without waiting
+        """
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cl = TLSClient(b, 'user@example.org', ['one', 'two', 'three'])
+        b.parser = lambda message, who: message
+        b._wakeup = asyncio.Event()
+        b._on_readable()
+        self.assertEqual([m.getBody() for m in b.cl.msgs],
+                         ['one', 'two', 'three'])
+        self.assertTrue(b._wakeup.is_set())
+
+    def test_worker_exceptions_logged(self):
+        """Failed worker jobs are logged with their traceback
+        """
+        log = logging.getLogger('benderjab.test.workers')
+        for pool in (OrderedWorkerPool(1, log=log),
+                     LimitedWorkerPool(1, log=log)):
+            with self.assertLogs(log, 'ERROR') as logs:
+                pool.submit('a', lambda: 1/0, lambda result: None)
+                pool.shutdown()
+            self.assertTrue('ZeroDivisionError' in logs.output[0])
+
+    def test_worker_pool(self):
+        """Parsers on worker threads should reply in order per JID
+        """
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        b.cfg['workers'] = '4'
+        b.cfg['worker_queue'] = '3'
+        self.configure_logging(b)
+        b.cl = MockClient()
+
+        def parser(message, who):
+            delay, text = message.split()
+            time.sleep(float(delay))
+            return text
+        b.parser = parser
+
+        slow = util.toJID('slow@example.org')
+        fast = util.toJID('fast@example.org')
+        for who, body in [(slow, '0.2 one'), (slow, '0 two'),
+                          (fast, '0 three'), (slow, '0 four')]:
+            msg = xmpp.protocol.Message(b.jid, body=body, typ='chat', frm=who)
+            b.messageCB(b.cl, msg)
+        b._shutdown_workers()
+
+        replies = [(str(m.getTo()), m.getBody()) for m in b.cl.msgs]
+        self.assertEqual(len(replies), 4)
+        slow_replies = [r for w, r in replies if w == str(slow)]
+        self.assertEqual(slow_replies, ['one', 'two', 'four'])
+        # the fast user shouldn't have waited on the slow one
+        self.assertEqual(replies[0], (str(fast), 'three'))
+
 
 
 
@@ -0,0 +1,70 @@
+import unittest
+
+from benderjab import bot
+from benderjab.commands import CommandRouter, command
+
+from .mock import LoggingTestCase
+
+class EchoBot(bot.BenderJab):
+    @command('echo', help="say it back")
+    def echo(self, args, who):
+        return args
+
+    @command('add', pattern=r'(\d+) (\d+)$')
+    def add(self, args, who):
+        return str(int(args.group(1)) + int(args.group(2)))
+
+class LoudBot(EchoBot):
+    # overriding a command keeps it registered
+    def echo(self, args, who):
+        return args.upper()
+
+class TestCommands(LoggingTestCase):
+    def test_router(self):
+        router = CommandRouter()
+        router.add('Ping', lambda args, who: 'pong ' + args)
+        cmd, args = router.lookup('PING   a b ')
+        self.assertEqual(router.run(cmd, args), 'pong a b ')
+        self.assertEqual(router.lookup('pin'), (None, None))
+        self.assertEqual(router.lookup(''), (None, None))
+        self.assertTrue('ping' in router)
+
+        router.add('fail', lambda args, who: 1/0)
+        cmd, args = router.lookup('fail')
+        self.assertRaises(ZeroDivisionError, router.run, cmd, args)
+        stats = router.stats()
+        self.assertEqual(stats['Ping'][:2], (1, 0))
+        self.assertEqual(stats['fail'][:2], (1, 1))
+
+    def test_bot_commands(self):
+        b = EchoBot()
+        self.assertEqual(b.parser('echo hello there', None), 'hello there')
+        self.assertEqual(b.parser('add 2 3', None), '5')
+        self.assertEqual(b.parser('add two', None), r'usage: add (\d+) (\d+)$')
+        self.assertEqual(b.parser('time', None)[:11], 'Server time')
+        self.assertEqual(b.parser('nope', None),
+                         'I have no idea what "nope" means.')
+        self.assertEqual(b.parser('help', None),
+                         'I know: add, echo, help, time, uptime')
+        # other bots' errors are ignored without being listed
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        self.assertEqual(b.parser('Exception: oops', None), None)
+        self.assertTrue('exception:' in b.commands)
+        self.assertEqual(b.parser('help echo', None),
+                         'usage: echo: say it back')
+
+        @b.command('double')
+        def double(args, who):
+            return args * 2
+        self.assertEqual(b.parser('double ab', None), 'abab')
+
+        self.assertEqual(LoudBot().parser('echo hi', None), 'HI')
+        # commands belong to the instance
+        self.assertFalse('double' in LoudBot().commands)
+
+def suite():
+    return unittest.makeSuite(TestCommands)
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from benderjab import bot
+from benderjab.delayed import DelayedMessageStore
+
+from .mock import LoggingTestCase, MockClient
+
+class TestDelayedMessageStore(LoggingTestCase):
+    def setUp(self):
+        super(TestDelayedMessageStore, self).setUp()
+        self.tempdir = tempfile.mkdtemp(prefix='benderjab_')
+        self.filename = os.path.join(self.tempdir, 'delayed.db')
+
+    def tearDown(self):
+        super(TestDelayedMessageStore, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def test_store(self):
+        store = DelayedMessageStore(self.filename, commit_size=3)
+        self.assertTrue(store.add(30, 'a@example.org', 'third'))
+        self.assertFalse(store.add(10, 'a@example.org', 'first'))
+        self.assertEqual(store.next_due(), 10)
+        # third add commits the batch
+        store.add(20, 'b@example.org', 'second')
+        self.assertEqual(store._buffer, [])
+        store.add(100, 'b@example.org', 'later')
+        self.assertEqual(len(store), 4)
+
+        rows = store.get_due(25)
+        self.assertEqual([r[3] for r in rows], ['first', 'second'])
+        store.remove([r[0] for r in rows])
+        self.assertEqual(store.next_due(), 30)
+        store.close()
+
+        # everything not yet sent survives a restart
+        store = DelayedMessageStore(self.filename)
+        self.assertEqual(len(store), 2)
+        rows = store.get_due(1000, limit=1)
+        self.assertEqual([(r[2], r[3]) for r in rows],
+                         [('a@example.org', 'third')])
+        store.close()
+
+    def test_bot_delivery(self):
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cfg['delayed_store'] = self.filename
+        b.cl = MockClient()
+
+        now = time.time()
+        b.send_at(now - 10, 'user@example.org', 'missed')
+        b.send_at(now + 3600, 'user@example.org', 'later')
+        # the store keeps a single timer for its earliest message
+        self.assertEqual(len(b.scheduler), 1)
+        # and committed both without waiting for a flush
+        self.assertEqual(b._delayed._buffer, [])
+        self.assertAlmostEqual(b._delayed_timer.when,
+                               b._scheduler_time(now - 10), places=2)
+
+        b._run_timers()
+        self.assertEqual([m.getBody() for m in b.cl.msgs], ['missed'])
+        self.assertAlmostEqual(b._delayed_timer.when,
+                               b._scheduler_time(now + 3600), places=2)
+        b._close_delayed_store()
+
+        # after a restart overdue messages are sent in batches
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cfg['delayed_store'] = self.filename
+        b.cl = MockClient()
+        store = b._get_delayed_store()
+        for i in range(5):
+            store.add(now - 5, 'user@example.org', 'overdue %d' % (i,))
+        b._deliver_delayed(limit=3)
+        self.assertEqual(len(b.cl.msgs), 3)
+        b._run_timers()
+        self.assertEqual(len(b.cl.msgs), 5)
+        self.assertEqual(len(store), 1)
+        b._close_delayed_store()
+
+    def test_offline_delivery(self):
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cfg['delayed_store'] = self.filename
+        b.cl = MockClient()
+        b.send_at(time.time() - 10, 'user@example.org', 'missed')
+        # while reconnecting nothing is sent, so nothing is removed
+        b._reconnecting = True
+        b._run_timers()
+        self.assertEqual(b.cl.msgs, [])
+        self.assertEqual(len(b._delayed), 1)
+
+        # a full send queue doesn't lose it either
+        b._reconnecting = False
+        b.cfg['send_rate'] = 1
+        b.cfg['send_queue'] = 0
+        b._deliver_delayed()
+        self.assertEqual(len(b._delayed), 1)
+        self.assertTrue(b._delayed_timer.when > b.scheduler.clock())
+
+        # queued isn't sent, it stays in the store until it's written
+        b._outbound = None
+        b.cfg['send_queue'] = 10
+        b._deliver_delayed()
+        self.assertEqual(len(b._outbound), 1)
+        self.assertEqual(len(b._delayed), 1)
+        # and isn't queued again while it waits
+        b._deliver_delayed()
+        self.assertEqual(len(b._outbound), 1)
+        b._drain_outbound()
+        self.assertEqual(len(b.cl.msgs), 1)
+        self.assertTrue('missed' in b.cl.msgs[0])
+        self.assertEqual(len(b._delayed), 0)
+        b._close_delayed_store()
+
+    def test_in_memory(self):
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cl = MockClient()
+        b.send_later(-1, 'user@example.org', 'hi')
+        b._run_timers()
+        self.assertEqual(b.cl.msgs[0].getBody(), 'hi')
+
+def suite():
+    return unittest.makeSuite(TestDelayedMessageStore)
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
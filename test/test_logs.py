@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from benderjab import bot
+from benderjab.logs import JSONFormatter
+
+class TestLogs(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='benderjab_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_json_formatter(self):
+        formatter = JSONFormatter()
+        record = logging.LogRecord('bot', logging.WARNING, __file__, 1,
+                                   "%s subscribed", ('a@example.org',), None)
+        record.jid = 'a@example.org'
+        entry = json.loads(formatter.format(record))
+        self.assertEqual(entry['message'], 'a@example.org subscribed')
+        self.assertEqual(entry['level'], 'WARNING')
+        self.assertEqual(entry['jid'], 'a@example.org')
+        self.assertFalse('exception' in entry)
+
+        try:
+            raise ValueError("oops")
+        except ValueError:
+            record.exc_info = sys.exc_info()
+        entry = json.loads(formatter.format(record))
+        self.assertTrue('ValueError: oops' in entry['exception'])
+
+    def test_queue_logging(self):
+        b = bot.BenderJab()
+        b.jid = 'logger@example.org'
+        b.cfg['log'] = os.path.join(self.tempdir, '%(jid)s.log')
+        b.cfg['loglevel'] = 'info'
+        b.cfg['log_format'] = 'json'
+        b.configure_logging()
+        # configuring again shouldn't duplicate records
+        b.configure_logging()
+        self.assertTrue(b._log_listener is not None)
+        b.log.info("%s said %s", 'someone@example.org', 'hi')
+        b.log.debug("not at this level")
+        b._stop_logging()
+
+        with open(b.log_filename) as logfile:
+            lines = [json.loads(line) for line in logfile]
+        messages = [line['message'] for line in lines]
+        self.assertEqual(messages.count('someone@example.org said hi'), 1)
+        self.assertFalse('not at this level' in messages)
+        self.assertEqual(b.log.handlers, [])
+
+    def test_queue_logging_exception(self):
+        b = bot.BenderJab()
+        b.jid = 'except@example.org'
+        b.cfg['log'] = os.path.join(self.tempdir, '%(jid)s.log')
+        b.cfg['log_format'] = 'json'
+        b.configure_logging()
+        try:
+            raise ValueError("oops")
+        except ValueError:
+            b.log.exception("boom %d", 1)
+        b._stop_logging()
+
+        with open(b.log_filename) as logfile:
+            entry = json.loads(logfile.readlines()[-1])
+        self.assertEqual(entry['message'], 'boom 1')
+        self.assertTrue('ValueError: oops' in entry['exception'])
+
+    def test_direct_logging(self):
+        b = bot.BenderJab()
+        b.jid = 'direct@example.org'
+        b.cfg['log'] = os.path.join(self.tempdir, '%(jid)s.log')
+        b.cfg['log_mode'] = 'direct'
+        b.configure_logging()
+        self.assertTrue(b._log_listener is None)
+        b.log.warning("written right away")
+        with open(b.log_filename) as logfile:
+            self.assertTrue('written right away' in logfile.read())
+        b._stop_logging()
+
+def suite():
+    return unittest.makeSuite(TestLogs)
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,115 @@
+import smtplib
+import time
+import unittest
+
+from benderjab import bot
+from benderjab.mail import MailSender
+
+from .mock import LoggingTestCase, MockClient, SMTPSink
+
+class TestMailSender(LoggingTestCase):
+    def setUp(self):
+        super(TestMailSender, self).setUp()
+        self.sink = SMTPSink()
+
+    def tearDown(self):
+        super(TestMailSender, self).tearDown()
+        self.sink.close()
+
+    def test_persistent_connection(self):
+        mail = MailSender(self.sink.host, self.sink.port)
+        for i in range(20):
+            mail.send('bot@example.org', ['user%d@example.org' % (i,)],
+                      'Subject: %d\r\n\r\nbody %d\r\n' % (i, i))
+        mail.flush()
+        self.assertEqual(mail.sent, 20)
+        self.assertEqual(len(self.sink.messages), 20)
+        self.assertEqual(self.sink.messages[3][1], ['<user3@example.org>'])
+        self.assertTrue('body 3' in self.sink.messages[3][2])
+        self.assertEqual(self.sink.connections, 1)
+        mail.close()
+
+    def test_reconnect(self):
+        mail = MailSender(self.sink.host, self.sink.port, idle_timeout=0.05)
+        mail.send('bot@example.org', ['a@example.org'], 'one')
+        mail.flush()
+        # an idle connection gets closed and reopened for the next message
+        time.sleep(0.2)
+        self.assertEqual(mail._smtp, None)
+        mail.send('bot@example.org', ['a@example.org'], 'two')
+        mail.flush()
+        self.assertEqual(mail.connections, 2)
+
+        # so does one the server dropped
+        mail._smtp = None
+        stale = smtplib.SMTP(self.sink.host, self.sink.port)
+        stale.close()
+        mail._smtp = stale
+        mail.send('bot@example.org', ['a@example.org'], 'three')
+        mail.close()
+        self.assertEqual(mail.sent, 3)
+        self.assertEqual(mail.failed, 0)
+        self.assertEqual(len(self.sink.messages), 3)
+
+    def test_stale_connection_closed(self):
+        class StaleSMTP(object):
+            closed = False
+            def sendmail(self, *args):
+                raise ConnectionResetError("gone")
+            def close(self):
+                self.closed = True
+                raise OSError("already gone")
+        mail = MailSender(self.sink.host, self.sink.port)
+        stale = StaleSMTP()
+        mail._smtp = stale
+        mail.send('bot@example.org', ['a@example.org'], 'one')
+        mail.close()
+        # the dead connection is closed instead of leaking its socket
+        self.assertTrue(stale.closed)
+        self.assertEqual(mail.sent, 1)
+        self.assertEqual(len(self.sink.messages), 1)
+
+    def test_timeout(self):
+        opened = []
+        def factory(host, port, timeout):
+            opened.append(timeout)
+            return smtplib.SMTP(host, port, timeout=timeout)
+        mail = MailSender(self.sink.host, self.sink.port,
+                          smtp_factory=factory, timeout=5)
+        mail.send('bot@example.org', ['a@example.org'], 'one')
+        mail.close()
+        self.assertEqual(opened, [5])
+        self.assertEqual(mail.sent, 1)
+
+    def test_bad_message(self):
+        mail = MailSender(self.sink.host, self.sink.port)
+        # smtplib refuses non-ascii str messages with a UnicodeEncodeError
+        mail.send('bot@example.org', ['a@example.org'], 'caf\u00e9')
+        mail.send('bot@example.org', ['a@example.org'], 'fine')
+        mail.flush()
+        self.assertEqual(mail.failed, 1)
+        self.assertEqual(mail.sent, 1)
+        mail.close()
+
+    def test_bot_uses_config(self):
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cl = MockClient()
+        b.cfg['smtpserver'] = self.sink.host
+        b.cfg['smtpport'] = str(self.sink.port)
+        b.cfg['smtp_timeout'] = '5'
+        b.send('mailto:user@example.org', 'hello')
+        self.assertEqual(b._mail.timeout, 5)
+        self.assertTrue(b._mail.log is b.log)
+        b._close_mail_sender()
+        self.assertEqual(len(self.sink.messages), 1)
+        sender, recipients, text = self.sink.messages[0]
+        self.assertEqual(recipients, ['<user@example.org>'])
+        self.assertTrue('To: user@example.org' in text)
+
+def suite():
+    return unittest.makeSuite(TestMailSender)
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
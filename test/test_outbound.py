@@ -0,0 +1,103 @@
+import unittest
+
+import xmpp
+
+from benderjab import bot
+from benderjab.outbound import OutboundQueue, TokenBucket
+
+from .mock import FakeClock, LoggingTestCase, MockClient
+
+def message(to, body):
+    return xmpp.protocol.Message(to, typ='chat', body=body)
+
+class TestOutbound(LoggingTestCase):
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, 3, clock)
+        self.assertEqual([bucket.take() for i in range(4)],
+                         [True, True, True, False])
+        self.assertEqual(bucket.wait(), 0.5)
+        clock.now += 0.5
+        self.assertTrue(bucket.take())
+        self.assertRaises(ValueError, TokenBucket, 0)
+
+    def test_global_limit(self):
+        clock = FakeClock()
+        writes = []
+        q = OutboundQueue(writes.append, rate=10, burst=5, clock=clock)
+        for i in range(12):
+            q.put(message('user%d@example.org' % (i,), str(i)), 'user%d' % (i,))
+        self.assertEqual(q.drain(), 0.1)
+        # the burst went out as one write
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(writes[0].count('<message'), 5)
+        self.assertEqual(len(q), 7)
+
+        clock.now += 0.5
+        q.drain()
+        self.assertEqual(writes[1].count('<message'), 5)
+        clock.now += 10
+        self.assertEqual(q.drain(), None)
+        self.assertEqual(q.stats(), {'depth': 0, 'destinations': 0,
+                                     'sent': 12, 'dropped': 0, 'writes': 3})
+
+    def test_peer_limit(self):
+        clock = FakeClock()
+        writes = []
+        q = OutboundQueue(writes.append, peer_rate=1, peer_burst=2,
+                          max_queue=6, clock=clock)
+        for i in range(5):
+            q.put(message('flood@example.org', 'flood %d' % (i,)), 'flood')
+        q.put(message('quiet@example.org', 'quiet'), 'quiet')
+        self.assertFalse(q.put(message('quiet@example.org', 'x'), 'quiet'))
+        self.assertEqual(q.stats()['dropped'], 1)
+
+        self.assertEqual(q.drain(), 1)
+        self.assertEqual(writes[0].count('<message'), 3)
+        self.assertTrue('quiet' in writes[0])
+        # one destination's messages stay in order
+        self.assertTrue(writes[0].index('flood 0') < writes[0].index('flood 1'))
+        clock.now += 1
+        q.drain()
+        self.assertTrue('flood 2' in writes[1])
+
+    def test_sent_callbacks(self):
+        writes = []
+        def write(data):
+            if not writes:
+                writes.append(None)
+                raise IOError("connection lost")
+            writes.append(data)
+        sent = []
+        q = OutboundQueue(write, rate=10, burst=5, clock=FakeClock())
+        q.put(message('a@example.org', 'one'), 'a', lambda: sent.append(1))
+        q.put(message('a@example.org', 'two'), 'a', lambda: sent.append(2))
+        # a failed write keeps the stanzas for next time
+        self.assertRaises(IOError, q.drain)
+        self.assertEqual(sent, [])
+        self.assertEqual(len(q), 2)
+        q.bucket.tokens = 5
+        self.assertEqual(q.drain(), None)
+        self.assertTrue(writes[1].index('one') < writes[1].index('two'))
+        self.assertEqual(sent, [1, 2])
+
+    def test_bot_queue(self):
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cl = MockClient()
+        self.assertEqual(b.send_queue_stats(), None)
+        b.cfg['send_rate'] = '100'
+        for i in range(3):
+            b.send('user@example.org', 'hi %d' % (i,))
+        self.assertEqual(b.cl.msgs, [])
+        b._run_timers()
+        self.assertEqual(len(b.cl.msgs), 1)
+        self.assertEqual(b.cl.msgs[0].count('<body>hi'), 3)
+        self.assertEqual(b.send_queue_stats()['sent'], 3)
+
+def suite():
+    return unittest.makeSuite(TestOutbound)
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,107 @@
+import unittest
+
+import xmpp
+
+from benderjab import bot
+from benderjab.presence import PresenceManager
+
+from .mock import FakeClock, LoggingTestCase, MockClient
+
+class FakeTimer(object):
+    def __init__(self, timers, delay, func):
+        self.timers = timers
+        self.delay = delay
+        self.func = func
+        timers.append(self)
+
+    def cancel(self):
+        self.timers.remove(self)
+
+class TestPresenceManager(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.timers = []
+        self.clock = FakeClock()
+
+    def send(self, stanza):
+        self.sent.append(stanza)
+        return True
+
+    def call_later(self, delay, func):
+        return FakeTimer(self.timers, delay, func)
+
+    def test_duplicates_suppressed(self):
+        presence = PresenceManager(self.send, clock=self.clock)
+        self.assertTrue(presence.publish('away', 'busy'))
+        self.assertFalse(presence.publish('away', 'busy'))
+        self.assertTrue(presence.publish('dnd', 'busy'))
+        self.assertEqual([p.getShow() for p in self.sent], ['away', 'dnd'])
+        self.assertEqual(presence.current, ('dnd', 'busy', None))
+        self.assertEqual(presence.suppressed, 1)
+
+        # logging on again sends it even though it hasn't changed
+        presence.announce()
+        self.assertEqual(len(self.sent), 3)
+
+    def test_debounce(self):
+        presence = PresenceManager(self.send, 10, self.call_later,
+                                   clock=self.clock)
+        presence.publish(status='1')
+        self.clock.now += 1
+        presence.publish(status='2')
+        presence.publish(status='3')
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(len(self.timers), 1)
+        self.assertEqual(self.timers[0].delay, 9)
+
+        self.timers[0].func()
+        self.assertEqual([p.getStatus() for p in self.sent], ['1', '3'])
+
+        # changing back before the timer fires sends nothing
+        self.clock.now += 1
+        presence.publish(status='4')
+        presence.publish(status='3')
+        self.assertEqual(self.timers, [])
+        self.assertEqual(len(self.sent), 2)
+
+    def test_contacts(self):
+        presence = PresenceManager(self.send)
+        presence.update(xmpp.Presence(frm='a@example.org/home', show='away',
+                                      priority=5))
+        presence.update(xmpp.Presence(frm='a@example.org/work'))
+        presence.update(xmpp.Presence(frm='b@example.org/home'))
+        self.assertEqual(presence.online(), ['a@example.org', 'b@example.org'])
+        self.assertEqual(presence.resources('A@example.org')['home'],
+                         ('away', None, 5))
+
+        presence.update(xmpp.Presence(frm='a@example.org/home',
+                                      typ='unavailable'))
+        self.assertEqual(list(presence.resources('a@example.org')), ['work'])
+        presence.update(xmpp.Presence(frm='a@example.org/work',
+                                      typ='unavailable'))
+        presence.update(xmpp.Presence(frm='b@example.org/home',
+                                      typ='subscribe'))
+        self.assertFalse(presence.is_online('a@example.org'))
+        self.assertEqual(presence.online(), ['b@example.org'])
+
+class TestBotPresence(LoggingTestCase):
+    def test_presence_callback(self):
+        b = bot.BenderJab()
+        b.jid = 'bot@example.org'
+        self.configure_logging(b)
+        b.cl = MockClient()
+        b.presenceCB(b.cl, xmpp.Presence(to=b.jid, frm='a@example.org/x'))
+        self.assertEqual(b.presence.online(), ['a@example.org'])
+
+        b.presence.publish('away')
+        b.presence.publish('away')
+        self.assertEqual(len(b.cl.msgs), 1)
+        self.assertEqual(b.cl.msgs[0].getShow(), 'away')
+
+def suite():
+    suite = unittest.makeSuite(TestPresenceManager)
+    suite.addTest(unittest.makeSuite(TestBotPresence))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import xmpp
+
+from benderjab import bot
+from benderjab.roster import RosterCache, NS_ROSTER_VER
+
+from .mock import LoggingTestCase, MockClient
+
+def roster_query(items, ver=None):
+    query = xmpp.Node('query', {'xmlns': xmpp.NS_ROSTER})
+    if ver is not None:
+        query.setAttr('ver', ver)
+    for jid, subscription, groups in items:
+        item = query.addChild('item', {'jid': jid,
+                                       'subscription': subscription})
+        for group in groups:
+            item.addChild('group').setData(group)
+    return query
+
+class TestRosterCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='benderjab_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_apply(self):
+        cache = RosterCache()
+        cache.apply(roster_query([('a@example.org', 'both', ['friends']),
+                                  ('b@example.org', 'to', [])], ver='1'),
+                    replace=True)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.version, '1')
+        item = cache.get('a@example.org/home')
+        self.assertEqual(item['subscription'], 'both')
+        self.assertEqual(item['groups'], ['friends'])
+
+        # pushes only touch the items they name
+        cache.apply(roster_query([('b@example.org', 'remove', []),
+                                  ('c@example.org', 'from', [])], ver='2'))
+        self.assertEqual(list(cache), ['a@example.org', 'c@example.org'])
+        self.assertFalse('b@example.org' in cache)
+        self.assertEqual(cache.version, '2')
+
+        # a full roster replaces everything
+        cache.apply(roster_query([('d@example.org', 'both', [])]),
+                    replace=True)
+        self.assertEqual(list(cache), ['d@example.org'])
+        self.assertEqual(cache.version, '2')
+
+    def test_persistent(self):
+        filename = os.path.join(self.tempdir, 'roster.db')
+        cache = RosterCache(filename)
+        cache.apply(roster_query([('a@example.org', 'both', [])], ver='7'),
+                    replace=True)
+        cache.close()
+
+        cache = RosterCache(filename)
+        self.assertEqual(cache.version, '7')
+        self.assertTrue('a@example.org' in cache)
+        cache.close()
+
+class TestBotRoster(LoggingTestCase):
+    def setUp(self):
+        super(TestBotRoster, self).setUp()
+        self.bot = bot.BenderJab()
+        self.bot.jid = 'bot@example.org'
+        self.bot.cl = MockClient()
+        self.configure_logging(self.bot)
+
+    def test_request_and_result(self):
+        b = self.bot
+        b.request_roster()
+        b.request_roster()
+        self.assertEqual(len(b.cl.callbacks), 1)
+        iq, func, args = b.cl.callbacks[0]
+        # no roster versioning without the stream feature
+        self.assertEqual(iq.getTag('query').getAttr('ver'), None)
+
+        reply = iq.buildReply('result')
+        reply.setQueryPayload(
+            roster_query([('a@example.org', 'both', [])], ver='3').getChildren())
+        reply.getTag('query').setAttr('ver', '3')
+        func(b.cl, reply, **args)
+        self.assertTrue('a@example.org' in b.roster)
+        self.assertEqual(b.roster.version, '3')
+
+        # an empty result means what we have is current
+        unchanged = xmpp.Iq('result', attrs={'id': iq.getID()})
+        func(b.cl, unchanged, **args)
+        self.assertTrue('a@example.org' in b.roster)
+
+    def test_versioned_request(self):
+        b = self.bot
+        b.roster.apply(roster_query([], ver='12'))
+        features = xmpp.Node('features')
+        features.addChild('ver', namespace=NS_ROSTER_VER)
+        b.cl.Dispatcher = xmpp.Node('dispatcher')
+        b.cl.Dispatcher.Stream = xmpp.Node('stream')
+        b.cl.Dispatcher.Stream.features = features
+        b.request_roster()
+        iq = b.cl.callbacks[0][0]
+        self.assertEqual(iq.getTag('query').getAttr('ver'), '12')
+
+    def test_lazy(self):
+        b = self.bot
+        b.cfg['roster'] = 'lazy'
+        self.assertEqual(b.cl.callbacks, [])
+        self.assertEqual(len(b.roster), 0)
+        self.assertEqual(len(b.cl.callbacks), 1)
+
+    def test_push(self):
+        b = self.bot
+        push = xmpp.Iq('set', xmpp.NS_ROSTER, frm='bot@example.org')
+        push.setQueryPayload(
+            roster_query([('a@example.org', 'none', [])]).getChildren())
+        push.setID('push1')
+        self.assertRaises(xmpp.NodeProcessed,
+                          b.roster_push_handler, b.cl, push)
+        self.assertTrue('a@example.org' in b.roster)
+        self.assertEqual(b.cl.msgs[-1].getType(), 'result')
+        self.assertEqual(b.cl.msgs[-1].getID(), 'push1')
+
+        # someone else can't edit our roster
+        spoof = xmpp.Iq('set', xmpp.NS_ROSTER, frm='mallory@example.org')
+        spoof.setQueryPayload(
+            roster_query([('a@example.org', 'remove', [])]).getChildren())
+        sent = len(b.cl.msgs)
+        self.assertRaises(xmpp.NodeProcessed,
+                          b.roster_push_handler, b.cl, spoof)
+        self.assertTrue('a@example.org' in b.roster)
+        self.assertEqual(len(b.cl.msgs), sent)
+
+def suite():
+    suite = unittest.makeSuite(TestRosterCache)
+    suite.addTest(unittest.makeSuite(TestBotRoster))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
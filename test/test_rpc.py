@@ -1,12 +1,17 @@
+import datetime
 import socket
+import threading
 import types
 import unittest
 from io import StringIO
 import xmlrpc.client
 
 from benderjab import rpc
+from benderjab.scheduler import Scheduler
 import xmpp
 
+from .mock import FakeClock
+
 class fake_conn(object):
    def __init__(self):
      self.messages = []
@@ -27,6 +32,221 @@ class TestRPC(unittest.TestCase):
         # loads returns (params, methodname)
         self.failUnlessEqual(unmarshaled[0], params)
 
+    def test_marshal_node(self):
+        """marshal_node/unmarshal_node should agree with xmlrpc.client
+        """
+        params = (1, -2, True, 1.5, '', 'a <b> & "c"', '\u00e9t\u00e9',
+                  [], [1, ['x', {}]], {'a': 1, 'b': [False, 2.25]},
+                  xmlrpc.client.Binary(b'\x00\xffdata'),
+                  xmlrpc.client.DateTime('20240102T03:04:05'), None)
+        node = rpc.marshal_node(params, 'echo', allow_none=True)
+
+        # what we generate can be read by xmlrpc.client
+        self.assertEqual(xmlrpc.client.loads(str(node)),
+                         xmlrpc.client.loads(xmlrpc.client.dumps(
+                             params, 'echo', allow_none=True)))
+
+        # and we can read what xmlrpc.client generates after it has
+        # been through the xmpp parser
+        dumped = xmlrpc.client.dumps(params, 'echo', allow_none=True)
+        iq = rpc.make_iq('test@test.org', 'set', dumped)
+        iq = xmpp.Iq(node=str(iq))
+        self.assertEqual(rpc.extract_params(iq),
+                         xmlrpc.client.loads(dumped))
+
+        iq = rpc.make_iq('test@test.org', 'set', node)
+        iq = xmpp.Iq(node=str(iq))
+        unmarshaled, method = rpc.extract_params(iq, use_builtin_types=True)
+        self.assertEqual(method, 'echo')
+        self.assertEqual(unmarshaled[-3], b'\x00\xffdata')
+        self.assertEqual(unmarshaled[-2], datetime.datetime(2024, 1, 2, 3, 4, 5))
+
+        self.assertRaises(TypeError, rpc.marshal_node, (None,))
+        self.assertRaises(OverflowError, rpc.marshal_node, (2**40,))
+
+    def test_marshal_json(self):
+        """JSON bodies should carry the same values as XML-RPC
+        """
+        params = (1, 2.5, 'a <b> & "c"', [1, [2]], {'a': None},
+                  xmlrpc.client.Binary(b'\x00\xff'),
+                  xmlrpc.client.DateTime('20240102T03:04:05'))
+        iq = rpc.make_iq('test@test.org', 'set',
+                         rpc.marshal_json(params, 'echo'),
+                         namespace=rpc.NS_RPC_JSON)
+        # locally built
+        self.assertEqual(rpc.extract_params(iq), (params, 'echo'))
+        # and after going through the xmpp parser
+        iq = xmpp.Iq(node=str(iq))
+        self.assertEqual(rpc.extract_params(iq), (params, 'echo'))
+
+        # dicts that look like our tags come back as they went in
+        params = ({'__base64__': 'x'}, {'__datetime__': 'soon'},
+                  {'___base64__': {'__base64__': 'y'}},
+                  {'__base64__': 'z', 'other': 1})
+        iq = rpc.make_iq('test@test.org', 'set',
+                         rpc.marshal_json(params, 'echo'),
+                         namespace=rpc.NS_RPC_JSON)
+        iq = xmpp.Iq(node=str(iq))
+        self.assertEqual(rpc.extract_params(iq), (params, 'echo'))
+
+        fault = rpc.marshal_json(xmlrpc.client.Fault(3, 'nope'))
+        iq = rpc.make_iq('test@test.org', 'result', fault,
+                         namespace=rpc.NS_RPC_JSON)
+        iq = xmpp.Iq(node=str(iq))
+        self.assertRaises(xmlrpc.client.Fault, rpc.extract_params, iq)
+
+    def test_json_negotiation(self):
+        """Use JSON with peers that advertise it, XML-RPC with the rest
+        """
+        server = rpc.XmlRpcBot()
+        server.register_function(lambda x, y: x + y, 'add')
+        server_conn = fake_conn()
+
+        client = rpc.XmlRpcBot()
+        client.cfg['rpc_format'] = 'json'
+        client.cl = fake_conn()
+
+        # first call goes out as XML-RPC while we ask what the peer supports
+        first = client.rpc_call_async('server@test.fake', (1, 2), 'add')
+        disco, call = client.cl.messages
+        self.assertEqual(call.getTag('query').getNamespace(), xmpp.NS_RPC)
+
+        self.assertRaises(xmpp.NodeProcessed, server.disco_info_handler,
+                          server_conn, xmpp.Iq(node=str(disco)))
+        self.assertRaises(xmpp.NodeProcessed, client.rpc_response_handler,
+                          client.cl, xmpp.Iq(node=str(server_conn.messages[-1])))
+        self.assertEqual(client.rpc_peer_formats['server@test.fake'],
+                         rpc.NS_RPC_JSON)
+
+        second = client.rpc_call_async('server@test.fake', (3, 4), 'add')
+        call = client.cl.messages[-1]
+        self.assertEqual(call.getTag('query').getNamespace(), rpc.NS_RPC_JSON)
+        self.assertRaises(xmpp.NodeProcessed, server.bot_dispatcher,
+                          server_conn, xmpp.Iq(node=str(call)))
+        reply = server_conn.messages[-1]
+        self.assertEqual(reply.getTag('query').getNamespace(), rpc.NS_RPC_JSON)
+        self.assertRaises(xmpp.NodeProcessed, client.rpc_response_handler,
+                          client.cl, xmpp.Iq(node=str(reply)))
+        self.assertEqual(second.result(0), 7)
+
+        # peers that don't advertise it stay on XML-RPC
+        client.rpc_call_async('other@test.fake', (), 'add')
+        disco = client.cl.messages[-2]
+        reply = disco.buildReply('result')
+        reply.getTag('query').addChild('feature', {'var': xmpp.NS_RPC})
+        self.assertRaises(xmpp.NodeProcessed, client.rpc_response_handler,
+                          client.cl, xmpp.Iq(node=str(reply)))
+        self.assertEqual(client.rpc_peer_formats['other@test.fake'],
+                         xmpp.NS_RPC)
+
+    def test_rpc_batch(self):
+        """Queued calls go out as one system.multicall request
+        """
+        server = rpc.XmlRpcBot()
+        server.register_function(lambda x, y: x + y, 'add')
+        server_conn = fake_conn()
+
+        client = rpc.XmlRpcBot()
+        client.cl = fake_conn()
+        batch = client.rpc_batch('server@test.fake', flush_size=3,
+                                 flush_interval=60)
+        self.assertTrue(client.rpc_batch('server@test.fake') is batch)
+        first = batch.call('add', 1, 2)
+        missing = batch.call('missing')
+        self.assertEqual(client.cl.messages, [])
+        self.assertFalse(batch.due())
+        third = batch.call('add', 3, 4)
+        self.assertEqual(len(client.cl.messages), 1)
+        self.assertEqual(len(batch), 0)
+
+        request = xmpp.Iq(node=str(client.cl.messages[0]))
+        self.assertRaises(xmpp.NodeProcessed, server.bot_dispatcher,
+                          server_conn, request)
+        self.assertRaises(xmpp.NodeProcessed, client.rpc_response_handler,
+                          client.cl, xmpp.Iq(node=str(server_conn.messages[0])))
+        self.assertEqual(first.result(0), 3)
+        self.assertRaises(xmlrpc.client.Fault, missing.result, 0)
+        self.assertEqual(third.result(0), 7)
+
+        # old calls get flushed by a timer
+        batch.flush_interval = 0
+        batch.call('add', 5, 6)
+        client._run_timers()
+        self.assertEqual(len(client.cl.messages), 2)
+
+    def test_rpc_batch_timer(self):
+        """A flush timer that fires early tries again later
+        """
+        clock = FakeClock()
+        client = rpc.XmlRpcBot()
+        client.cl = fake_conn()
+        client.scheduler = Scheduler(clock)
+        batch = client.rpc_batch('server@test.fake', flush_size=10,
+                                 flush_interval=10)
+        batch.call('add', 1, 2)
+        # as if the clocks disagreed by half a second
+        batch._started += 0.5
+        clock.now += 10
+        client._run_timers()
+        self.assertEqual(client.cl.messages, [])
+        self.assertEqual(len(client.scheduler), 1)
+        clock.now += 0.5
+        client._run_timers()
+        self.assertEqual(len(client.cl.messages), 1)
+
+    def test_rpc_batch_cancelled(self):
+        """Cancelling one call shouldn't stop the rest getting results
+        """
+        server = rpc.XmlRpcBot()
+        server.register_function(lambda x, y: x + y, 'add')
+        server_conn = fake_conn()
+
+        client = rpc.XmlRpcBot()
+        client.cl = fake_conn()
+        batch = client.rpc_batch('server@test.fake', flush_size=3,
+                                 flush_interval=60)
+        # options given later apply to the existing batch
+        client.rpc_batch('server@test.fake', flush_size=2)
+        self.assertEqual(batch.flush_size, 2)
+
+        cancelled = batch.call('add', 1, 2)
+        self.assertTrue(cancelled.cancel())
+        kept = batch.call('add', 3, 4)
+        request = xmpp.Iq(node=str(client.cl.messages[0]))
+        self.assertRaises(xmpp.NodeProcessed, server.bot_dispatcher,
+                          server_conn, request)
+        self.assertRaises(xmpp.NodeProcessed, client.rpc_response_handler,
+                          client.cl, xmpp.Iq(node=str(server_conn.messages[0])))
+        self.assertTrue(cancelled.cancelled())
+        self.assertEqual(kept.result(0), 7)
+
+    def test_rpc_while_reconnecting(self):
+        """RPC sends fail right away instead of writing to a dead client
+        """
+        client = rpc.XmlRpcBot()
+        client.cl = fake_conn()
+        client._reconnecting = True
+        self.assertRaises(RuntimeError, client.rpc_send,
+                          'server@test.fake', (1, 2), 'add')
+        self.assertRaises(RuntimeError, client.rpc_call_async,
+                          'server@test.fake', (1, 2), 'add')
+        batch = client.rpc_batch('server@test.fake', flush_size=1)
+        future = batch.call('add', 1, 2)
+        self.assertRaises(RuntimeError, future.result, 0)
+        self.assertEqual(client.cl.messages, [])
+
+    def test_marshal_node_fault(self):
+        fault = xmlrpc.client.Fault(2, 'broken')
+        iq = rpc.make_iq('test@test.org', 'result', rpc.marshal_node(fault))
+        iq = xmpp.Iq(node=str(iq))
+        try:
+            rpc.extract_params(iq)
+        except xmlrpc.client.Fault as e:
+            self.assertEqual(e.faultCode, 2)
+            self.assertEqual(e.faultString, 'broken')
+        else:
+            self.fail("Fault wasn't raised")
+
     # FIXME: figure out xmlrpc_error_iq api
     #def test_xmlrpc_error(self):
     #    """
@@ -60,6 +280,167 @@ class TestRPC(unittest.TestCase):
        result = result_tuple[0][0]
        self.failUnlessEqual(3, result)
 
+    def test_replies_hold_send_lock(self):
+       """Replies sent on the xmpp thread take the lock workers use
+       """
+       bot = rpc.XmlRpcBot()
+       bot.register_function(lambda x, y: x + y, 'add')
+       held = []
+       class LockCheckingConn(fake_conn):
+         def send(self, msg):
+           # another thread can't get the lock while we're writing
+           result = []
+           t = threading.Thread(
+             target=lambda: result.append(bot._send_lock.acquire(False)))
+           t.start()
+           t.join()
+           held.append(not result[0])
+           fake_conn.send(self, msg)
+       conn = LockCheckingConn()
+       bot.cl = conn
+       msg = rpc.make_iq('test@test.fake', 'set',
+                         xmlrpc.client.dumps((1, 2), 'add'))
+       self.assertRaises(xmpp.NodeProcessed, bot.bot_dispatcher, conn, msg)
+       bot.rpc_send('test@test.fake', (1, 2), 'add')
+       self.assertEqual(held, [True, True])
+
+    def make_reply(self, request, params):
+       """Build the result iq a remote bot would send for request
+       """
+       response = xmlrpc.client.dumps(params, methodresponse=True)
+       return rpc.make_iq('bot@test.fake', 'result', response, request.getID())
+
+    def test_rpc_call_async(self):
+       """Several calls can be waiting for replies at once
+       """
+       bot = rpc.XmlRpcBot()
+       bot.cl = fake_conn()
+       first = bot.rpc_call_async('a@test.fake', (1, 2), 'add')
+       second = bot.rpc_call_async('b@test.fake', (3, 4), 'add')
+       self.assertEqual(len(bot.cl.messages), 2)
+       first_iq, second_iq = bot.cl.messages
+       self.assertNotEqual(first_iq.getID(), second_iq.getID())
+
+       # replies can come back in any order
+       self.assertRaises(xmpp.NodeProcessed, bot.rpc_response_handler,
+                         bot.cl, self.make_reply(second_iq, (7,)))
+       self.assertFalse(first.done())
+       self.assertEqual(second.result(0), 7)
+
+       fault = xmlrpc.client.dumps(xmlrpc.client.Fault(1, 'broken'),
+                                   methodresponse=True)
+       reply = rpc.make_iq('a@test.fake', 'result', fault, first_iq.getID())
+       self.assertRaises(xmpp.NodeProcessed, bot.rpc_response_handler,
+                         bot.cl, reply)
+       self.assertRaises(xmlrpc.client.Fault, first.result, 0)
+       self.assertEqual(bot._pending_calls, {})
+
+       # replies we aren't waiting for are left for other handlers
+       self.assertEqual(
+           bot.rpc_response_handler(bot.cl, self.make_reply(first_iq, (1,))),
+           None)
+
+    def test_rpc_call_async_timeout(self):
+       bot = rpc.XmlRpcBot()
+       bot.cl = fake_conn()
+       expired = bot.rpc_call_async('a@test.fake', (), 'wait', timeout=0)
+       waiting = bot.rpc_call_async('a@test.fake', (), 'wait', timeout=60)
+       cancelled = bot.rpc_call_async('a@test.fake', (), 'wait', timeout=60)
+       cancelled.cancel()
+       bot._run_timers()
+       self.assertRaises(rpc.XmlRpcReceiveTimeout, expired.result, 0)
+       self.assertFalse(waiting.done())
+       self.assertEqual([f for f, decode in bot._pending_calls.values()],
+                        [waiting])
+
+    def test_rpc_call_async_cancel_race(self):
+       """Cancelling while a reply or timeout resolves the call is harmless
+       """
+       bot = rpc.XmlRpcBot()
+       bot.cl = fake_conn()
+       def cancel_after_check(future):
+           done = future.done
+           def racing_done():
+               result = done()
+               future.cancel()
+               return result
+           future.done = racing_done
+           return future
+       answered = cancel_after_check(
+           bot.rpc_call_async('a@test.fake', (), 'wait', timeout=60))
+       expired = cancel_after_check(
+           bot.rpc_call_async('a@test.fake', (), 'wait', timeout=0))
+       self.assertRaises(xmpp.NodeProcessed, bot.rpc_response_handler,
+                         bot.cl, self.make_reply(bot.cl.messages[0], (1,)))
+       bot._run_timers()
+       self.assertTrue(answered.cancelled())
+       self.assertTrue(expired.cancelled())
+
+
+    def test_xmlrpcbot_workers(self):
+       """Dispatch calls on worker threads with a per method limit
+       """
+       bot = rpc.XmlRpcBot()
+       bot.cfg['rpc_workers'] = '4'
+       bot.cfg['rpc_queue'] = '3'
+       release = threading.Event()
+       def slow():
+         release.wait(5)
+         return 'slow'
+       def add(x, y):
+         return x+y
+       bot.register_function(slow)
+       bot.register_function(add)
+       bot.set_method_concurrency('slow', 1)
+
+       conn = fake_conn()
+       def call(params, method):
+         msg = rpc.make_iq('test@test.fake', 'set',
+                           xmlrpc.client.dumps(params, method))
+         self.assertRaises(xmpp.NodeProcessed, bot.bot_dispatcher, conn, msg)
+
+       call((), 'slow')
+       call((), 'slow')
+       call((), 'slow')
+       self.assertEqual(bot.rpc_queue_depth('slow'), 3)
+       # queue is full now
+       call((1, 2), 'add')
+       self.assertEqual(conn.messages[0].getType(), 'error')
+       release.set()
+       bot._shutdown_workers()
+
+       results = [xmlrpc.client.loads(rpc.extract_iq(m))[0][0]
+                  for m in conn.messages[1:]]
+       self.assertEqual(results, ['slow', 'slow', 'slow'])
+       self.assertEqual(bot.rpc_queue_depth(), 0)
+
+    def test_multicall_workers(self):
+       """Calls inside a system.multicall respect per method limits
+       """
+       bot = rpc.XmlRpcBot()
+       bot.cfg['rpc_workers'] = '4'
+       release = threading.Event()
+       def slow(x):
+         release.wait(5)
+         return x
+       bot.register_function(slow)
+       bot.set_method_concurrency('slow', 1)
+
+       conn = fake_conn()
+       calls = [{'methodName': 'slow', 'params': [i]} for i in range(3)]
+       calls.append({'methodName': 'missing', 'params': []})
+       msg = rpc.make_iq('test@test.fake', 'set',
+                         xmlrpc.client.dumps((calls,), 'system.multicall'))
+       self.assertRaises(xmpp.NodeProcessed, bot.bot_dispatcher, conn, msg)
+       # each call is queued under its own name
+       self.assertEqual(bot.rpc_queue_depth('slow'), 3)
+       release.set()
+       bot._shutdown_workers()
+
+       results = xmlrpc.client.loads(rpc.extract_iq(conn.messages[0]))[0][0]
+       self.assertEqual(results[:3], [[0], [1], [2]])
+       self.assertTrue('faultCode' in results[3])
+
 
 def suite():
     return unittest.makeSuite(TestRPC)
@@ -0,0 +1,94 @@
+import unittest
+
+from benderjab import bot
+from benderjab.scheduler import Scheduler
+
+from .mock import FakeClock
+
+class TestScheduler(unittest.TestCase):
+    def test_order(self):
+        clock = FakeClock()
+        s = Scheduler(clock)
+        fired = []
+        s.call_later(3, fired.append, 3)
+        s.call_later(1, fired.append, 1)
+        s.call_later(2, fired.append, 2)
+        self.assertEqual(len(s), 3)
+        self.assertEqual(s.timeout(), 1)
+        self.assertEqual(s.timeout(0.5), 0.5)
+
+        clock.now += 2
+        for handle in s.pop_due():
+            handle.callback(*handle.args)
+        self.assertEqual(fired, [1, 2])
+        self.assertEqual(len(s), 1)
+        self.assertEqual(s.timeout(10), 1)
+
+    def test_cancel(self):
+        clock = FakeClock()
+        s = Scheduler(clock)
+        handles = [s.call_later(i + 1, lambda: None) for i in range(200)]
+        for handle in handles[:150]:
+            handle.cancel()
+        self.assertEqual(len(s), 50)
+        # cancelled entries got compacted out of the heap
+        self.assertTrue(len(s._heap) < 200)
+        self.assertEqual(s.next_deadline(), clock.now + 151)
+
+        # cancelling something that already ran changes nothing
+        clock.now += 1000
+        due = s.pop_due()
+        self.assertEqual(len(due), 50)
+        due[0].cancel()
+        self.assertEqual(len(s), 0)
+        self.assertEqual(s.timeout(5), 5)
+
+    def test_every(self):
+        clock = FakeClock()
+        s = Scheduler(clock)
+        handle = s.call_every(10, lambda: None)
+        self.assertEqual(s.pop_due(), [])
+        clock.now += 10
+        self.assertEqual(s.pop_due(), [handle])
+        # missed intervals are skipped, not fired in a burst
+        clock.now += 35
+        self.assertEqual(s.pop_due(), [handle])
+        self.assertEqual(s.pop_due(), [])
+        self.assertEqual(handle.when, 1050)
+        handle.cancel()
+        clock.now += 100
+        self.assertEqual(s.pop_due(), [])
+        self.assertRaises(ValueError, s.call_every, 0, lambda: None)
+
+class StepClient(object):
+    def __init__(self):
+        self.timeouts = []
+
+    def Process(self, timeout):
+        self.timeouts.append(timeout)
+        return '0'
+
+class TestBotTimers(unittest.TestCase):
+    def test_step_waits_for_timer(self):
+        b = bot.BenderJab()
+        fired = []
+        b.call_later(0.5, fired.append, 'hi')
+        conn = StepClient()
+        b.step(conn, 5)
+        self.assertTrue(conn.timeouts[0] <= 0.5)
+
+        handle = b.call_at(0, fired.append, 'now')
+        b.call_later(60, fired.append, 'cancelled').cancel()
+        b.step(conn, 5)
+        self.assertEqual(fired, ['now'])
+        self.assertEqual(conn.timeouts[1], 0)
+        self.assertTrue(handle._queued is False)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(TestScheduler))
+    suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(TestBotTimers))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
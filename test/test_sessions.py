@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from benderjab import bot
+from benderjab import util
+from benderjab.sessions import SessionStore
+
+from .mock import FakeClock
+
+class TestSessionStore(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='benderjab_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_bare_jid_keys(self):
+        store = SessionStore()
+        store[util.toJID('User@Example.org/home')]['count'] = 1
+        self.assertEqual(store['user@example.org/work']['count'], 1)
+        self.assertEqual(len(store), 1)
+        del store['user@example.org']
+        self.assertEqual(store['user@example.org'], {})
+
+    def test_lru_and_ttl(self):
+        clock = FakeClock()
+        store = SessionStore(max_sessions=2, ttl=60, clock=clock)
+        store['a@example.org']['n'] = 'a'
+        store['b@example.org']['n'] = 'b'
+        store['a@example.org']
+        store['c@example.org']['n'] = 'c'
+        # b was least recently used
+        self.assertFalse('b@example.org' in store)
+        self.assertEqual(store['a@example.org']['n'], 'a')
+
+        clock.now += 30
+        store['c@example.org']
+        clock.now += 45
+        self.assertEqual(store.prune(), 1)
+        self.assertFalse('a@example.org' in store)
+        self.assertTrue('c@example.org' in store)
+        clock.now += 61
+        self.assertEqual(store['c@example.org'], {})
+
+    def test_memory_cap_and_spill(self):
+        spill = os.path.join(self.tempdir, 'sessions')
+        store = SessionStore(max_bytes=3000, spill=spill)
+        for i in range(10):
+            store['user%d@example.org' % (i,)] = {'history': 'x' * 1000}
+        self.assertTrue(store.memory() <= 3000 + 1100)
+        self.assertTrue(len(store) < 10)
+        # evicted sessions come back from disk
+        self.assertEqual(store['user0@example.org']['history'], 'x' * 1000)
+        store.close()
+
+        store = SessionStore(spill=spill)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store['user9@example.org']['history'], 'x' * 1000)
+        store.close()
+
+    def test_prune_spill(self):
+        clock = FakeClock()
+        spill = os.path.join(self.tempdir, 'sessions')
+        store = SessionStore(max_sessions=1, ttl=60, spill=spill, clock=clock)
+        store['a@example.org'] = {'n': 'a'}
+        clock.now += 45
+        store['b@example.org'] = {'n': 'b'}
+        store['c@example.org'] = {'n': 'c'}
+        clock.now += 30
+        # a has been idle on disk too long, b hasn't
+        self.assertEqual(store.prune(), 1)
+        self.assertEqual(store['b@example.org'], {'n': 'b'})
+        store.close()
+
+    def test_bot_sessions(self):
+        b = bot.BenderJab()
+        b.cfg['sessions'] = '2'
+        b.cfg['session_ttl'] = '600'
+        b.sessions['a@example.org']['seen'] = True
+        self.assertTrue(b.sessions is b.sessions)
+        self.assertEqual(b.sessions.max_sessions, 2)
+        # the ttl sets up a timer to prune idle sessions
+        self.assertEqual(len(b.scheduler), 1)
+
+def suite():
+    return unittest.makeSuite(TestSessionStore)
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,184 @@
+from io import StringIO
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+from benderjab import xsend
+
+from .mock import MockClient
+
+class PooledClient(MockClient):
+    """Mock a XMPP client that can be connected and disconnected
+    """
+    def __init__(self):
+        super(PooledClient, self).__init__()
+        self.connected = 'tcp'
+
+    def isConnected(self):
+        return self.connected
+
+    def Process(self, timeout=0):
+        if self.connected:
+            return '0'
+        return 0
+
+    def disconnect(self):
+        self.connected = ''
+
+class TestXSend(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+        def connect(profile=None):
+            cl = PooledClient()
+            self.connections.append((profile, cl))
+            return cl
+        self.saved_connect = xsend.connect
+        xsend.connect = connect
+
+    def tearDown(self):
+        xsend.close_clients()
+        xsend.connect = self.saved_connect
+
+    def test_pooled_send(self):
+        """keep_alive sends should share one connection per profile
+        """
+        for i in range(3):
+            xsend.send('user@example.org', 'message %d' % (i,),
+                       keep_alive=True)
+        xsend.send('user@example.org', 'other', profile='other',
+                   keep_alive=True)
+        self.assertEqual([p for p, cl in self.connections], [None, 'other'])
+        default = self.connections[0][1]
+        self.assertEqual([m.getBody() for m in default.msgs],
+                         ['message 0', 'message 1', 'message 2'])
+
+        # dropped connections get replaced
+        default.disconnect()
+        xsend.send('user@example.org', 'again', keep_alive=True)
+        self.assertEqual(len(self.connections), 3)
+
+        xsend.close_clients()
+        self.assertFalse(self.connections[-1][1].isConnected())
+
+    def test_pooled_failures(self):
+        xsend.send('user@example.org', 'first', keep_alive=True)
+        stale = self.connections[0][1]
+        # the server hung up but the socket is still open
+        stale.Process = lambda timeout=0: 0
+        xsend.send('user@example.org', 'second', keep_alive=True)
+        self.assertFalse(stale.isConnected())
+        self.assertEqual(self.connections[1][1].msgs[0].getBody(), 'second')
+
+        xsend.connect = lambda profile=None: None
+        self.assertRaises(IOError, xsend.send, 'user@example.org', 'lost',
+                          profile='nobody', keep_alive=True)
+
+    def test_unpooled_send(self):
+        xsend.send('user@example.org', 'once')
+        profile, cl = self.connections[0]
+        self.assertEqual(cl.msgs[0].getBody(), 'once')
+        self.assertFalse(cl.isConnected())
+
+    def test_parse_stream_line(self):
+        self.assertEqual(xsend.parse_stream_line('a@example.org\thi there\n'),
+                         ('a@example.org', 'hi there'))
+        self.assertEqual(xsend.parse_stream_line(
+            '{"to": "b@example.org", "message": "tab\\tin json"}\n'),
+            ('b@example.org', 'tab\tin json'))
+        self.assertRaises(ValueError, xsend.parse_stream_line, 'no tab\n')
+
+    def test_stream_main(self):
+        """Stream a file of messages over one connection
+        """
+        lines = ['a@example.org\tone\n',
+                 'garbage\n',
+                 '\n',
+                 '{"to": "b@example.org", "message": "two"}\n',
+                 '{"to": "c@example.org"}\n']
+        fd, filename = tempfile.mkstemp()
+        try:
+            os.write(fd, ''.join(lines).encode('utf-8'))
+            os.close(fd)
+            errors = StringIO()
+            saved_stderr = xsend.sys.stderr
+            xsend.sys.stderr = errors
+            try:
+                status = xsend.main(['xsend', '--stream', filename,
+                                     '--rate', '1000'])
+            finally:
+                xsend.sys.stderr = saved_stderr
+        finally:
+            os.unlink(filename)
+
+        self.assertEqual(status, 1)
+        self.assertEqual(len(self.connections), 1)
+        profile, cl = self.connections[0]
+        self.assertEqual([(str(m.getTo()), m.getBody()) for m in cl.msgs],
+                         [('a@example.org', 'one'), ('b@example.org', 'two')])
+        self.assertTrue('delivered 2, failed 2' in errors.getvalue())
+        self.assertFalse(cl.isConnected())
+
+    def start_sleepers(self, *delays):
+        procs = [subprocess.Popen([sys.executable, '-c',
+                                   'import time; time.sleep(%s)' % (d,)])
+                 for d in delays]
+        # reap them so they don't linger as zombies
+        for proc in procs:
+            threading.Thread(target=proc.wait, daemon=True).start()
+        return procs
+
+    def test_wait_for_pids(self):
+        """Processes should be reported in the order they exit
+        """
+        slow, fast = self.start_sleepers(0.6, 0.2)
+        start = time.time()
+        exited = list(xsend.wait_for_pids([slow.pid, fast.pid]))
+        self.assertEqual(exited, [fast.pid, slow.pid])
+        self.assertTrue(time.time() - start < 5)
+
+    def test_wait_for_pids_polling(self):
+        """Without pidfds we fall back to polling
+        """
+        saved = xsend._pidfd_open
+        xsend._pidfd_open = lambda pid: None
+        try:
+            slow, fast = self.start_sleepers(0.6, 0.2)
+            exited = list(xsend.wait_for_pids([slow.pid, fast.pid], 0.2))
+        finally:
+            xsend._pidfd_open = saved
+        self.assertEqual(exited, [fast.pid, slow.pid])
+
+    def test_wait_for_pids_without_poll(self):
+        """Without select.poll we poll with os.kill instead
+        """
+        saved = xsend.select
+        xsend.select = types.SimpleNamespace()
+        try:
+            slow, fast = self.start_sleepers(0.6, 0.2)
+            exited = list(xsend.wait_for_pids([slow.pid, fast.pid], 0.2))
+        finally:
+            xsend.select = saved
+        self.assertEqual(exited, [fast.pid, slow.pid])
+
+    def test_send_on_exit(self):
+        slow, fast = self.start_sleepers(0.4, 0.1)
+        watches = [xsend.parse_watch_line('%d\ta@example.org\tslow done' % (
+                       slow.pid,)),
+                   xsend.parse_watch_line(
+                       '{"pid": %d, "to": "b@example.org", '
+                       '"message": "fast done"}' % (fast.pid,))]
+        self.assertEqual(xsend.send_on_exit(watches), (2, 0))
+        profile, cl = self.connections[0]
+        self.assertEqual([m.getBody() for m in cl.msgs],
+                         ['fast done', 'slow done'])
+
+def suite():
+    return unittest.makeSuite(TestXSend)
+
+if __name__ == "__main__":
+  unittest.main(defaultTest="suite")